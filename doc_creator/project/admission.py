@@ -0,0 +1,189 @@
+"""
+Adaptive execution timeouts and admission control for generated scripts.
+
+`CostModel` keeps the recent execution times of scripts per document type
+(docx/pptx/pdf, read from the script itself) and script size class. Each new script
+gets a predicted cost (median) and a timeout derived from the tail (p95 x factor),
+clamped to configured bounds. A bucket with too few samples falls back to its
+document type, then to all scripts, then to the fixed default timeout.
+
+`AdmissionController` bounds the predicted work in flight. A script is admitted
+when the work already admitted would drain within `max_queue_seconds` on the
+available execution slots and the host's load average leaves CPU headroom.
+Otherwise it is deferred: it waits up to `max_wait` for capacity and is then shed
+with `Overloaded`, carrying a Retry-After estimate. When nothing is in flight, work
+is always admitted, so the server keeps making progress on a host loaded by
+something else.
+"""
+import os
+import math
+import time
+import bisect
+import threading
+from collections import deque
+
+SIZE_CLASSES = (2048, 4096, 8192, 16384) # Script length bounds in characters; longer scripts share the last class
+MIN_SAMPLES = 20 # Per bucket before its own distribution is trusted
+MAX_SAMPLES = 200 # Recent samples kept per bucket
+
+
+def guess_doc_type(code):
+    """Output type a script will produce, judged by the output filename or library it uses."""
+    for doc_type in ('docx', 'pptx', 'pdf'):
+        if f'output.{doc_type}' in code:
+            return doc_type
+    if 'reportlab' in code:
+        return 'pdf'
+    if 'pptx' in code:
+        return 'pptx'
+    if 'docx' in code:
+        return 'docx'
+    return 'unknown'
+
+
+def size_class(code_length):
+    return bisect.bisect_left(SIZE_CLASSES, code_length)
+
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(math.ceil(len(sorted_values) * pct / 100)) - 1)]
+
+
+class Estimate:
+    """Predicted execution cost and the timeout to run it with."""
+
+    def __init__(self, doc_type, size_class, expected, timeout, basis):
+        self.doc_type = doc_type
+        self.size_class = size_class
+        self.expected = expected # Seconds (median of the basis bucket)
+        self.timeout = timeout # Seconds
+        self.basis = basis # Which bucket the numbers came from: 'bucket', 'doc_type', 'global' or 'default'
+
+
+class CostModel:
+    """Execution-time distributions per (document type, script size class). Thread-safe."""
+
+    def __init__(self, default_timeout=15, min_timeout=5, max_timeout=60, timeout_factor=3.0):
+        self.default_timeout = default_timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.timeout_factor = timeout_factor
+        self._lock = threading.Lock()
+        self._samples = {} # key -> deque of seconds; keys: (doc_type, size_class), (doc_type,), ()
+
+    def record(self, doc_type, code_length, seconds):
+        """Adds one observed execution time (use the timeout for runs that timed out)."""
+        bucket = (doc_type, size_class(code_length))
+        with self._lock:
+            for key in (bucket, bucket[:1], ()):
+                samples = self._samples.get(key)
+                if samples is None:
+                    samples = self._samples[key] = deque(maxlen=MAX_SAMPLES)
+                samples.append(seconds)
+
+    def estimate(self, code):
+        doc_type = guess_doc_type(code)
+        bucket = (doc_type, size_class(len(code)))
+        with self._lock:
+            for key, basis in ((bucket, 'bucket'), (bucket[:1], 'doc_type'), ((), 'global')):
+                samples = self._samples.get(key)
+                if samples is not None and len(samples) >= MIN_SAMPLES:
+                    values = sorted(samples)
+                    break
+            else:
+                return Estimate(doc_type, bucket[1], None, self.default_timeout, 'default')
+        timeout = _percentile(values, 95) * self.timeout_factor
+        timeout = min(self.max_timeout, max(self.min_timeout, timeout))
+        return Estimate(doc_type, bucket[1], _percentile(values, 50), timeout, basis)
+
+    def stats(self):
+        with self._lock:
+            buckets = {key: sorted(samples) for key, samples in self._samples.items() if len(key) == 2}
+        return {
+            f"{doc_type}/{'<' + str(SIZE_CLASSES[cls]) if cls < len(SIZE_CLASSES) else '>=' + str(SIZE_CLASSES[-1])}": {
+                'samples': len(values), 'p50': _percentile(values, 50), 'p95': _percentile(values, 95),
+            }
+            for (doc_type, cls), values in sorted(buckets.items())
+        }
+
+
+class Overloaded(Exception):
+    """No headroom for more work within the admission wait; retry after `retry_after` seconds."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _cpu_count():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _load_per_cpu():
+    try:
+        return os.getloadavg()[0] / _cpu_count()
+    except (AttributeError, OSError):
+        return 0.0 # Not available on this platform: rely on the in-flight work bound alone
+
+
+class AdmissionController:
+    """Admits executions while the predicted work in flight fits the host. Thread-safe."""
+
+    def __init__(self, slots, max_queue_seconds=10.0, max_wait=5.0, max_load=2.0, default_cost=1.0):
+        self.slots = max(1, slots)
+        self.max_queue_seconds = max_queue_seconds
+        self.max_wait = max_wait
+        self.max_load = max_load
+        self.default_cost = default_cost # Used until the cost model has predictions
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._work = 0.0 # Sum of the predicted costs admitted and not yet released
+        self.counters = {'admitted': 0, 'deferred': 0, 'shed': 0}
+
+    def _has_headroom(self, cost):
+        if self._in_flight == 0:
+            return True
+        if (self._work + cost) / self.slots > self.max_queue_seconds:
+            return False
+        return not self.max_load or _load_per_cpu() <= self.max_load
+
+    def acquire(self, cost=None):
+        """Blocks up to max_wait for headroom; returns the admitted cost or raises Overloaded."""
+        cost = cost if cost is not None else self.default_cost
+        with self._cond:
+            if not self._has_headroom(cost):
+                self.counters['deferred'] += 1
+                deadline = time.monotonic() + self.max_wait
+                while not self._has_headroom(cost):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.counters['shed'] += 1
+                        # Time for the admitted work to drain to the queue bound
+                        retry_after = max(1, math.ceil(self._work / self.slots - self.max_queue_seconds))
+                        raise Overloaded("Execution capacity exhausted", retry_after)
+                    self._cond.wait(remaining)
+            self.counters['admitted'] += 1
+            self._in_flight += 1
+            self._work += cost
+            return cost
+
+    def release(self, cost):
+        with self._cond:
+            self._in_flight -= 1
+            self._work = max(0.0, self._work - cost)
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'slots': self.slots,
+                'in_flight': self._in_flight,
+                'predicted_work_seconds': round(self._work, 3),
+                'load_per_cpu': round(_load_per_cpu(), 2),
+                **self.counters,
+            }
@@ -0,0 +1,201 @@
+"""
+Cache of rendered documents keyed by the SHA-256 of the script that produced them.
+
+Identical validated scripts produce the same document, so instead of executing a
+script again the server links the previously rendered `output.*` file into the
+new session directory. Files are hard-linked when the cache and the session
+directories share a filesystem (no data is copied) and copied otherwise.
+
+Layout: <root>/<key[:2]>/<key>/<output.ext>. Entries expire after `ttl` seconds
+(so date-stamped documents get refreshed) and the least recently used entries are
+evicted once the cache grows past `max_bytes`.
+
+Several processes (gunicorn workers) may share one root. Each keeps an in-memory index
+of the entries, but the directory is the source of truth: a key another process stored
+is picked up from disk on the first lookup or store that misses the index, and the
+index is re-synced from disk at most every `resync_interval` seconds before evicting,
+so `max_bytes` and the TTL bound the shared directory rather than each process's share
+of it. Recency (for LRU) is still tracked per process.
+"""
+import os
+import time
+import errno
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+
+
+def artifact_key(code):
+    return hashlib.sha256(code.encode('utf-8')).hexdigest()
+
+
+def link_or_copy(src, dest):
+    """Hard-links `src` to `dest`, falling back to a copy across filesystems or where links are unsupported."""
+    try:
+        os.link(src, dest)
+        return 'link'
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP, errno.EACCES):
+            raise
+    shutil.copyfile(src, dest) # Uses copy_file_range/sendfile where the OS supports it
+    return 'copy'
+
+
+class ArtifactCache:
+    """Content-addressed store of output files with TTL and LRU size eviction."""
+
+    def __init__(self, root, max_bytes=512 * 1024 * 1024, ttl=24 * 3600, resync_interval=60, logger=None):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.resync_interval = resync_interval
+        self.logger = logger or logging.getLogger(__name__)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+        # key -> [filename, size, created_at, last_used]; rebuilt from disk, then kept in memory
+        self._entries = self._scan()
+        self._total_bytes = sum(entry[1] for entry in self._entries.values())
+        self._synced_at = time.time()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def _scan(self):
+        entries = {}
+        for shard in os.listdir(self.root):
+            shard_dir = os.path.join(self.root, shard)
+            if not os.path.isdir(shard_dir):
+                continue
+            for key in os.listdir(shard_dir):
+                if key.startswith('.'):
+                    continue # Staging directory of a store() in progress, possibly in another process
+                entry_dir = os.path.join(shard_dir, key)
+                try:
+                    names = [n for n in os.listdir(entry_dir) if not n.startswith('.')]
+                    if len(names) != 1:
+                        shutil.rmtree(entry_dir, ignore_errors=True) # Incomplete/corrupt entry
+                        continue
+                    st = os.stat(os.path.join(entry_dir, names[0]))
+                except OSError:
+                    continue
+                entries[key] = [names[0], st.st_size, st.st_mtime, st.st_atime]
+        return entries
+
+    def _adopt(self, key, now):
+        """
+        Records an entry that exists on disk but not in the index (stored by another process).
+        Caller holds the lock. Returns the entry, or None if there is no complete entry.
+        """
+        entry_dir = self._entry_dir(key)
+        try:
+            names = [n for n in os.listdir(entry_dir) if not n.startswith('.')]
+            if len(names) != 1:
+                return None
+            st = os.stat(os.path.join(entry_dir, names[0]))
+        except OSError:
+            return None
+        # The entry directory is renamed into place once complete, so its mtime is the creation time
+        entry = self._entries[key] = [names[0], st.st_size, st.st_mtime, now]
+        self._total_bytes += st.st_size
+        return entry
+
+    def _resync(self, now):
+        # Caller holds the lock. Merges entries other processes added or removed, keeping known recency.
+        scanned = self._scan()
+        for key, entry in scanned.items():
+            known = self._entries.get(key)
+            if known is not None:
+                entry[3] = known[3]
+        self._entries = scanned
+        self._total_bytes = sum(entry[1] for entry in scanned.values())
+        self._synced_at = now
+
+    def lookup(self, key):
+        """Returns the path of the cached output for `key`, or None."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._adopt(key, now)
+            if entry is not None and now - entry[2] > self.ttl:
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            path = os.path.join(self._entry_dir(key), entry[0])
+            if not os.path.isfile(path):
+                self._remove(key)
+                self.misses += 1
+                return None
+            entry[3] = now
+            self.hits += 1
+            return path
+
+    def store(self, key, src_path):
+        """Adds the rendered file at `src_path` to the cache under `key`."""
+        filename = os.path.basename(src_path)
+        size = os.path.getsize(src_path)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+        entry_dir = self._entry_dir(key)
+        os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+        # Build the entry in a temp dir and rename it into place so readers never see a partial entry
+        staging_dir = tempfile.mkdtemp(prefix='.staging-', dir=os.path.dirname(entry_dir))
+        try:
+            link_or_copy(src_path, os.path.join(staging_dir, filename))
+            os.rename(staging_dir, entry_dir)
+        except OSError:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            if not os.path.isdir(entry_dir):
+                raise
+            # Lost a race to a concurrent store() (possibly in another process): use its entry
+            with self._lock:
+                if key not in self._entries:
+                    self._adopt(key, time.time())
+            return
+        now = time.time()
+        with self._lock:
+            self._entries[key] = [filename, size, now, now]
+            self._total_bytes += size
+            self._evict(now)
+
+    def _remove(self, key):
+        # Caller holds the lock
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._total_bytes -= entry[1]
+            self.evictions += 1
+        shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+
+    def _evict(self, now):
+        # Caller holds the lock
+        if now - self._synced_at >= self.resync_interval:
+            self._resync(now)
+        for key in [k for k, e in self._entries.items() if now - e[2] > self.ttl]:
+            self._remove(key)
+        if self._total_bytes > self.max_bytes:
+            for key in sorted(self._entries, key=lambda k: self._entries[k][3]):
+                if self._total_bytes <= self.max_bytes:
+                    break
+                self._remove(key)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._total_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
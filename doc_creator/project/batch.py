@@ -0,0 +1,76 @@
+"""
+Helpers for batch generation: bounded fan-out of pipeline calls and streamed ZIP output.
+
+`run_concurrently` runs a handler over many items on a bounded thread pool (the handler
+spends most of its time waiting on the model API or on the worker-process pool, so
+threads are enough to overlap them) and yields results as they finish. `iter_zip`
+builds a ZIP archive on the fly for a streamed response: members are written with
+data descriptors, so nothing needs to be seeked back and at most one copy block is
+held in memory per member.
+"""
+import io
+import zipfile
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+COPY_BLOCK_SIZE = 256 * 1024
+
+
+def run_concurrently(handler, items, concurrency, thread_name_prefix="docgen-batch"):
+    """
+    Calls handler(item) for every item with at most `concurrency` calls in flight.
+    Yields (index, result) in completion order. Closing the generator early cancels
+    the items that have not started yet.
+    """
+    executor = ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(items))),
+                                  thread_name_prefix=thread_name_prefix)
+    try:
+        # Each call runs in a copy of the caller's context, so log records keep the request id
+        futures = {executor.submit(contextvars.copy_context().run, handler, item): index for index, item in enumerate(items)}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only, unseekable file object that collects what ZipFile writes."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def iter_zip(members):
+    """
+    Yields the bytes of a ZIP archive built from `members`, an iterable of
+    (arcname, path) or (arcname, bytes) pairs that may itself be produced lazily.
+    Office files and PDFs are already compressed, so members are stored, not deflated.
+    """
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for arcname, source in members:
+            if isinstance(source, bytes):
+                archive.writestr(arcname, source)
+            else:
+                with open(source, 'rb') as src, archive.open(arcname, 'w', force_zip64=True) as dest:
+                    for block in iter(lambda: src.read(COPY_BLOCK_SIZE), b''):
+                        dest.write(block)
+                        data = sink.drain()
+                        if data:
+                            yield data
+            data = sink.drain()
+            if data:
+                yield data
+    yield sink.drain() # Central directory
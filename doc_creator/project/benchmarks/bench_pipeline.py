@@ -0,0 +1,198 @@
+"""
+End-to-end benchmark: POST /generate-file through the Flask test client.
+
+The model is the replay backend (llm_backends.ReplayBackend) serving the recorded
+docx/pptx/pdf scripts in benchmarks/corpus, so runs are free, offline and
+repeatable; everything after the model call (extraction, validation, execution,
+file move, storage) is the real pipeline. For every concurrency level it reports
+requests/sec and p50/p95/p99 latency of the whole request and of each stage:
+
+  llm         model call incl. streaming (minus extraction)
+  extraction  code-block extraction from the streamed text
+  validation  static validation of the script
+  execution   running the script (warm worker pool or subprocess)
+  file_move   moving output.* into the session directory
+  render      in-process rendering of the document tree (--mode ir, replaces execution/file_move)
+
+Caches are disabled by default so every request runs every stage.
+
+Usage (from doc_creator/project):
+    python benchmarks/bench_pipeline.py [--concurrency 1,2,4,8] [--requests 40]
+        [--mode code|ir] [--llm-ttft fixed:0] [--llm-chunk-interval fixed:0] [--json results.json]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.abspath(os.path.join(HERE, '..'))
+STAGES = ('llm', 'extraction', 'validation', 'execution', 'file_move', 'render')
+
+
+def percentile(sorted_values, pct):
+    """Linear-interpolated percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = (len(sorted_values) - 1) * pct / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (rank - lower)
+
+
+def summarize(samples):
+    values = sorted(samples)
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'mean': sum(values) / len(values),
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+        'max': values[-1],
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', default='1,2,4,8', help="Comma-separated concurrency levels")
+    parser.add_argument('--requests', type=int, default=40, help="Measured requests per concurrency level")
+    parser.add_argument('--warmup', type=int, default=3, help="Unmeasured requests before the first level")
+    parser.add_argument('--mode', choices=('code', 'ir'), default='code', help="Generation mode (scripts or document trees)")
+    parser.add_argument('--corpus', default=os.path.join(HERE, 'corpus'), help="Replay corpus directory (scripts)")
+    parser.add_argument('--ir-corpus', default=os.path.join(HERE, 'corpus_ir'), help="Replay corpus directory (document trees)")
+    parser.add_argument('--llm-ttft', default='fixed:0', help="Replay time-to-first-chunk, e.g. 'lognormal:2,0.5'")
+    parser.add_argument('--llm-chunk-interval', default='fixed:0', help="Replay delay between chunks")
+    parser.add_argument('--worker-pool-size', type=int, default=None, help="Override WORKER_POOL_SIZE")
+    parser.add_argument('--no-worker-pool', action='store_true', help="Execute scripts with one subprocess each")
+    parser.add_argument('--with-caches', action='store_true', help="Keep the code/artifact caches enabled")
+    parser.add_argument('--json', metavar='PATH', help="Write machine-readable results to PATH")
+    return parser.parse_args()
+
+
+def configure_environment(args, work_dir):
+    """Must run before `server` is imported: its configuration is read from the environment at import."""
+    os.environ.update({
+        'LLM_BACKEND': 'replay',
+        'LLM_REPLAY_CORPUS': args.corpus,
+        'LLM_REPLAY_IR_CORPUS': args.ir_corpus,
+        'LLM_REPLAY_TTFT': args.llm_ttft,
+        'LLM_REPLAY_CHUNK_INTERVAL': args.llm_chunk_interval,
+        'CODE_CACHE_ENABLED': '1' if args.with_caches else '0',
+        'ARTIFACT_CACHE_ENABLED': '1' if args.with_caches else '0',
+        'CODE_CACHE_PATH': os.path.join(work_dir, 'cache', 'code_cache.sqlite3'),
+        'ARTIFACT_CACHE_DIR': os.path.join(work_dir, 'cache', 'artifacts'),
+        'JANITOR_ENABLED': '0',
+        'DOCGEN_WORKER_POOL': '0' if args.no_worker_pool else '1',
+    })
+    if args.worker_pool_size:
+        os.environ['WORKER_POOL_SIZE'] = str(args.worker_pool_size)
+
+
+def main():
+    args = parse_args()
+    levels = [int(level) for level in args.concurrency.split(',') if level.strip()]
+    work_dir = tempfile.mkdtemp(prefix='docgen-bench-')
+    configure_environment(args, work_dir)
+
+    sys.path.insert(0, PROJECT_DIR)
+    import server # noqa: E402 - configured through the environment above
+
+    server.app.config['GENERATED_FILES_DIR'] = os.path.join(work_dir, 'generated_files')
+    os.makedirs(server.app.config['GENERATED_FILES_DIR'], exist_ok=True)
+    server.app.logger.setLevel(logging.WARNING) # Per-request INFO logging would dominate the measurement
+
+    stage_samples = {stage: [] for stage in STAGES}
+    samples_lock = threading.Lock()
+
+    def observer(stage, seconds):
+        with samples_lock:
+            stage_samples.setdefault(stage, []).append(seconds)
+
+    server.STAGE_OBSERVERS.append(observer)
+    counter = iter(range(10 ** 9))
+
+    def one_request(_):
+        # Unique prompts: the replay backend still maps them onto the corpus by hash
+        prompt = f"Benchmark document request #{next(counter)}"
+        client = server.app.test_client()
+        started = time.perf_counter()
+        response = client.post('/generate-file', json={'prompt': prompt, 'mode': args.mode})
+        return time.perf_counter() - started, response.status_code
+
+    try:
+        for _ in range(args.warmup):
+            one_request(None)
+
+        results = []
+        print(f"{'conc':>5}{'req/s':>9}{'errors':>8}  " + ''.join(f"{name + ' p50/p95/p99 ms':>30}" for name in ('total',) + STAGES))
+        for level in levels:
+            with samples_lock:
+                for samples in stage_samples.values():
+                    samples.clear()
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=level) as executor:
+                outcomes = list(executor.map(one_request, range(args.requests)))
+            wall = time.perf_counter() - started
+
+            with samples_lock:
+                latency = {stage: summarize(samples) for stage, samples in stage_samples.items()}
+            latency['total'] = summarize([seconds for seconds, _ in outcomes])
+            errors = sum(1 for _, status in outcomes if status != 200)
+            result = {
+                'concurrency': level,
+                'requests': len(outcomes),
+                'errors': errors,
+                'status_codes': {str(code): sum(1 for _, status in outcomes if status == code) for code in {s for _, s in outcomes}},
+                'wall_seconds': wall,
+                'requests_per_second': len(outcomes) / wall if wall else None,
+                'latency_seconds': latency,
+            }
+            results.append(result)
+
+            def cell(name):
+                stats = latency.get(name, {})
+                if not stats.get('count'):
+                    return f"{'-':>30}"
+                return f"{stats['p50'] * 1e3:>14.1f}/{stats['p95'] * 1e3:.1f}/{stats['p99'] * 1e3:.1f}".rjust(30)
+            print(f"{level:>5}{result['requests_per_second']:>9.2f}{errors:>8}  " + ''.join(cell(name) for name in ('total',) + STAGES))
+
+        if args.json:
+            report = {
+                'benchmark': 'pipeline',
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'config': {
+                    'requests_per_level': args.requests,
+                    'mode': args.mode,
+                    'llm_ttft': args.llm_ttft,
+                    'llm_chunk_interval': args.llm_chunk_interval,
+                    'worker_pool': server.app.config['USE_WORKER_POOL'],
+                    'worker_pool_size': server.app.config['WORKER_POOL_SIZE'],
+                    'caches': args.with_caches,
+                    'corpus': sorted(name for name, _ in (server.get_ir_model() if args.mode == 'ir' else server.get_model()).responses),
+                },
+                'results': results,
+            }
+            with open(args.json, 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2)
+            print(f"Results written to {args.json}")
+    finally:
+        server.STAGE_OBSERVERS.remove(observer)
+        if server._worker_pool is not None:
+            server._worker_pool.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
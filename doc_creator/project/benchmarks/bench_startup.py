@@ -0,0 +1,232 @@
+"""
+Startup benchmark: what a new web worker pays before it serves its first requests.
+
+  import profile  `python -X importtime -c "import server"` in a fresh interpreter: total
+                  import time and the most expensive modules (cumulative and self time)
+  cold worker     fresh interpreter: import server, create_app(), a first template request
+                  (python-docx imported on first use), the first model client
+  forked worker   fork of a process that imported server and ran create_app(preload=True),
+                  as gunicorn does with gunicorn.conf.py (preload_app): the same steps
+
+Each phase is timed inside the worker; `total` is measured by the parent from spawn (or
+fork) to the worker's report, so it includes interpreter startup for cold workers.
+The model backend is google.generativeai with a placeholder key: only its import and
+client construction are measured, no request is sent (--backend replay leaves it out).
+
+Usage (from doc_creator/project):
+    python benchmarks/bench_startup.py [--runs 5] [--top 15] [--backend gemini|replay] [--json results.json]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.abspath(os.path.join(HERE, '..'))
+PHASES = ('import', 'create_app', 'first_request', 'model_client')
+TEMPLATE_REQUEST = {'template': 'meeting_minutes', 'content': {'title': 'Startup', 'attendees': ['A', 'B']}}
+
+
+def percentile(sorted_values, pct):
+    """Linear-interpolated percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = (len(sorted_values) - 1) * pct / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (rank - lower)
+
+
+def summarize(samples):
+    values = sorted(samples)
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'mean': sum(values) / len(values),
+        'p50': percentile(values, 50),
+        'max': values[-1],
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help="Workers started per variant")
+    parser.add_argument('--top', type=int, default=15, help="Modules listed in the import profile")
+    parser.add_argument('--backend', choices=('gemini', 'replay'), default='gemini', help="Model backend built in the model_client phase")
+    parser.add_argument('--json', metavar='PATH', help="Write machine-readable results to PATH")
+    parser.add_argument('--worker', metavar='WORK_DIR', help=argparse.SUPPRESS) # Internal: run one cold worker
+    return parser.parse_args()
+
+
+def configure_environment(backend, work_dir):
+    """Must run before `server` is imported: its configuration is read from the environment at import."""
+    os.environ.update({
+        'LLM_BACKEND': backend,
+        'LLM_REPLAY_CORPUS': os.path.join(HERE, 'corpus'),
+        'CODE_CACHE_ENABLED': '0',
+        'ARTIFACT_CACHE_ENABLED': '0',
+        'JANITOR_ENABLED': '0',
+        'DOCGEN_WORKER_POOL': '0',
+        'CODE_CACHE_PATH': os.path.join(work_dir, 'cache', 'code_cache.sqlite3'),
+        'ARTIFACT_CACHE_DIR': os.path.join(work_dir, 'cache', 'artifacts'),
+    })
+    os.environ.setdefault('GEMINI_API_KEY', 'placeholder-key-for-startup-benchmark')
+
+
+def point_at(server, work_dir):
+    server.app.config['GENERATED_FILES_DIR'] = os.path.join(work_dir, 'generated_files')
+    server.log_file = os.path.join(work_dir, 'app.log') # Keep benchmark records out of the real log
+
+
+def run_worker(work_dir):
+    """One worker's startup, phase by phase (seconds). Runs in the cold subprocess or the forked child."""
+    timings = {}
+    started = time.perf_counter()
+    sys.path.insert(0, PROJECT_DIR)
+    import server # Already in sys.modules in a forked worker
+    point_at(server, work_dir)
+    timings['import'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    server.create_app(preload=False) # Whatever the master preloaded is inherited; nothing more is imported here
+    timings['create_app'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    response = server.app.test_client().post('/generate-file', json=TEMPLATE_REQUEST)
+    if response.status_code != 200:
+        raise RuntimeError(f"Template request failed: {response.status_code} {response.get_data(as_text=True)[:200]}")
+    timings['first_request'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    if server.get_model() is None:
+        raise RuntimeError("Model backend could not be created")
+    timings['model_client'] = time.perf_counter() - started
+    return timings
+
+
+def import_profile(top):
+    """Parses `-X importtime` output of `import server` (microseconds per module)."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import server'], cwd=PROJECT_DIR,
+                            env=os.environ.copy(), capture_output=True, text=True, check=True)
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules.append({'module': name.strip(), 'depth': (len(name) - len(name.lstrip()) - 1) // 2,
+                        'self_ms': int(self_us) / 1000, 'cumulative_ms': int(cumulative_us) / 1000})
+    total = next((m['cumulative_ms'] for m in modules if m['module'] == 'server'), None)
+    # Top-level imports of server.py (depth 1) show which dependency costs what
+    direct = sorted((m for m in modules if m['depth'] == 1), key=lambda m: m['cumulative_ms'], reverse=True)[:top]
+    by_self = sorted(modules, key=lambda m: m['self_ms'], reverse=True)[:top]
+    return {'total_ms': total, 'modules': len(modules), 'direct': direct, 'self': by_self}
+
+
+def cold_worker(work_dir):
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', work_dir], cwd=PROJECT_DIR,
+                            env=os.environ.copy(), capture_output=True, text=True)
+    total = time.perf_counter() - started
+    if result.returncode != 0:
+        raise RuntimeError(f"Cold worker failed:\n{result.stderr[-2000:]}")
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    timings['total'] = total
+    return timings
+
+
+def forked_worker(work_dir):
+    read_fd, write_fd = os.pipe()
+    started = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        status = 0
+        try:
+            report = run_worker(work_dir)
+        except Exception as e:
+            report, status = {'error': str(e)}, 1
+        os.write(write_fd, json.dumps(report).encode())
+        os._exit(status)
+    os.close(write_fd)
+    with os.fdopen(read_fd, 'rb') as pipe:
+        output = pipe.read()
+    total = time.perf_counter() - started
+    os.waitpid(pid, 0)
+    timings = json.loads(output)
+    if 'error' in timings:
+        raise RuntimeError(f"Forked worker failed: {timings['error']}")
+    timings['total'] = total
+    return timings
+
+
+def print_variant(name, runs):
+    row = {phase: summarize([run[phase] for run in runs]) for phase in PHASES + ('total',)}
+    print(f"{name:<16}" + ''.join(f"{row[phase]['p50'] * 1000:>15.1f}" for phase in PHASES + ('total',)))
+    return row
+
+
+def main():
+    args = parse_args()
+    if args.worker:
+        print(json.dumps(run_worker(args.worker)))
+        return
+
+    work_dir = tempfile.mkdtemp(prefix='docgen-startup-')
+    configure_environment(args.backend, work_dir)
+    try:
+        profile = import_profile(args.top)
+        print(f"import server: {profile['total_ms']:.1f} ms over {profile['modules']} modules")
+        print(f"\n{'direct imports':<40}{'cumulative ms':>15}")
+        for m in profile['direct']:
+            print(f"{m['module']:<40}{m['cumulative_ms']:>15.1f}")
+        print(f"\n{'modules by self time':<40}{'self ms':>15}")
+        for m in profile['self']:
+            print(f"{m['module']:<40}{m['self_ms']:>15.1f}")
+
+        cold = [cold_worker(work_dir) for _ in range(args.runs)]
+
+        # This process becomes the "master": import, preload, then fork the workers
+        sys.path.insert(0, PROJECT_DIR)
+        import server # noqa: E402 - configured through the environment above
+        point_at(server, work_dir)
+        started = time.perf_counter()
+        server.create_app(preload=True)
+        preload_seconds = time.perf_counter() - started
+        forked = [forked_worker(work_dir) for _ in range(args.runs)]
+
+        print(f"\nworker startup, p50 of {args.runs} (ms); master preload took {preload_seconds * 1000:.1f} ms once")
+        print(f"{'':<16}" + ''.join(f"{phase:>15}" for phase in PHASES + ('total',)))
+        results = {
+            'cold': print_variant('cold worker', cold),
+            'forked': print_variant('forked worker', forked),
+        }
+        speedup = results['cold']['total']['p50'] / results['forked']['total']['p50']
+        print(f"\nforked workers are ready {speedup:.1f}x faster")
+
+        if args.json:
+            report = {
+                'benchmark': 'startup',
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'config': {'runs': args.runs, 'backend': args.backend},
+                'import_profile': profile,
+                'master_preload_seconds': preload_seconds,
+                'results': results,
+            }
+            with open(args.json, 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2)
+            print(f"Results written to {args.json}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
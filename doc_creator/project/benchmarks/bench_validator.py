@@ -0,0 +1,161 @@
+"""
+Micro-benchmark: legacy validate_generated_code() vs. CodeValidator.
+
+Builds docx/pptx/pdf scripts of roughly 5, 20 and 50 KB (the sizes the model
+typically returns) and times:
+  - legacy:  the original regex + ast.walk + isinstance/list-membership version
+  - cold:    CodeValidator with the memo bypassed (one AST pass, frozenset rules)
+  - memo:    CodeValidator.validate() on a script it has already seen
+
+Usage (from doc_creator/project):
+    python benchmarks/bench_validator.py [--repeat N]
+"""
+import os
+import re
+import sys
+import ast
+import json
+import timeit
+import logging
+import argparse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from code_validator import CodeValidator # noqa: E402
+
+ALLOWED_MODULES = {'python-docx', 'docx', 'pptx', 'python-pptx', 'reportlab', 'datetime', 'random'}
+logger = logging.getLogger('bench')
+logger.addHandler(logging.NullHandler())
+
+DOCX_HEADER = """from docx import Document
+from docx.shared import Pt, Inches
+from docx.enum.text import WD_LINE_SPACING
+
+doc = Document()
+style = doc.styles['Normal']
+style.font.name = 'Times New Roman'
+style.font.size = Pt(13)
+section = doc.sections[0]
+section.left_margin = Inches(1)
+"""
+DOCX_BLOCK = """heading_{i} = doc.add_heading('Section {i}', level=2)
+para_{i} = doc.add_paragraph()
+run_{i} = para_{i}.add_run("Quarterly figures for region {i} improved across all key indicators.")
+run_{i}.bold = {bold}
+table_{i} = doc.add_table(rows=2, cols=2)
+table_{i}.cell(0, 0).text = 'Metric'
+table_{i}.cell(0, 1).text = str({i} * 3)
+"""
+PPTX_HEADER = """from pptx import Presentation
+from pptx.util import Pt, Inches
+
+prs = Presentation()
+"""
+PPTX_BLOCK = """slide_{i} = prs.slides.add_slide(prs.slide_layouts[1])
+title_{i} = slide_{i}.shapes.title
+title_{i}.text = "Topic {i}"
+body_{i} = slide_{i}.placeholders[1].text_frame
+para_{i} = body_{i}.add_paragraph()
+para_{i}.text = "Key point number {i} with supporting detail"
+para_{i}.font.size = Pt(18)
+"""
+PDF_HEADER = """from reportlab.lib.pagesizes import letter
+from reportlab.lib.styles import getSampleStyleSheet
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
+
+styles = getSampleStyleSheet()
+doc = SimpleDocTemplate("output.pdf", pagesize=letter)
+story = []
+"""
+PDF_BLOCK = """story.append(Paragraph("Chapter {i}: findings and analysis of item {i}", styles['Heading2']))
+story.append(Paragraph("Body text for chapter {i}. " * 4, styles['Normal']))
+story.append(Spacer(1, 12))
+"""
+FOOTERS = {'docx': "doc.save('output.docx')\n", 'pptx': "prs.save('output.pptx')\n", 'pdf': "doc.build(story)\n"}
+
+
+def build_script(kind, target_bytes):
+    header, block = {'docx': (DOCX_HEADER, DOCX_BLOCK), 'pptx': (PPTX_HEADER, PPTX_BLOCK), 'pdf': (PDF_HEADER, PDF_BLOCK)}[kind]
+    parts = [header]
+    size, i = len(header), 0
+    while size < target_bytes:
+        chunk = block.format(i=i, bold=bool(i % 2))
+        parts.append(chunk)
+        size += len(chunk)
+        i += 1
+    parts.append(FOOTERS[kind])
+    return ''.join(parts)
+
+
+def legacy_validate(code):
+    """Frozen copy of the original validate_generated_code() logic, for comparison."""
+    logger.debug(f"Validating code (first 200 chars): {code[:200]}...")
+    MAX_CODE_LENGTH = 1000000
+    if len(code) > MAX_CODE_LENGTH:
+        return False
+    forbidden_patterns = []
+    for pattern in forbidden_patterns:
+        if re.search(pattern, code, re.IGNORECASE):
+            return False
+    try:
+        tree = ast.parse(code)
+        allowed_modules = ALLOWED_MODULES
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                for alias in node.names:
+                    module_name = alias.name.split('.')[0]
+                    if module_name not in allowed_modules:
+                        return False
+            elif isinstance(node, ast.ImportFrom):
+                if node.level > 0:
+                    return False
+                module_name = node.module.split('.')[0] if node.module else None
+                if module_name and module_name not in allowed_modules:
+                    return False
+            if isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+                if node.func.id in ['eval', 'exec', 'compile', 'open', 'input', '__import__', 'globals', 'locals', 'getattr', 'setattr']:
+                    return False
+            if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name):
+                if node.value.id in ['os', 'sys', 'subprocess', 'shutil', 'socket', 'requests', 'urllib', 'httpx', 'pickle', 'ctypes']:
+                    if node.value.id == 'os' and node.attr in ['system', 'popen', 'environ', 'getenv', 'putenv', 'listdir', 'scandir', 'remove', 'unlink', 'rmdir', 'makedirs', 'chmod', 'chown']:
+                        return False
+                    if node.value.id == 'subprocess' and node.attr in ['run', 'call', 'check_call', 'check_output', 'Popen']:
+                        return False
+    except SyntaxError:
+        return False
+    except Exception:
+        return False
+    logger.debug("Code validation passed.")
+    return True
+
+
+def best_of(func, repeat, number):
+    return min(timeit.repeat(func, repeat=repeat, number=number)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5, help="Timing rounds per case (best is reported)")
+    parser.add_argument('--json', metavar='PATH', help="Also write results as JSON to PATH")
+    args = parser.parse_args()
+
+    validator = CodeValidator(ALLOWED_MODULES)
+    results = []
+    print(f"{'case':<12}{'size':>9}{'legacy ms':>12}{'cold ms':>10}{'memo us':>10}{'speedup':>10}")
+    for kind in ('docx', 'pptx', 'pdf'):
+        for target in (5_000, 20_000, 50_000):
+            code = build_script(kind, target)
+            assert legacy_validate(code) and validator.validate(code), f"{kind} script should pass"
+            number = max(1, 200_000 // len(code))
+            legacy = best_of(lambda: legacy_validate(code), args.repeat, number)
+            cold = best_of(lambda: validator._validate_uncached(code), args.repeat, number)
+            memo = best_of(lambda: validator.validate(code), args.repeat, number * 20)
+            results.append({'case': kind, 'bytes': len(code), 'legacy_s': legacy, 'cold_s': cold, 'memo_s': memo})
+            print(f"{kind:<12}{len(code):>9}{legacy * 1e3:>12.3f}{cold * 1e3:>10.3f}{memo * 1e6:>10.1f}{legacy / memo:>9.0f}x")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
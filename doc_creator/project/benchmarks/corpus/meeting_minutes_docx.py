@@ -0,0 +1,33 @@
+from docx import Document
+from docx.shared import Pt, Inches
+from docx.enum.text import WD_LINE_SPACING
+
+doc = Document()
+style = doc.styles['Normal']
+style.font.name = 'Times New Roman'
+style.font.size = Pt(13)
+section = doc.sections[0]
+section.left_margin = Inches(1)
+section.right_margin = Inches(1)
+section.top_margin = Inches(1)
+section.bottom_margin = Inches(1)
+paragraph_format = style.paragraph_format
+paragraph_format.line_spacing_rule = WD_LINE_SPACING.ONE_POINT_FIVE
+
+doc.add_heading('Meeting Minutes', level=1)
+doc.add_paragraph('Meeting Date: 2024-01-26')
+doc.add_heading('Attendees', level=2)
+for name in ['John Doe', 'Jane Smith', 'Alex Johnson']:
+    doc.add_paragraph(name, style='List Bullet')
+doc.add_heading('Agenda Items', level=2)
+for item in ['Project Status Update', 'Budget Review', 'Next Steps']:
+    doc.add_paragraph(item, style='List Number')
+doc.add_heading('Action Items', level=2)
+table = doc.add_table(rows=4, cols=3)
+table.style = 'Table Grid'
+rows = [('Task', 'Owner', 'Due'), ('Finalize budget', 'Jane Smith', '2024-02-02'),
+        ('Update roadmap', 'John Doe', '2024-02-05'), ('Schedule review', 'Alex Johnson', '2024-02-09')]
+for row_index, values in enumerate(rows):
+    for col_index, value in enumerate(values):
+        table.cell(row_index, col_index).text = value
+doc.save('output.docx')
@@ -0,0 +1,26 @@
+from pptx import Presentation
+from pptx.util import Pt
+
+prs = Presentation()
+title_slide = prs.slides.add_slide(prs.slide_layouts[0])
+title_slide.shapes.title.text = 'Project Proposal'
+title_slide.placeholders[1].text = 'Prepared by John Doe'
+
+sections = [
+    ('Key Objectives', ['Increase market share by 15%', 'Improve customer satisfaction', 'Reduce operational costs']),
+    ('Timeline', ['Q1: Discovery and planning', 'Q2: Pilot rollout', 'Q3: Full deployment']),
+    ('Budget', ['Personnel: $120,000', 'Tooling: $30,000', 'Contingency: $15,000']),
+]
+for heading, bullets in sections:
+    slide = prs.slides.add_slide(prs.slide_layouts[1])
+    title = slide.shapes.title
+    title.text = heading
+    title.text_frame.paragraphs[0].font.size = Pt(30)
+    body = slide.placeholders[1].text_frame
+    body.text = bullets[0]
+    body.paragraphs[0].font.size = Pt(20)
+    for bullet in bullets[1:]:
+        paragraph = body.add_paragraph()
+        paragraph.text = bullet
+        paragraph.font.size = Pt(20)
+prs.save('output.pptx')
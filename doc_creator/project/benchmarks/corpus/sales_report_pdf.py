@@ -0,0 +1,32 @@
+from reportlab.lib.pagesizes import letter
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.lib.units import inch
+from reportlab.lib import colors
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, ListFlowable, ListItem
+
+styles = getSampleStyleSheet()
+custom_style = ParagraphStyle('Custom', parent=styles['Normal'], fontName='Times-Roman', fontSize=13, leading=19.5)
+doc = SimpleDocTemplate('output.pdf', pagesize=letter, leftMargin=inch, rightMargin=inch, topMargin=inch, bottomMargin=inch)
+
+story = []
+story.append(Paragraph('Monthly Sales Report', styles['Title']))
+story.append(Paragraph('Date: 2024-01-26', custom_style))
+story.append(Spacer(1, 12))
+data = [['Product', 'Units', 'Revenue'], ['Product A', '200', '$10,000'], ['Product B', '300', '$15,000'], ['Product C', '160', '$8,000']]
+table = Table(data)
+table.setStyle(TableStyle([
+    ('FONTNAME', (0, 0), (-1, -1), 'Times-Roman'),
+    ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
+    ('BACKGROUND', (0, 0), (-1, 0), colors.lightgrey),
+]))
+story.append(table)
+story.append(Spacer(1, 12))
+highlights = ListFlowable(
+    [
+        ListItem(Paragraph('Product B led revenue for the third month in a row', custom_style)),
+        ListItem(Paragraph('Product C units grew 12% month over month', custom_style)),
+    ],
+    bulletType='1'
+)
+story.append(highlights)
+doc.build(story)
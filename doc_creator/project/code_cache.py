@@ -0,0 +1,155 @@
+"""
+Persistent, content-addressed cache of AI-generated document code.
+
+Entries are keyed by a SHA-256 over the model name, the system prompt and the
+normalized user prompt, so changing either the model or SYSTEM_PROMPT naturally
+invalidates everything generated under the old configuration. Storage is a small
+SQLite database with TTL expiry and least-recently-used eviction bounded both by
+entry count and by total code bytes.
+
+Entries may also record the normalized prompt and a namespace (model and system
+prompt) they were generated for, so a near-duplicate index (prompt_index.py) can be
+rebuilt from the most recently used entries when a process starts.
+"""
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+
+def make_cache_key(normalized_prompt, model_name, system_prompt):
+    """Content address of a generation request."""
+    digest = hashlib.sha256()
+    for part in (model_name, system_prompt, normalized_prompt):
+        data = (part or '').encode('utf-8')
+        # Length-prefix every part so ('ab', 'c') and ('a', 'bc') never collide
+        digest.update(len(data).to_bytes(8, 'big'))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+class CodeCache:
+    """
+    SQLite-backed code cache with TTL + LRU eviction and hit/miss counters.
+    Safe to share between threads of one process; separate processes may share the file.
+    """
+
+    def __init__(self, path, ttl=7 * 24 * 3600, max_entries=5000, max_bytes=64 * 1024 * 1024, logger=None):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.logger = logger or logging.getLogger(__name__)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        with self._lock, self._db:
+            # auto_vacuum only takes effect on a fresh database; lets evictions actually shrink the file
+            self._db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            self._db.execute("PRAGMA journal_mode = WAL")
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS code_cache (
+                    key TEXT PRIMARY KEY,
+                    code TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used REAL NOT NULL,
+                    prompt TEXT,
+                    namespace TEXT
+                )
+            """)
+            # Databases created before prompts were recorded get the columns added (NULL for old entries)
+            columns = {row[1] for row in self._db.execute("PRAGMA table_info(code_cache)")}
+            for column in ('prompt', 'namespace'):
+                if column not in columns:
+                    self._db.execute(f"ALTER TABLE code_cache ADD COLUMN {column} TEXT")
+            self._db.execute("CREATE INDEX IF NOT EXISTS idx_code_cache_last_used ON code_cache (last_used)")
+
+    def get(self, key):
+        """Returns the cached code for `key`, or None on a miss or expired entry."""
+        now = time.time()
+        with self._lock, self._db:
+            row = self._db.execute("SELECT code, created_at FROM code_cache WHERE key = ?", (key,)).fetchone()
+            if row is not None and now - row[1] > self.ttl:
+                self._db.execute("DELETE FROM code_cache WHERE key = ?", (key,))
+                self.evictions += 1
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE code_cache SET last_used = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, code, prompt=None, namespace=None):
+        """
+        Stores `code` under `key` (with the normalized prompt and namespace it answers, if given)
+        and evicts expired / least recently used entries beyond the limits.
+        """
+        size = len(code.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO code_cache (key, code, size, created_at, last_used, prompt, namespace)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, code, size, now, now, prompt, namespace),
+            )
+            self._evict(now)
+
+    def discard(self, key):
+        """Drops an entry, e.g. when cached code stopped producing a document."""
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM code_cache WHERE key = ?", (key,))
+
+    def recent_prompts(self, limit):
+        """(namespace, prompt, key) of up to `limit` live entries that recorded their prompt, most recently used first."""
+        with self._lock:
+            return self._db.execute(
+                "SELECT namespace, prompt, key FROM code_cache WHERE prompt IS NOT NULL AND created_at >= ?"
+                " ORDER BY last_used DESC LIMIT ?",
+                (time.time() - self.ttl, limit),
+            ).fetchall()
+
+    def _evict(self, now):
+        # Caller holds the lock and an open transaction
+        removed = self._db.execute("DELETE FROM code_cache WHERE created_at < ?", (now - self.ttl,)).rowcount
+        count, total = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM code_cache").fetchone()
+        if count > self.max_entries or total > self.max_bytes:
+            # Walk from the least recently used end until both limits hold again
+            victims = []
+            for key, size in self._db.execute("SELECT key, size FROM code_cache ORDER BY last_used ASC"):
+                if count <= self.max_entries and total <= self.max_bytes:
+                    break
+                victims.append((key,))
+                count -= 1
+                total -= size
+            self._db.executemany("DELETE FROM code_cache WHERE key = ?", victims)
+            removed += len(victims)
+        if removed:
+            self.evictions += removed
+            self._db.execute("PRAGMA incremental_vacuum")
+
+    def stats(self):
+        with self._lock:
+            count, total = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM code_cache").fetchone()
+            lookups = self.hits + self.misses
+            return {
+                'entries': count,
+                'bytes': total,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+    def close(self):
+        with self._lock:
+            self._db.close()
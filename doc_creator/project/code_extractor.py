@@ -0,0 +1,100 @@
+"""
+Extraction of Python code from model responses, incrementally as chunks stream in.
+
+The model usually wraps the script in a ```python fenced block and often appends a
+long explanation after it. `StreamingCodeExtractor` watches the streamed text for the
+opening and closing fences so the caller can stop reading (and stop paying for
+tokens) as soon as the code block is complete. Extraction semantics are exactly the
+ones of the original regex; responses without a fenced block fall back to the raw
+text with full-line comments stripped.
+"""
+import re
+
+FENCE = '```'
+CODE_BLOCK_RE = re.compile(r"```(?:python)?\s*([\s\S]+?)\s*```", re.IGNORECASE)
+_LEADING_WHITESPACE = re.compile(r"\s*")
+
+
+def strip_comment_lines(text):
+    """Fallback when no fenced block is present: assume the whole response is code."""
+    return '\n'.join(line for line in text.split('\n') if not line.strip().startswith('#')).strip()
+
+
+def extract_code(text):
+    """Returns (code, from_fenced_block) for a complete response text."""
+    match = CODE_BLOCK_RE.search(text)
+    if match:
+        return match.group(1).strip(), True
+    return strip_comment_lines(text), False
+
+
+class StreamingCodeExtractor:
+    """
+    Accumulates streamed text and reports when the first fenced code block has closed.
+
+    Fences are found by scanning only the newly appended text (resuming two characters
+    early to catch a fence split across chunks), so the total work stays linear in the
+    response length.
+    """
+
+    def __init__(self):
+        self._buffer = ''
+        self._scan_pos = 0
+        self._open = -1 # Index of the opening fence
+        self._code = None
+
+    @property
+    def complete(self):
+        """True once the first fenced code block has been fully received."""
+        return self._code is not None
+
+    @property
+    def text(self):
+        return self._buffer
+
+    def feed(self, chunk):
+        """Adds a chunk of streamed text. Returns True once the code block is complete."""
+        if self._code is not None or not chunk:
+            return self._code is not None
+        self._buffer += chunk
+
+        if self._open < 0:
+            index = self._buffer.find(FENCE, self._scan_pos)
+            if index < 0:
+                # Resume just before the end next time: a fence may be split across chunks
+                self._scan_pos = max(0, len(self._buffer) - len(FENCE) + 1)
+                return False
+            self._open = index
+            self._scan_pos = index + len(FENCE)
+
+        self._code = self._closed_block()
+        return self._code is not None
+
+    def _closed_block(self):
+        """
+        Follows the regex's preferred match from the opening fence: greedy 'python' tag and
+        whitespace, then the shortest body up to the next fence. If that path already matches
+        on the text received so far, more text cannot change the regex's answer. (Other paths
+        only win when the body would start right at a fence; those responses fall back to
+        the full-text regex in result().)
+        """
+        buffer = self._buffer
+        start = self._open + len(FENCE)
+        if len(buffer) < start + len('python'):
+            return None # Cannot tell yet whether a language tag follows
+        if buffer[start:start + len('python')].lower() == 'python':
+            start += len('python')
+        start = _LEADING_WHITESPACE.match(buffer, start).end()
+        if start >= len(buffer):
+            return None # The whitespace run may continue in the next chunk
+        close = buffer.find(FENCE, max(start + 1, self._scan_pos))
+        if close < 0:
+            self._scan_pos = max(start + 1, len(buffer) - len(FENCE) + 1)
+            return None
+        return buffer[start:close].strip()
+
+    def result(self):
+        """Returns (code, from_fenced_block) for everything received so far."""
+        if self._code is not None:
+            return self._code, True
+        return extract_code(self._buffer)
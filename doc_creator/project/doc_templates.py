@@ -0,0 +1,196 @@
+"""
+Parameterized document templates rendered in-process (no model call, no script execution).
+
+The shapes are the ones hard-coded in create_file.py (meeting minutes as .docx, a
+project proposal as .pptx, a sales report as .pdf). Each template builds a document
+tree that document_ir.py renders, styled like the model is told to in SYSTEM_PROMPT.
+A request supplies structured JSON `content`; every field is optional and falls
+back to a default, and wrong types are rejected with `TemplateError`. `classify()` picks a template from the prompt and content keys with
+a few precompiled keyword patterns, so clients do not have to name one.
+"""
+import re
+import datetime
+import document_ir
+
+MAX_LIST_ITEMS = 500
+MAX_TEXT_LENGTH = 10000
+
+
+class TemplateError(ValueError):
+    """The supplied content does not fit the template (client error)."""
+
+
+# --- Content schema ---
+
+def _text(name, value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        value = str(value)
+    if not isinstance(value, str):
+        raise TemplateError(f"'{name}' must be a string")
+    if len(value) > MAX_TEXT_LENGTH:
+        raise TemplateError(f"'{name}' is longer than {MAX_TEXT_LENGTH} characters")
+    return value.strip()
+
+
+def _list(name, value):
+    if not isinstance(value, list):
+        raise TemplateError(f"'{name}' must be a list")
+    if len(value) > MAX_LIST_ITEMS:
+        raise TemplateError(f"'{name}' has more than {MAX_LIST_ITEMS} items")
+    return value
+
+
+def _text_list(name, value):
+    return [_text(f"{name}[{i}]", item) for i, item in enumerate(_list(name, value))]
+
+
+def _records(keys):
+    """List of objects with the given text keys (missing keys become empty strings)."""
+    def coerce(name, value):
+        records = []
+        for i, item in enumerate(_list(name, value)):
+            if not isinstance(item, dict):
+                raise TemplateError(f"'{name}[{i}]' must be an object with keys {', '.join(keys)}")
+            records.append({key: _text(f"{name}[{i}].{key}", item.get(key, '')) for key in keys})
+        return records
+    return coerce
+
+
+def _sections(name, value):
+    sections = []
+    for i, item in enumerate(_list(name, value)):
+        if not isinstance(item, dict):
+            raise TemplateError(f"'{name}[{i}]' must be an object with 'heading' and 'bullets'")
+        sections.append({
+            'heading': _text(f"{name}[{i}].heading", item.get('heading', '')),
+            'bullets': _text_list(f"{name}[{i}].bullets", item.get('bullets', [])),
+        })
+    return sections
+
+
+def _today():
+    return datetime.date.today().isoformat()
+
+
+class Template:
+    def __init__(self, name, extension, fields, keywords, build):
+        self.name = name
+        self.extension = extension
+        self.fields = fields # field -> (coerce, default or zero-arg callable)
+        self.build = build # filled content -> document tree (document_ir.py)
+        # Multi-word phrases count double: "meeting minutes" is stronger evidence than "minutes"
+        self.keyword_weights = [
+            (re.compile(r'\b' + re.escape(keyword) + r'\b'), 2 if ' ' in keyword else 1) for keyword in keywords
+        ]
+
+    @property
+    def output_filename(self):
+        return f"output.{self.extension}"
+
+    def fill(self, content):
+        """Validates `content` against the fields and fills in defaults."""
+        if not isinstance(content, dict):
+            raise TemplateError("'content' must be a JSON object")
+        unknown = sorted(set(content) - set(self.fields))
+        if unknown:
+            raise TemplateError(f"Unknown field(s) for template '{self.name}': {', '.join(unknown)}")
+        filled = {}
+        for field, (coerce, default) in self.fields.items():
+            if content.get(field) is None:
+                filled[field] = default() if callable(default) else default
+            else:
+                filled[field] = coerce(field, content[field])
+        return filled
+
+    def score(self, normalized_prompt, content_keys):
+        score = sum(weight for pattern, weight in self.keyword_weights if pattern.search(normalized_prompt))
+        return score + len(content_keys & set(self.fields))
+
+
+# --- Builders (same structure as create_file.py; rendering and styling live in document_ir.py) ---
+
+def _build_meeting_minutes(data):
+    blocks = [{'type': 'paragraph', 'text': f"Meeting Date: {data['date']}"}]
+    for heading, items, ordered in (('Attendees', data['attendees'], False),
+                                    ('Agenda Items', data['agenda'], True),
+                                    ('Notes', data['notes'], False)):
+        if items:
+            blocks += [{'type': 'heading', 'text': heading, 'level': 2},
+                       {'type': 'bullets', 'items': items, 'ordered': ordered}]
+    if data['action_items']:
+        rows = [['Task', 'Owner', 'Due']] + [[item['task'], item['owner'], item['due']] for item in data['action_items']]
+        blocks += [{'type': 'heading', 'text': 'Action Items', 'level': 2},
+                   {'type': 'table', 'rows': rows, 'header': True}]
+    return {'format': 'docx', 'title': data['title'], 'blocks': blocks}
+
+
+def _build_project_proposal(data):
+    slides = [{'title': section['heading'], 'blocks': [{'type': 'bullets', 'items': section['bullets']}]}
+              for section in data['sections']]
+    return {'format': 'pptx', 'title': data['title'], 'subtitle': data['subtitle'], 'slides': slides}
+
+
+def _build_sales_report(data):
+    blocks = [{'type': 'paragraph', 'text': f"Date: {data['date']}"}]
+    if data['figures']:
+        rows = [['Item', 'Value']] + [[figure['label'], figure['value']] for figure in data['figures']]
+        blocks.append({'type': 'table', 'rows': rows, 'header': True})
+    if data['highlights']:
+        blocks.append({'type': 'bullets', 'items': data['highlights']})
+    return {'format': 'pdf', 'title': data['title'], 'blocks': blocks}
+
+
+TEMPLATES = {template.name: template for template in (
+    Template('meeting_minutes', 'docx', {
+        'title': (_text, 'Meeting Minutes'),
+        'date': (_text, _today),
+        'attendees': (_text_list, []),
+        'agenda': (_text_list, []),
+        'notes': (_text_list, []),
+        'action_items': (_records(('task', 'owner', 'due')), []),
+    }, ('meeting minutes', 'minutes', 'meeting notes', 'agenda', 'attendees', 'action items'), _build_meeting_minutes),
+    Template('project_proposal', 'pptx', {
+        'title': (_text, 'Project Proposal'),
+        'subtitle': (_text, ''),
+        'sections': (_sections, []),
+    }, ('project proposal', 'proposal', 'pitch deck', 'objectives', 'slides'), _build_project_proposal),
+    Template('sales_report', 'pdf', {
+        'title': (_text, 'Sales Report'),
+        'date': (_text, _today),
+        'figures': (_records(('label', 'value')), []),
+        'highlights': (_text_list, []),
+    }, ('sales report', 'sales', 'revenue', 'sales figures'), _build_sales_report),
+)}
+
+MIN_CLASSIFIER_SCORE = 2
+
+
+def classify(prompt, content):
+    """
+    Returns the name of the template `prompt`/`content` clearly ask for, or None.
+    A template must score at least MIN_CLASSIFIER_SCORE and beat the runner-up.
+    """
+    normalized = (prompt or '').lower()
+    keys = set(content) if isinstance(content, dict) else set()
+    scored = sorted(((template.score(normalized, keys), name) for name, template in TEMPLATES.items()), reverse=True)
+    best_score, best_name = scored[0]
+    runner_up = scored[1][0] if len(scored) > 1 else 0
+    if best_score >= MIN_CLASSIFIER_SCORE and best_score > runner_up:
+        return best_name
+    return None
+
+
+def build(name, content):
+    """Returns the document tree (document_ir.py) of template `name` filled with `content`. Raises TemplateError for bad content."""
+    template = TEMPLATES.get(name)
+    if template is None:
+        raise TemplateError(f"Unknown template '{name}' (available: {', '.join(sorted(TEMPLATES))})")
+    try:
+        return document_ir.validate(template.build(template.fill(content)))
+    except document_ir.IRError as e:
+        raise TemplateError(str(e))
+
+
+def render(name, content, path):
+    """Renders template `name` filled with `content` to `path`. Raises TemplateError for bad content."""
+    document_ir.render(build(name, content), path)
@@ -0,0 +1,345 @@
+"""
+Document IR: a compact JSON document tree and trusted in-process renderers for it.
+
+In IR mode the model answers with this tree instead of a Python script, so there is
+no interpreter to spawn, no AST validation and no sandbox on the hot path; the
+renderers below are the only code that touches python-docx / python-pptx / reportlab.
+The templates in doc_templates.py build the same tree.
+
+    {
+      "format": "docx" | "pptx" | "pdf",
+      "title": "Optional document title",
+      "subtitle": "Optional (title slide of a pptx)",
+      "blocks": [...],                                  (docx / pdf)
+      "slides": [{"title": "...", "blocks": [...]}]     (pptx)
+    }
+
+Blocks:
+    {"type": "heading", "text": "...", "level": 1-3}
+    {"type": "paragraph", "text": "...", "bold": false}
+    {"type": "bullets", "items": ["..."], "ordered": false}
+    {"type": "table", "rows": [["..."]], "header": true}
+    {"type": "page_break"}                            (docx / pdf only)
+
+`validate()` checks the tree against this schema and against size limits (a model
+asking for a million-row table must not tie up a request thread), raising `IRError`.
+"""
+import json
+
+FORMATS = ('docx', 'pptx', 'pdf')
+BLOCK_TYPES = ('heading', 'paragraph', 'bullets', 'table', 'page_break')
+
+MAX_BLOCKS = 2000
+MAX_SLIDES = 200
+MAX_LIST_ITEMS = 500
+MAX_TABLE_ROWS = 500
+MAX_TABLE_COLUMNS = 20
+MAX_TEXT_LENGTH = 10000
+
+# Formatting required by SYSTEM_PROMPT for generated scripts; IR documents look the same
+FONT_NAME = 'Times New Roman'
+PDF_FONT_NAME = 'Times-Roman'
+BODY_FONT_SIZE = 13
+SLIDE_TITLE_FONT_SIZE = 30
+SLIDE_BODY_FONT_SIZE = 20
+
+IR_SYSTEM_PROMPT = """You are a helpful assistant that writes the content of documents as a JSON document tree.
+
+Analyze the user's request, choose the document type (Word "docx", PowerPoint "pptx" or PDF "pdf")
+and answer with ONE JSON object and nothing else (no explanations before or after it):
+
+{
+  "format": "docx" | "pptx" | "pdf",
+  "title": "Document title",
+  "subtitle": "Optional subtitle (pptx title slide)",
+  "blocks": [ ...blocks... ],
+  "slides": [ {"title": "Slide title", "blocks": [ ...blocks... ]} ]
+}
+
+Use "blocks" for docx and pdf, "slides" for pptx. Block types:
+  {"type": "heading", "text": "...", "level": 1}          (level 1-3)
+  {"type": "paragraph", "text": "...", "bold": false}
+  {"type": "bullets", "items": ["...", "..."], "ordered": false}
+  {"type": "table", "rows": [["Header", "..."], ["...", "..."]], "header": true}
+  {"type": "page_break"}                                    (docx and pdf only)
+
+Rules:
+- Plain text only inside strings: no markdown, no HTML.
+- Write complete, professional content; do not leave placeholders.
+- Fonts, sizes, margins and spacing are applied by the renderer; do not describe formatting.
+"""
+
+
+class IRError(ValueError):
+    """The document tree does not match the schema or exceeds a size limit."""
+
+
+# --- Parsing and validation ---
+
+def parse(text):
+    """Parses the model's answer (bare JSON, or the body of a ```json block) into a validated tree."""
+    text = (text or '').strip()
+    if text[:4].lower() == 'json':
+        text = text[4:] # Language tag left over from the fence
+    try:
+        document = json.loads(text)
+    except ValueError as e:
+        raise IRError(f"Not valid JSON: {e}")
+    return validate(document)
+
+
+def _text(path, value, required=True):
+    if value is None and not required:
+        return ''
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        value = str(value)
+    if not isinstance(value, str):
+        raise IRError(f"{path} must be a string")
+    if len(value) > MAX_TEXT_LENGTH:
+        raise IRError(f"{path} is longer than {MAX_TEXT_LENGTH} characters")
+    return value
+
+
+def _list(path, value, limit):
+    if not isinstance(value, list):
+        raise IRError(f"{path} must be a list")
+    if len(value) > limit:
+        raise IRError(f"{path} has more than {limit} entries")
+    return value
+
+
+def _block(path, block, fmt):
+    if not isinstance(block, dict):
+        raise IRError(f"{path} must be an object")
+    kind = block.get('type')
+    if kind not in BLOCK_TYPES:
+        raise IRError(f"{path}.type must be one of {', '.join(BLOCK_TYPES)}")
+    if kind == 'heading':
+        level = block.get('level', 1)
+        if not isinstance(level, int) or isinstance(level, bool) or not 1 <= level <= 3:
+            raise IRError(f"{path}.level must be 1, 2 or 3")
+        return {'type': kind, 'text': _text(f"{path}.text", block.get('text')), 'level': level}
+    if kind == 'paragraph':
+        return {'type': kind, 'text': _text(f"{path}.text", block.get('text')), 'bold': bool(block.get('bold', False))}
+    if kind == 'bullets':
+        items = _list(f"{path}.items", block.get('items'), MAX_LIST_ITEMS)
+        return {'type': kind, 'items': [_text(f"{path}.items[{i}]", item) for i, item in enumerate(items)],
+                'ordered': bool(block.get('ordered', False))}
+    if kind == 'table':
+        rows = _list(f"{path}.rows", block.get('rows'), MAX_TABLE_ROWS)
+        if not rows:
+            raise IRError(f"{path}.rows must not be empty")
+        checked = []
+        for r, row in enumerate(rows):
+            row = _list(f"{path}.rows[{r}]", row, MAX_TABLE_COLUMNS)
+            checked.append([_text(f"{path}.rows[{r}][{c}]", cell, required=False) for c, cell in enumerate(row)])
+        width = max(len(row) for row in checked)
+        if not width:
+            raise IRError(f"{path}.rows must have at least one column")
+        # Ragged rows are padded so every renderer gets a rectangular grid
+        return {'type': kind, 'rows': [row + [''] * (width - len(row)) for row in checked],
+                'header': bool(block.get('header', True))}
+    if fmt == 'pptx':
+        raise IRError(f"{path}: page_break is not supported in pptx")
+    return {'type': kind}
+
+
+def validate(document):
+    """Returns a normalized copy of `document` (defaults filled in). Raises IRError if it is not a valid tree."""
+    if not isinstance(document, dict):
+        raise IRError("The document must be a JSON object")
+    fmt = document.get('format')
+    if fmt not in FORMATS:
+        raise IRError(f"format must be one of {', '.join(FORMATS)}")
+    normalized = {
+        'format': fmt,
+        'title': _text('title', document.get('title'), required=False),
+        'subtitle': _text('subtitle', document.get('subtitle'), required=False),
+    }
+    if fmt == 'pptx':
+        slides = _list('slides', document.get('slides', []), MAX_SLIDES)
+        normalized['slides'] = []
+        for s, slide in enumerate(slides):
+            if not isinstance(slide, dict):
+                raise IRError(f"slides[{s}] must be an object")
+            blocks = _list(f"slides[{s}].blocks", slide.get('blocks', []), MAX_BLOCKS)
+            normalized['slides'].append({
+                'title': _text(f"slides[{s}].title", slide.get('title'), required=False),
+                'blocks': [_block(f"slides[{s}].blocks[{b}]", block, fmt) for b, block in enumerate(blocks)],
+            })
+        if not normalized['slides'] and not normalized['title']:
+            raise IRError("A pptx document needs a title or at least one slide")
+    else:
+        blocks = _list('blocks', document.get('blocks', []), MAX_BLOCKS)
+        normalized['blocks'] = [_block(f"blocks[{b}]", block, fmt) for b, block in enumerate(blocks)]
+        if not normalized['blocks'] and not normalized['title']:
+            raise IRError("The document needs a title or at least one block")
+    return normalized
+
+
+def output_filename(document):
+    return f"output.{document['format']}"
+
+
+# --- Renderers ---
+
+def _render_docx(document, path):
+    from docx import Document
+    from docx.shared import Pt, Inches
+    from docx.enum.text import WD_LINE_SPACING, WD_BREAK
+
+    doc = Document()
+    style = doc.styles['Normal']
+    style.font.name = FONT_NAME
+    style.font.size = Pt(BODY_FONT_SIZE)
+    style.paragraph_format.line_spacing_rule = WD_LINE_SPACING.ONE_POINT_FIVE
+    for section in doc.sections:
+        section.left_margin = section.right_margin = Inches(1)
+        section.top_margin = section.bottom_margin = Inches(1)
+
+    if document['title']:
+        doc.add_heading(document['title'], level=0)
+    if document['subtitle']:
+        doc.add_paragraph(document['subtitle'])
+    for block in document['blocks']:
+        kind = block['type']
+        if kind == 'heading':
+            doc.add_heading(block['text'], level=block['level'])
+        elif kind == 'paragraph':
+            paragraph = doc.add_paragraph()
+            run = paragraph.add_run(block['text'])
+            run.bold = block['bold']
+        elif kind == 'bullets':
+            list_style = 'List Number' if block['ordered'] else 'List Bullet'
+            for item in block['items']:
+                doc.add_paragraph(item, style=list_style)
+        elif kind == 'table':
+            rows = block['rows']
+            table = doc.add_table(rows=len(rows), cols=len(rows[0]))
+            table.style = 'Table Grid'
+            for r, row in enumerate(rows):
+                for c, value in enumerate(row):
+                    cell = table.cell(r, c)
+                    cell.text = value
+                    if block['header'] and r == 0:
+                        for run in cell.paragraphs[0].runs:
+                            run.bold = True
+        else:
+            paragraph = doc.add_paragraph()
+            paragraph.add_run().add_break(WD_BREAK.PAGE)
+    doc.save(path)
+
+
+def _render_pptx(document, path):
+    from pptx import Presentation
+    from pptx.util import Pt, Inches
+
+    prs = Presentation()
+
+    def style_text(text_frame, size):
+        for paragraph in text_frame.paragraphs:
+            paragraph.font.name = FONT_NAME
+            paragraph.font.size = Pt(size)
+
+    if document['title']:
+        slide = prs.slides.add_slide(prs.slide_layouts[0])
+        slide.shapes.title.text = document['title']
+        style_text(slide.shapes.title.text_frame, SLIDE_TITLE_FONT_SIZE)
+        slide.placeholders[1].text = document['subtitle']
+        style_text(slide.placeholders[1].text_frame, SLIDE_BODY_FONT_SIZE)
+
+    for spec in document['slides']:
+        slide = prs.slides.add_slide(prs.slide_layouts[1]) # Title and content
+        slide.shapes.title.text = spec['title']
+        style_text(slide.shapes.title.text_frame, SLIDE_TITLE_FONT_SIZE)
+        body = slide.placeholders[1]
+        text_frame = body.text_frame
+        first = True
+        tables = []
+        for block in spec['blocks']:
+            if block['type'] == 'table':
+                tables.append(block)
+                continue
+            lines = block['items'] if block['type'] == 'bullets' else [block['text']]
+            for line in lines:
+                paragraph = text_frame.paragraphs[0] if first else text_frame.add_paragraph()
+                paragraph.text = line
+                paragraph.font.bold = block['type'] == 'heading' or block.get('bold', False)
+                first = False
+        style_text(text_frame, SLIDE_BODY_FONT_SIZE)
+        if first:
+            # No text: drop the empty placeholder so tables get the whole slide
+            body._element.getparent().remove(body._element)
+        # Tables are stacked below the body placeholder area
+        top = Inches(1.6) if first else Inches(4.2)
+        for block in tables:
+            rows = block['rows']
+            height = Inches(0.4) * len(rows)
+            shape = slide.shapes.add_table(len(rows), len(rows[0]), Inches(0.5), top, prs.slide_width - Inches(1), height)
+            for r, row in enumerate(rows):
+                for c, value in enumerate(row):
+                    cell = shape.table.cell(r, c)
+                    cell.text = value
+                    style_text(cell.text_frame, BODY_FONT_SIZE)
+            top += height + Inches(0.2)
+    prs.save(path)
+
+
+def _render_pdf(document, path):
+    from reportlab.lib import colors
+    from reportlab.lib.units import inch
+    from reportlab.lib.pagesizes import letter
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+    from reportlab.platypus import (SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle,
+                                    ListFlowable, ListItem, PageBreak)
+    from xml.sax.saxutils import escape
+
+    styles = getSampleStyleSheet()
+    body = ParagraphStyle('IRBody', parent=styles['Normal'], fontName=PDF_FONT_NAME,
+                          fontSize=BODY_FONT_SIZE, leading=BODY_FONT_SIZE * 1.5)
+    bold = ParagraphStyle('IRBold', parent=body, fontName='Times-Bold')
+    headings = {level: ParagraphStyle(f'IRHeading{level}', parent=styles[f'Heading{level}'], fontName='Times-Bold')
+                for level in (1, 2, 3)}
+    title = ParagraphStyle('IRTitle', parent=styles['Title'], fontName='Times-Bold')
+
+    def paragraph(text, style):
+        # Model text is plain: escape it so '<' or '&' cannot break reportlab's markup parser
+        return Paragraph(escape(text).replace('\n', '<br/>'), style)
+
+    story = []
+    if document['title']:
+        story.append(paragraph(document['title'], title))
+    if document['subtitle']:
+        story.append(paragraph(document['subtitle'], body))
+    for block in document['blocks']:
+        kind = block['type']
+        if kind == 'heading':
+            story.append(paragraph(block['text'], headings[block['level']]))
+        elif kind == 'paragraph':
+            story.append(paragraph(block['text'], bold if block['bold'] else body))
+        elif kind == 'bullets':
+            story.append(ListFlowable([ListItem(paragraph(item, body)) for item in block['items']],
+                                      bulletType='1' if block['ordered'] else 'bullet'))
+        elif kind == 'table':
+            table = Table([[paragraph(value, body) for value in row] for row in block['rows']], repeatRows=1 if block['header'] else 0)
+            commands = [('GRID', (0, 0), (-1, -1), 0.5, colors.grey), ('VALIGN', (0, 0), (-1, -1), 'TOP')]
+            if block['header']:
+                commands.append(('BACKGROUND', (0, 0), (-1, 0), colors.lightgrey))
+            table.setStyle(TableStyle(commands))
+            story.append(table)
+        else:
+            story.append(PageBreak())
+            continue
+        story.append(Spacer(1, 6))
+
+    doc = SimpleDocTemplate(path, pagesize=letter, leftMargin=inch, rightMargin=inch, topMargin=inch, bottomMargin=inch,
+                            title=document['title'])
+    doc.build(story)
+
+
+_RENDERERS = {'docx': _render_docx, 'pptx': _render_pptx, 'pdf': _render_pdf}
+
+
+def render(document, path):
+    """Renders a validated tree (see validate) to `path`."""
+    _RENDERERS[document['format']](document, path)
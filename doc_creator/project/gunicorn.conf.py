@@ -0,0 +1,24 @@
+"""
+Gunicorn settings (from doc_creator/project: `gunicorn -c gunicorn.conf.py`).
+
+The master imports server.py and preloads the heavy libraries (google.generativeai,
+python-docx, python-pptx, reportlab) once. Workers are forked from it and share those
+pages copy-on-write, so starting or restarting a worker costs a fork plus the per-process
+setup in create_app(), not a fresh import of everything. Clients, pools and background
+threads are never created in the master: each worker creates its own on first use.
+"""
+import os
+
+wsgi_app = 'server:create_app()'
+preload_app = True
+bind = f"{os.getenv('FLASK_RUN_HOST', '0.0.0.0')}:{os.getenv('PORT', 5000)}"
+workers = int(os.getenv('WEB_CONCURRENCY', 2))
+worker_class = 'gthread' # Requests mostly wait on the model; threads share the worker's clients
+threads = int(os.getenv('GUNICORN_THREADS', 8))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 200)) # Above LLM_DEADLINE + EXECUTION_TIMEOUT_MAX
+
+
+def post_fork(server, worker):
+    import server as app_module
+    app_module.create_app() # Restarts the log listener thread in this process (threads do not survive fork)
+    app_module.warm_up()
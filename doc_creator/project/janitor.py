@@ -0,0 +1,246 @@
+"""
+Background garbage collector for generated session directories.
+
+Every successful generation registers its session directory in a small SQLite index
+(size, creation time, last download). A janitor thread periodically removes sessions
+older than the TTL and, when the total size exceeds the quota, evicts the least
+recently downloaded sessions first. Passes work from the index alone; the directory
+tree is only scanned once to adopt sessions that existed before the index did. That scan
+runs on the janitor thread before its first pass, and only in the one process (of all
+those sharing the index) that claims it in the index's meta table.
+
+Sizes (for the quota and `bytes_freed`) count only the files a session owns: a file
+hard-linked from the artifact cache (st_nlink > 1) frees nothing when the session is
+deleted. A session is sized when it is registered, so if the cache later evicts its copy,
+the session's file is under-counted for the quota. `bytes_freed` is measured on disk just
+before each deletion.
+"""
+import os
+import time
+import uuid
+import shutil
+import sqlite3
+import logging
+import threading
+
+# Directories younger than this are never adopted by a scan: they may still be in the middle of a generation
+SCAN_MIN_AGE = 300
+# A claimed scan that has not finished after this long is assumed dead (its process exited) and may be retaken
+SCAN_CLAIM_TIMEOUT = 3600
+
+
+def owned_bytes(path):
+    """Size of the files under `path` that are not hard-linked elsewhere (deleting them frees this much)."""
+    total = 0
+    for dirpath, _dirnames, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                st = os.stat(os.path.join(dirpath, name))
+            except OSError:
+                continue
+            if st.st_nlink == 1:
+                total += st.st_size
+    return total
+
+
+def _is_session_name(name):
+    try:
+        uuid.UUID(name)
+        return True
+    except ValueError:
+        return False
+
+
+class SessionJanitor:
+    """
+    Tracks session directories under `root` and deletes them by age and total (owned) size.
+
+    `ttl` (seconds) and `max_bytes` may be None/0 to disable that policy.
+    """
+
+    def __init__(self, root, index_path, ttl=24 * 3600, max_bytes=1024 * 1024 * 1024, interval=300, logger=None):
+        self.root = os.path.abspath(root)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.logger = logger or logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.counters = {
+            'passes': 0,
+            'removed_expired': 0,
+            'removed_quota': 0,
+            'bytes_freed': 0,
+            'last_pass_at': None,
+            'last_pass_seconds': None,
+        }
+
+        os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+        self._db = sqlite3.connect(index_path, check_same_thread=False, timeout=10)
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode = WAL")
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    session_id TEXT PRIMARY KEY,
+                    rel_path TEXT NOT NULL,
+                    bytes INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )
+            """)
+            self._db.execute("CREATE INDEX IF NOT EXISTS idx_sessions_created ON sessions (created_at)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS idx_sessions_last_access ON sessions (last_access)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    # --- Index maintenance ---
+
+    def register(self, session_id, rel_path, size, created_at=None):
+        """Records a finished session directory (`rel_path` is relative to the root)."""
+        now = created_at or time.time()
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO sessions (session_id, rel_path, bytes, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (str(session_id), rel_path, size, now, now),
+            )
+
+    def touch(self, session_id):
+        """Marks a session as just downloaded, moving it to the back of the eviction order."""
+        with self._lock, self._db:
+            self._db.execute("UPDATE sessions SET last_access = ? WHERE session_id = ?", (time.time(), str(session_id)))
+
+    def _claim_adoption(self):
+        """
+        Atomically claims the one-off adoption scan. The 'adopted_existing' meta row holds
+        'scanning:<claimed at>' while a scan runs and the finish time once it is done.
+        """
+        now = time.time()
+        with self._lock, self._db:
+            if self._db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('adopted_existing', ?)",
+                                (f"scanning:{now}",)).rowcount:
+                return True
+            # Retake a claim whose process died mid-scan
+            return self._db.execute(
+                "UPDATE meta SET value = ? WHERE key = 'adopted_existing' AND value LIKE 'scanning:%'"
+                " AND CAST(substr(value, 10) AS REAL) < ?",
+                (f"scanning:{now}", now - SCAN_CLAIM_TIMEOUT),
+            ).rowcount == 1
+
+    def adopt_existing(self):
+        """
+        One-off scan that indexes session directories created before the index existed.
+        Returns the number adopted, or None if the scan is done or running in another process.
+        """
+        if not self._claim_adoption():
+            return None
+        adopted = 0
+        cutoff = time.time() - SCAN_MIN_AGE
+        for dirpath, dirnames, _filenames in os.walk(self.root):
+            sessions = [name for name in dirnames if _is_session_name(name)]
+            # Never descend into session directories themselves
+            dirnames[:] = [name for name in dirnames if not _is_session_name(name) and not name.startswith('.')]
+            for name in sessions:
+                path = os.path.join(dirpath, name)
+                try:
+                    mtime = os.stat(path).st_mtime
+                except OSError:
+                    continue
+                if mtime > cutoff:
+                    continue
+                with self._lock, self._db:
+                    self._db.execute(
+                        "INSERT OR IGNORE INTO sessions (session_id, rel_path, bytes, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                        (name, os.path.relpath(path, self.root), owned_bytes(path), mtime, mtime),
+                    )
+                adopted += 1
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('adopted_existing', ?)", (str(time.time()),))
+        if adopted:
+            self.logger.info(f"Janitor adopted {adopted} existing session directories into its index.")
+        return adopted
+
+    # --- Eviction ---
+
+    def _delete(self, session_id, rel_path):
+        """Deletes a session directory and its index row. Returns the bytes actually freed on disk."""
+        freed = 0
+        path = os.path.normpath(os.path.join(self.root, rel_path))
+        if os.path.commonpath([path, self.root]) != self.root or path == self.root:
+            self.logger.error(f"Janitor refusing to delete path outside storage root: {path}")
+        else:
+            freed = owned_bytes(path)
+            shutil.rmtree(path, ignore_errors=True)
+            # Remove now-empty parent directories (e.g. shard directories), never the root itself
+            parent = os.path.dirname(path)
+            while parent != self.root and parent.startswith(self.root):
+                try:
+                    os.rmdir(parent)
+                except OSError:
+                    break
+                parent = os.path.dirname(parent)
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+        return freed
+
+    def run_once(self):
+        """Runs one collection pass. Returns the number of sessions removed."""
+        started = time.time()
+        removed = 0
+        if self.ttl:
+            with self._lock:
+                expired = self._db.execute(
+                    "SELECT session_id, rel_path, bytes FROM sessions WHERE created_at < ?", (started - self.ttl,)
+                ).fetchall()
+            for session_id, rel_path, _size in expired:
+                self.counters['bytes_freed'] += self._delete(session_id, rel_path)
+                self.counters['removed_expired'] += 1
+                removed += 1
+
+        if self.max_bytes:
+            with self._lock:
+                total = self._db.execute("SELECT COALESCE(SUM(bytes), 0) FROM sessions").fetchone()[0]
+                candidates = self._db.execute(
+                    "SELECT session_id, rel_path, bytes FROM sessions ORDER BY last_access ASC"
+                ).fetchall() if total > self.max_bytes else []
+            for session_id, rel_path, size in candidates:
+                if total <= self.max_bytes:
+                    break
+                self.counters['bytes_freed'] += self._delete(session_id, rel_path)
+                total -= size
+                self.counters['removed_quota'] += 1
+                removed += 1
+
+        self.counters['passes'] += 1
+        self.counters['last_pass_at'] = started
+        self.counters['last_pass_seconds'] = round(time.time() - started, 4)
+        if removed:
+            self.logger.info(f"Janitor removed {removed} session directories.")
+        return removed
+
+    # --- Background thread ---
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="docgen-janitor", daemon=True)
+            self._thread.start()
+
+    def _loop(self):
+        try:
+            self.adopt_existing()
+        except Exception as e:
+            self.logger.error(f"Janitor could not adopt existing sessions: {e}", exc_info=True)
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                self.logger.error(f"Janitor pass failed: {e}", exc_info=True)
+
+    def stop(self):
+        self._stop.set()
+
+    def metrics(self):
+        with self._lock:
+            sessions, total = self._db.execute("SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM sessions").fetchone()
+        data = dict(self.counters)
+        data.update({'sessions': sessions, 'bytes': total, 'quota_bytes': self.max_bytes, 'ttl_seconds': self.ttl})
+        return data
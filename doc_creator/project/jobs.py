@@ -0,0 +1,140 @@
+"""
+Bounded in-process job queue for asynchronous document generation.
+
+`POST /generate-file?async=1` submits the prompt here and returns immediately with
+a job id; a fixed number of executor threads drain the queue and run the normal
+generation pipeline. When the queue is full, `submit()` raises `JobQueueFull`
+carrying a Retry-After estimate instead of letting clients wait without limit.
+Finished jobs are kept for `result_ttl` seconds so clients can poll `GET /jobs/<id>`.
+"""
+import math
+import time
+import uuid
+import queue
+import logging
+import threading
+import contextvars
+from collections import deque
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class JobQueueFull(Exception):
+    """Raised by JobQueue.submit() when no more work can be accepted."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Job queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class Job:
+    """State of a single asynchronous generation request."""
+
+    def __init__(self, args):
+        self.id = str(uuid.uuid4())
+        self.args = args
+        self.context = contextvars.copy_context() # Submitter's context (e.g. the request id for log records)
+        self.status = QUEUED
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None      # JSON payload produced by the handler (success or error body)
+        self.status_code = None # HTTP status the synchronous route would have returned
+
+    def to_dict(self):
+        data = {
+            'job_id': self.id,
+            'status': self.status,
+            'status_url': f"/jobs/{self.id}",
+        }
+        if self.status in (DONE, FAILED) and self.result:
+            # Same fields as the synchronous response: download_url/filename or error
+            data.update(self.result)
+            data['status_code'] = self.status_code
+        return data
+
+
+class JobQueue:
+    """
+    Runs `handler(*args)` for submitted jobs on `workers` background threads.
+
+    The handler must return a `(payload, status_code)` tuple; a status below 400 marks
+    the job as done, anything else as failed. At most `max_queued` jobs may wait.
+    """
+
+    def __init__(self, handler, workers=2, max_queued=32, result_ttl=3600, logger=None):
+        self.handler = handler
+        self.workers = max(1, int(workers))
+        self.result_ttl = result_ttl
+        self.logger = logger or logging.getLogger(__name__)
+        self._queue = queue.Queue(maxsize=max(1, int(max_queued)))
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._recent_durations = deque(maxlen=50) # Used to estimate Retry-After
+        self._threads = []
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"docgen-job-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, *args):
+        """Queues a job and returns it. Raises JobQueueFull if the queue is at capacity."""
+        self._prune()
+        job = Job(args)
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            raise JobQueueFull(self._estimate_retry_after())
+        with self._lock:
+            self._jobs[job.id] = job
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            job.status = RUNNING
+            job.started_at = time.time()
+            try:
+                job.result, job.status_code = job.context.run(self.handler, *job.args)
+            except Exception as e:
+                self.logger.error(f"Job {job.id} crashed: {e}", exc_info=True)
+                job.result, job.status_code = {'error': "An unexpected error occurred during document creation"}, 500
+            job.finished_at = time.time()
+            job.args = job.context = None # Release the prompt, it is no longer needed
+            job.status = DONE if job.status_code < 400 else FAILED
+            with self._lock:
+                self._recent_durations.append(job.finished_at - job.started_at)
+            self._queue.task_done()
+
+    def _estimate_retry_after(self):
+        # Time for the current backlog to drain at the observed per-job rate
+        with self._lock:
+            durations = list(self._recent_durations)
+        average = sum(durations) / len(durations) if durations else 5.0
+        backlog = self._queue.qsize() + self.workers
+        return max(1, math.ceil(average * backlog / self.workers))
+
+    def _prune(self):
+        cutoff = time.time() - self.result_ttl
+        with self._lock:
+            expired = [job_id for job_id, job in self._jobs.items()
+                       if job.finished_at is not None and job.finished_at < cutoff]
+            for job_id in expired:
+                del self._jobs[job_id]
+
+    def stats(self):
+        with self._lock:
+            jobs = list(self._jobs.values())
+        counts = {QUEUED: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+        for job in jobs:
+            counts[job.status] += 1
+        counts['queue_capacity'] = self._queue.maxsize
+        counts['workers'] = self.workers
+        return counts
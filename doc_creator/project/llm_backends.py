@@ -0,0 +1,379 @@
+"""
+Model backends behind the `generate_content()` interface the pipeline consumes.
+
+The pipeline (and `llm_client.LLMClient`) only relies on the shape of the
+google.generativeai streaming API: `generate_content(prompt, stream=True, ...)`
+returning an iterable of chunks with `.candidates[0].content.parts[*].text`,
+`.finish_reason`, `.safety_ratings` and `.prompt_feedback.block_reason`.
+
+  - `GeminiBackend` is the real model; google.generativeai is only imported when
+    this backend is created. With `context_cache_ttl` the system prompt is stored
+    once as a provider-side cached context that requests reference instead of
+    resending it (see `ContextCache`).
+  - `ReplayBackend` is a local, deterministic stand-in for load tests and
+    benchmarks: it replays recorded responses from a corpus directory, chosen by
+    prompt hash, with latencies drawn from configurable distributions.
+
+Select one with LLM_BACKEND=gemini|replay (see `create_backend`).
+"""
+import os
+import abc
+import time
+import datetime
+import types
+import random
+import hashlib
+import logging
+import threading
+
+REPLAY_CORPUS_EXTENSIONS = ('.py', '.json', '.md', '.txt')
+# Smallest context the Gemini API caches (models differ; override with GeminiBackend(context_cache_min_tokens=...))
+MIN_CACHED_CONTEXT_TOKENS = 4096
+
+
+class LLMBackend(abc.ABC):
+    """
+    Interface: a model that streams Gemini-shaped response chunks. `prompt` is a string or a
+    conversation, a list of {'role': 'user'|'model', 'parts': [text]} turns (see repair.py).
+    A backend that does not implement the interface cannot be instantiated, so it fails in
+    create_backend() at startup rather than on the first request.
+    """
+
+    name = None
+
+    @abc.abstractmethod
+    def generate_content(self, prompt, stream=False, request_options=None):
+        """Returns a response chunk, or an iterable of chunks with `stream=True`."""
+
+
+class GeminiBackend(LLMBackend):
+    """google.generativeai model configured with the system prompt."""
+
+    name = 'gemini'
+
+    def __init__(self, api_key, model_name, system_prompt, transport=None, generation_config=None,
+                 context_cache_ttl=None, context_cache_min_tokens=MIN_CACHED_CONTEXT_TOKENS, logger=None):
+        import google.generativeai as genai # Optional dependency: only this backend needs it
+        # One client per process: every request reuses its gRPC channel / HTTP session
+        genai.configure(api_key=api_key, transport=transport)
+        self.model_name = model_name
+        self._model = genai.GenerativeModel(model_name, system_instruction=system_prompt, generation_config=generation_config)
+        self.context_cache = None
+        if context_cache_ttl:
+            self.context_cache = ContextCache(genai, model_name, system_prompt, context_cache_ttl,
+                                              generation_config=generation_config, logger=logger,
+                                              min_tokens=context_cache_min_tokens)
+
+    def _cached_model(self):
+        return self.context_cache.model() if self.context_cache is not None else None
+
+    def generate_content(self, prompt, stream=False, request_options=None):
+        cached = self._cached_model()
+        if cached is not None:
+            try:
+                # Streaming calls fetch the first chunk before returning, so an expired cache fails here
+                return cached.generate_content(prompt, stream=stream, request_options=request_options)
+            except Exception as e:
+                if not self.context_cache.handle_error(e):
+                    raise
+        return self._model.generate_content(prompt, stream=stream, request_options=request_options)
+
+
+class ContextCache:
+    """
+    The system prompt as a provider-side cached context (google.generativeai caching).
+
+    The cache is created, and extended before it expires, on a background thread; until it
+    exists (or while it cannot be created, e.g. because the prompt is below the model's
+    minimum cacheable size) requests use the plain model with the system instruction, so a
+    cache problem never fails a request. A request that hits an expired or deleted cache
+    is retried once without it by GeminiBackend, and the cache is created again.
+
+    The cache is named after a hash of the model and prompt, and an existing one is adopted
+    rather than duplicated, so every web worker (and a restarted one) shares a single copy.
+
+    Before the first creation the model and prompt are checked once: experimental models and
+    models that do not list createCachedContent cannot cache, and a system prompt below
+    `min_tokens` (by count_tokens) is too small to be cached. An ineligible cache is never
+    created; `stats()['unavailable_reason']` says why.
+    """
+
+    def __init__(self, genai, model_name, system_prompt, ttl, generation_config=None, logger=None,
+                 retry_interval=300.0, min_tokens=MIN_CACHED_CONTEXT_TOKENS):
+        self._genai = genai
+        self.model_name = model_name
+        self.system_prompt = system_prompt
+        self.ttl = float(ttl)
+        self.refresh_margin = self.ttl / 4 # Extend once less than a quarter of the TTL is left
+        self.retry_interval = retry_interval # After a failed creation
+        self.generation_config = generation_config
+        self.display_name = 'docgen-' + hashlib.sha256(f"{model_name}\n{system_prompt}".encode('utf-8')).hexdigest()[:24]
+        self.logger = logger or logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._cache = None
+        self._model = None
+        self._expires_at = 0.0 # time.monotonic()
+        self._busy = False # A create/extend call is running
+        self._next_attempt = 0.0
+        self.min_tokens = min_tokens
+        self.prompt_tokens = None # By count_tokens, once checked
+        self._eligible = None # Unknown until the first background attempt
+        self.unavailable_reason = None
+        self.counters = {'created': 0, 'adopted': 0, 'extended': 0, 'errors': 0, 'expired_fallbacks': 0}
+
+    def model(self):
+        """The GenerativeModel bound to the cached context, or None (use the plain model)."""
+        now = time.monotonic()
+        with self._lock:
+            usable = self._model is not None and now < self._expires_at
+            if not self._busy and now >= self._next_attempt and (not usable or self._expires_at - now < self.refresh_margin):
+                self._busy = True
+                threading.Thread(target=self._create_or_extend, name="gemini-context-cache", daemon=True).start()
+            return self._model if usable else None
+
+    def _check_eligibility(self):
+        """None if the model and prompt can be cached, else the reason. Raises on transient API errors."""
+        model_id = self.model_name.split('/')[-1]
+        if '-exp' in model_id:
+            return f"experimental model {model_id} does not support cached contexts"
+        methods = getattr(self._genai.get_model(f"models/{model_id}"), 'supported_generation_methods', None)
+        if methods is not None and 'createCachedContent' not in methods:
+            return f"model {model_id} does not support cached contexts"
+        self.prompt_tokens = self._genai.GenerativeModel(self.model_name).count_tokens(self.system_prompt).total_tokens
+        if self.prompt_tokens < self.min_tokens:
+            return f"system prompt has {self.prompt_tokens} tokens, below the {self.min_tokens}-token minimum for a cached context"
+        return None
+
+    def _create_or_extend(self):
+        ttl = datetime.timedelta(seconds=self.ttl)
+        try:
+            if self._eligible is None:
+                reason = self._check_eligibility()
+                with self._lock:
+                    self._eligible = reason is None
+                    self.unavailable_reason = reason
+                    if reason is not None:
+                        self._next_attempt = float('inf')
+                if reason is not None:
+                    self.logger.warning(f"Gemini context cache disabled, sending the system prompt with each request: {reason}.")
+                    return
+            with self._lock:
+                cache = self._cache
+            if cache is not None:
+                try:
+                    cache.update(ttl=ttl)
+                    self._set(cache, None, 'extended')
+                    return
+                except Exception as e:
+                    self.logger.info(f"Could not extend the Gemini context cache, creating a new one: {e}")
+            cache = self._find_existing()
+            counter = 'adopted'
+            if cache is not None:
+                try:
+                    cache.update(ttl=ttl)
+                except Exception as e: # Expired between list() and update()
+                    self.logger.info(f"Could not adopt Gemini context cache {cache.name}: {e}")
+                    cache = None
+            if cache is None:
+                cache = self._genai.caching.CachedContent.create(
+                    model=self.model_name,
+                    display_name=self.display_name,
+                    system_instruction=self.system_prompt,
+                    ttl=ttl,
+                )
+                counter = 'created'
+            model = self._genai.GenerativeModel.from_cached_content(cache, generation_config=self.generation_config)
+            self._set(cache, model, counter)
+            with self._lock:
+                self.unavailable_reason = None
+            self.logger.info(f"Gemini context cache {cache.name} ready "
+                             f"({getattr(cache.usage_metadata, 'total_token_count', '?')} tokens, TTL {self.ttl:g}s).")
+        except Exception as e:
+            # Below the model's minimum cacheable size, retrying cannot help
+            permanent = 'min_total_token_count' in str(e) or 'too small' in str(e).lower()
+            with self._lock:
+                self.counters['errors'] += 1
+                self._next_attempt = float('inf') if permanent else time.monotonic() + self.retry_interval
+                self.unavailable_reason = str(e) if permanent or self._model is None else None
+            self.logger.warning(f"Gemini context cache unavailable{' for this model' if permanent else ''}, "
+                                f"sending the system prompt with each request: {e}")
+        finally:
+            with self._lock:
+                self._busy = False
+
+    def _find_existing(self):
+        """A live cache of this model and prompt created by another process, if any."""
+        model_id = self.model_name.split('/')[-1]
+        for cache in self._genai.caching.CachedContent.list():
+            if cache.display_name == self.display_name and cache.model.split('/')[-1] == model_id:
+                return cache
+        return None
+
+    def _set(self, cache, model, counter):
+        with self._lock:
+            self._cache = cache
+            if model is not None:
+                self._model = model
+            # Counted from before the call returned, so the local view never outlives the provider's
+            self._expires_at = time.monotonic() + self.ttl - 5
+            self.counters[counter] += 1
+
+    def handle_error(self, exc):
+        """True if `exc` means the cached context is gone (the request should be retried without it)."""
+        # e.g. "403 CachedContent not found (or permission denied)"
+        if 'cachedcontent' not in str(exc).lower().replace(' ', ''):
+            return False
+        with self._lock:
+            self._cache = None
+            self._model = None
+            self._expires_at = 0.0
+            self._next_attempt = 0.0
+            self.counters['expired_fallbacks'] += 1
+        self.logger.warning(f"Gemini context cache expired or missing, retrying without it: {exc}")
+        return True
+
+    def stats(self):
+        with self._lock:
+            remaining = self._expires_at - time.monotonic() if self._model is not None else 0
+            return {
+                'name': getattr(self._cache, 'name', None),
+                'active': self._model is not None and remaining > 0,
+                'expires_in_seconds': max(0, round(remaining)),
+                'prompt_tokens': self.prompt_tokens,
+                'unavailable_reason': self.unavailable_reason,
+                **self.counters,
+            }
+
+
+# --- Latency distributions ---
+
+def parse_latency(spec):
+    """
+    Parses a latency spec into a sampler `f(rng) -> seconds` (never negative):
+      fixed:S | uniform:LO,HI | normal:MEAN,STDDEV | lognormal:MEDIAN,SIGMA | exp:MEAN
+    """
+    kind, _, args = (spec or 'fixed:0').partition(':')
+    try:
+        params = [float(value) for value in args.split(',')] if args else []
+    except ValueError:
+        raise ValueError(f"Invalid latency spec: {spec!r}")
+    samplers = {
+        'fixed': (1, lambda rng, s: s),
+        'uniform': (2, lambda rng, lo, hi: rng.uniform(lo, hi)),
+        'normal': (2, lambda rng, mean, stddev: rng.gauss(mean, stddev)),
+        # Median rather than mu: lognormal:2,0.5 means "typically 2s, with a long right tail"
+        'lognormal': (2, lambda rng, median, sigma: rng.lognormvariate(0, sigma) * median),
+        'exp': (1, lambda rng, mean: rng.expovariate(1 / mean) if mean > 0 else 0.0),
+    }
+    if kind not in samplers or len(params) != samplers[kind][0]:
+        raise ValueError(f"Invalid latency spec: {spec!r} (expected e.g. 'fixed:0.5', 'lognormal:2,0.5')")
+    sample = samplers[kind][1]
+    return lambda rng: max(0.0, sample(rng, *params))
+
+
+class ReplayError(Exception):
+    """Injected provider failure; carries an HTTP status like google.api_core errors do."""
+
+    def __init__(self, message, code=503):
+        super().__init__(message)
+        self.code = code
+
+
+def _chunk(text, finish_reason=None):
+    candidate = types.SimpleNamespace(
+        content=types.SimpleNamespace(parts=[types.SimpleNamespace(text=text)]),
+        finish_reason=finish_reason,
+        safety_ratings=[],
+    )
+    return types.SimpleNamespace(candidates=[candidate], prompt_feedback=types.SimpleNamespace(block_reason=None), text=text)
+
+
+class _ReplayStream:
+    """Iterable streamed response; `_iterator.close()` stops it like the real client's stream."""
+
+    def __init__(self, iterator):
+        self._iterator = iterator
+
+    def __iter__(self):
+        return self._iterator
+
+
+class ReplayBackend(LLMBackend):
+    """
+    Replays recorded responses from `corpus_dir`.
+
+    `.py` files are treated as bare code and wrapped in a ```python fence (`.json`
+    document trees in a ```json fence, see document_ir.py); `.md`/`.txt`
+    files are replayed verbatim as full model responses. The same prompt always gets
+    the same response. Each response is split into `chunks` pieces; the first arrives
+    after a `ttft` sample, each further one after a `chunk_interval` sample.
+    `error_rate` injects 503 errors, raised by the `generate_content` call itself.
+    """
+
+    name = 'replay'
+
+    def __init__(self, corpus_dir, ttft='fixed:0', chunk_interval='fixed:0', chunks=8, error_rate=0.0, seed=0):
+        self.corpus_dir = corpus_dir
+        self.responses = []
+        for filename in sorted(os.listdir(corpus_dir)):
+            if not filename.endswith(REPLAY_CORPUS_EXTENSIONS):
+                continue
+            with open(os.path.join(corpus_dir, filename), encoding='utf-8') as f:
+                text = f.read()
+            if filename.endswith('.py'):
+                text = f"```python\n{text.strip()}\n```\n"
+            elif filename.endswith('.json'):
+                text = f"```json\n{text.strip()}\n```\n"
+            self.responses.append((filename, text))
+        if not self.responses:
+            raise ValueError(f"Replay corpus {corpus_dir} has no {'/'.join(REPLAY_CORPUS_EXTENSIONS)} files")
+        self._ttft = parse_latency(ttft)
+        self._chunk_interval = parse_latency(chunk_interval)
+        self.chunks = max(1, chunks)
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+
+    def pick(self, prompt):
+        """Returns (filename, response_text) replayed for `prompt`."""
+        digest = hashlib.sha256(str(prompt).encode('utf-8')).digest()
+        return self.responses[int.from_bytes(digest[:8], 'big') % len(self.responses)]
+
+    def _sample(self, sampler):
+        with self._rng_lock:
+            return sampler(self._rng)
+
+    def generate_content(self, prompt, stream=False, request_options=None):
+        _, text = self.pick(prompt)
+        timeout = (request_options or {}).get('timeout')
+        # Like the real client, the call itself waits for the first chunk and raises provider errors;
+        # only the remaining chunks arrive lazily while the stream is iterated
+        with self._rng_lock:
+            failed = self.error_rate and self._rng.random() < self.error_rate
+        delay = self._sample(self._ttft)
+        if timeout is not None and delay > timeout:
+            time.sleep(timeout)
+            raise TimeoutError("Replay backend: time to first chunk exceeded the request timeout")
+        time.sleep(delay)
+        if failed:
+            raise ReplayError("Replay backend: injected provider error")
+        if stream:
+            return _ReplayStream(self._stream(text))
+        for _ in self._stream(text): # A non-streamed call returns once the whole response is generated
+            pass
+        return _chunk(text, finish_reason='STOP')
+
+    def _stream(self, text):
+        size = -(-len(text) // self.chunks) # Ceiling division
+        pieces = [text[i:i + size] for i in range(0, len(text), size)] or ['']
+        for index, piece in enumerate(pieces):
+            if index:
+                time.sleep(self._sample(self._chunk_interval))
+            yield _chunk(piece, finish_reason='STOP' if index == len(pieces) - 1 else None)
+
+def create_backend(name, **options):
+    """Builds the backend selected by LLM_BACKEND. `options` are that backend's constructor arguments."""
+    backends = {backend.name: backend for backend in (GeminiBackend, ReplayBackend)}
+    if name not in backends:
+        raise ValueError(f"Unknown LLM backend {name!r} (choose from {', '.join(sorted(backends))})")
+    return backends[name](**options)
@@ -0,0 +1,268 @@
+"""
+Resilient call layer around the Gemini model object.
+
+`LLMClient` wraps the process-wide `GenerativeModel` (which owns the one shared
+gRPC channel / HTTP session, so every call reuses the same connections) and adds
+what a bare `generate_content()` call lacks:
+
+  - a per-process semaphore bounding in-flight model calls,
+  - a hard deadline per call, passed down as the transport timeout and enforced
+    between streamed chunks,
+  - retries with full-jitter exponential backoff on 429/5xx and connection errors,
+    only while no chunk has been delivered yet (a partial stream cannot be replayed),
+  - a circuit breaker: after `breaker_threshold` consecutive failed calls, calls fail
+    fast with `LLMUnavailable` for `breaker_reset` seconds, then a single trial call
+    decides whether to close it again.
+
+`stream()` is used by the request threads (and by the async job queue's worker threads).
+"""
+import time
+import random
+import asyncio
+import logging
+import threading
+
+# HTTP statuses worth retrying: rate limiting and transient server-side failures
+RETRYABLE_STATUS_CODES = frozenset({408, 429, 500, 502, 503, 504})
+# gRPC status numbers -> HTTP equivalents, for the retryable ones
+_GRPC_TO_HTTP = {4: 504, 8: 429, 13: 500, 14: 503}
+
+
+class LLMError(Exception):
+    """Base class for failures of the call layer itself (not of the model's output)."""
+
+
+class LLMUnavailable(LLMError):
+    """The call was refused without reaching the provider (circuit open, or no free call slot)."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class LLMDeadlineExceeded(LLMError):
+    """The call did not finish within its deadline."""
+
+
+def _status_code(exc):
+    # google.api_core exceptions carry the HTTP status as `.code`; gRPC errors expose a code() method
+    code = getattr(exc, 'code', None)
+    if callable(code):
+        try:
+            value = getattr(code(), 'value', None) # grpc.StatusCode values are (number, name) tuples
+        except Exception:
+            return None
+        code = _GRPC_TO_HTTP.get(value[0]) if isinstance(value, tuple) else None
+    return code if isinstance(code, int) else None
+
+
+def is_retryable(exc):
+    """True for errors a later attempt may not hit: 429/5xx responses, timeouts and dropped connections."""
+    if isinstance(exc, (ConnectionError, TimeoutError)):
+        return True
+    return _status_code(exc) in RETRYABLE_STATUS_CODES
+
+
+def close_stream(response, logger=None):
+    """Stops an in-flight streamed response so the model stops generating (and billing) tokens we discard."""
+    iterator = getattr(response, '_iterator', None)
+    for method_name in ('cancel', 'close', 'aclose'): # gRPC calls expose cancel(), HTTP/generator streams close()
+        method = getattr(iterator, method_name, None)
+        if callable(method):
+            try:
+                result = method()
+                if asyncio.iscoroutine(result):
+                    result.close() # Async generators: dropping the coroutine is enough for our purpose
+            except Exception as e:
+                (logger or logging.getLogger(__name__)).debug("Could not close AI response stream: %s", e)
+            return
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker (closed -> open -> half-open -> closed)."""
+
+    def __init__(self, threshold=5, reset_timeout=30.0):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+        self.times_opened = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            return 'half_open' if time.monotonic() - self._opened_at >= self.reset_timeout else 'open'
+
+    def before_call(self):
+        """Raises LLMUnavailable if calls should fail fast right now. Returns True for the half-open trial call."""
+        with self._lock:
+            if self._opened_at is None:
+                return False
+            waited = time.monotonic() - self._opened_at
+            if waited < self.reset_timeout:
+                raise LLMUnavailable("AI provider circuit is open", retry_after=max(1, int(self.reset_timeout - waited)))
+            if self._trial_in_flight:
+                raise LLMUnavailable("AI provider circuit is half-open, trial call in progress", retry_after=1)
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_in_flight or (self._opened_at is None and self._failures >= self.threshold):
+                self._opened_at = time.monotonic()
+                self.times_opened += 1
+            self._trial_in_flight = False
+
+    def release_trial(self):
+        """Ends a half-open trial that neither succeeded nor failed (e.g. a non-retryable error, or cancelled)."""
+        with self._lock:
+            self._trial_in_flight = False
+
+
+class LLMClient:
+    """Bounded, deadline-aware, retrying access to one model object. Thread-safe."""
+
+    def __init__(self, model, max_concurrency=8, deadline=60.0, max_retries=3, backoff_base=0.5,
+                 backoff_max=8.0, breaker_threshold=5, breaker_reset=30.0, logger=None):
+        self.model = model
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_concurrency = max_concurrency
+        self.logger = logger or logging.getLogger(__name__)
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_reset)
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._stats_lock = threading.Lock()
+        self._in_flight = 0
+        self.counters = {'calls': 0, 'retries': 0, 'failures': 0, 'deadline_exceeded': 0, 'rejected': 0}
+
+    # --- Bookkeeping ---
+
+    def _count(self, name, delta=1):
+        with self._stats_lock:
+            self.counters[name] += delta
+
+    def _backoff(self, attempt):
+        # Full jitter: uniform in [0, min(cap, base * 2^attempt)] spreads retries of concurrent callers apart
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _acquire_slot(self, deadline_at):
+        if not self._slots.acquire(timeout=max(0.0, deadline_at - time.monotonic())):
+            self._count('rejected')
+            raise LLMUnavailable("Too many concurrent AI requests", retry_after=1)
+        with self._stats_lock:
+            self._in_flight += 1
+
+    def _release_slot(self):
+        with self._stats_lock:
+            self._in_flight -= 1
+        self._slots.release()
+
+    def _request_options(self, deadline_at):
+        remaining = deadline_at - time.monotonic()
+        if remaining <= 0:
+            raise LLMDeadlineExceeded("AI request deadline exceeded")
+        return {'timeout': remaining}
+
+    def _on_attempt_error(self, exc, attempt, deadline_at):
+        """Decides whether a failed attempt that delivered nothing is retried; re-raises otherwise."""
+        if isinstance(exc, LLMDeadlineExceeded):
+            self._count('deadline_exceeded')
+            self._count('failures')
+            self.breaker.record_failure()
+            raise exc
+        if not is_retryable(exc):
+            raise exc
+        delay = self._backoff(attempt)
+        if attempt >= self.max_retries or time.monotonic() + delay >= deadline_at:
+            self._count('failures')
+            self.breaker.record_failure()
+            raise exc
+        self._count('retries')
+        self.logger.warning(f"AI request failed ({exc.__class__.__name__}: {exc}), retry {attempt + 1} in {delay:.2f}s")
+        return delay
+
+    def _mid_stream_error(self, exc):
+        if isinstance(exc, LLMDeadlineExceeded):
+            self._count('deadline_exceeded')
+        if isinstance(exc, LLMDeadlineExceeded) or is_retryable(exc):
+            self._count('failures')
+            self.breaker.record_failure()
+
+    # --- Blocking path ---
+
+    def stream(self, prompt, deadline=None, model=None):
+        """
+        Yields streamed response chunks for `prompt`. Raises LLMUnavailable (fail fast),
+        LLMDeadlineExceeded, or the provider's exception once retries are exhausted.
+        Closing the generator early closes the underlying stream.
+        `model` overrides self.model for this call (another prompt setup of the same provider,
+        which shares the concurrency limit and the circuit breaker).
+        """
+        model = model or self.model
+        deadline_at = time.monotonic() + (deadline or self.deadline)
+        trial = self.breaker.before_call()
+        try:
+            self._acquire_slot(deadline_at)
+        except LLMUnavailable:
+            if trial:
+                self.breaker.release_trial()
+            raise
+        self._count('calls')
+        try:
+            attempt = 0
+            while True:
+                response = None
+                delivered = False
+                try:
+                    response = model.generate_content(prompt, stream=True,
+                                                           request_options=self._request_options(deadline_at))
+                    for chunk in response:
+                        if not delivered:
+                            delivered = True
+                            self.breaker.record_success()
+                        yield chunk
+                        if time.monotonic() > deadline_at:
+                            raise LLMDeadlineExceeded("AI request deadline exceeded")
+                    if not delivered:
+                        self.breaker.record_success() # An empty but well-formed response is still a healthy provider
+                    return
+                except GeneratorExit:
+                    close_stream(response, self.logger)
+                    raise
+                except Exception as e:
+                    if response is not None:
+                        close_stream(response, self.logger)
+                    if delivered:
+                        self._mid_stream_error(e)
+                        raise
+                    time.sleep(self._on_attempt_error(e, attempt, deadline_at))
+                    attempt += 1
+        finally:
+            self._release_slot()
+            if trial:
+                self.breaker.release_trial()
+
+    def stats(self):
+        with self._stats_lock:
+            data = dict(self.counters)
+            data['in_flight'] = self._in_flight
+        data.update({
+            'max_concurrency': self.max_concurrency,
+            'circuit_state': self.breaker.state,
+            'circuit_opened': self.breaker.times_opened,
+        })
+        return data
+
@@ -0,0 +1,134 @@
+"""
+Minimal in-process metrics with Prometheus text exposition (format 0.0.4).
+
+Just what the server needs (counters and histograms with optional labels) and
+no dependency on prometheus_client. Recording is one dict lookup, a bisect over
+the bucket bounds and a few additions under a per-metric lock; all formatting
+happens when /metrics is scraped.
+
+Values are per process: under a multi-worker server, scrape every worker or run
+one worker per metrics target.
+"""
+import math
+import bisect
+import threading
+
+# Seconds; spans sub-millisecond stages up to the multi-minute AI deadline
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class _Metric:
+    type_name = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        with self._lock:
+            items = sorted(self._values.items())
+            lines.extend(self._sample_lines(items))
+        return lines
+
+
+class Counter(_Metric):
+    """Monotonically increasing count, e.g. failures per branch."""
+
+    type_name = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _sample_lines(self, items):
+        for key, value in items:
+            yield f"{self.name}_total{_format_labels(zip(self.labelnames, key))} {_format_value(value)}"
+
+
+class Histogram(_Metric):
+    """Distribution of observations in cumulative buckets, plus their sum and count."""
+
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket (non-cumulative) counts, overflow bucket last, then sum
+                state = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[index] += 1
+            state[-1] += value
+
+    def _sample_lines(self, items):
+        for key, state in items:
+            pairs = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), state[:-1]):
+                cumulative += count
+                yield f"{self.name}_bucket{_format_labels(pairs + [('le', _format_value(float(bound)))])} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(pairs)} {_format_value(state[-1])}"
+            yield f"{self.name}_count{_format_labels(pairs)} {cumulative}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Duplicate metric name: {metric.name}")
+            self._metrics[metric.name] = metric
+
+    def expose(self):
+        """Renders every metric in the Prometheus text format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
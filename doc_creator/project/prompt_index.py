@@ -0,0 +1,190 @@
+"""
+Prompt normalization and near-duplicate lookup for the generated-code cache.
+
+`normalize_prompt` turns a chat message into the canonical form the cache is keyed on.
+It is a fixed sequence of precompiled patterns:
+
+  - HTML tags and entities are removed, and the text is Unicode-normalized (NFKC) and lowercased.
+  - Dates are rewritten in ISO form, so "March 3, 2024", "3 Mar 2024" and "2024-03-03"
+    are one prompt, while different dates stay different prompts.
+  - Greetings and politeness filler ("please", "hi", "thanks") are dropped.
+  - Punctuation is dropped, except inside numbers such as "1.5" or "10,000".
+  - Whitespace is collapsed.
+
+`NearDuplicateIndex` is a MinHash index over the normalized prompts that have a cache
+entry, for prompts that say the same thing in a different word order ("in a word report,
+sales by region" / "sales by region in a word report"). Each prompt becomes the set of
+its words and word pairs. Signatures are split into LSH bands to find candidates in
+constant time. A candidate matches only if it has exactly the same words, with the same
+counts, and the exact Jaccard similarity of the shingles reaches the threshold. Generated scripts hard-code their prompt's content, so any
+difference in wording ("in French", "risks" / "opportunities", "5" / "6 slides") must be
+a miss, however similar the rest of the text is.
+"""
+import re
+import html
+import struct
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+
+_MONTHS = {name: index for index, names in enumerate((
+    ('january', 'jan'), ('february', 'feb'), ('march', 'mar'), ('april', 'apr'), ('may',), ('june', 'jun'),
+    ('july', 'jul'), ('august', 'aug'), ('september', 'sep', 'sept'), ('october', 'oct'), ('november', 'nov'),
+    ('december', 'dec'),
+), start=1) for name in names}
+_MONTH = r'(?P<month>' + '|'.join(sorted(_MONTHS, key=len, reverse=True)) + r')\.?'
+
+_TAG_RE = re.compile(r'<[^>]+>')
+_WHITESPACE_RE = re.compile(r'\s+')
+_ISO_DATE_RE = re.compile(r'\b(?P<year>\d{4})[-/.](?P<month>\d{1,2})[-/.](?P<day>\d{1,2})\b')
+_NUMERIC_DATE_RE = re.compile(r'\b(?P<day>\d{1,2})[/.](?P<month>\d{1,2})[/.](?P<year>\d{4})\b') # Day first, as in the client's locale
+_MONTH_FIRST_RE = re.compile(_MONTH + r'\s+(?P<day>\d{1,2})(?:st|nd|rd|th)?,?\s+(?P<year>\d{4})\b')
+_DAY_FIRST_RE = re.compile(r'\b(?P<day>\d{1,2})(?:st|nd|rd|th)?\s+(?:of\s+)?' + _MONTH + r',?\s+(?P<year>\d{4})\b')
+_FILLER_RE = re.compile(r'\b(?:please|pls|plz|kindly|hi|hello|hey|thanks|thank you|thx)\b')
+_PUNCTUATION_RE = re.compile(r'(?<!\d)[^\w\s]|[^\w\s](?!\d)|_')
+_TOKEN_RE = re.compile(r'\S+')
+
+SIGNATURE_SIZE = 64 # MinHash permutations
+BANDS = 16 # LSH bands of SIGNATURE_SIZE // BANDS rows; pairs above ~0.5 Jaccard almost always share a band
+_MERSENNE = (1 << 61) - 1
+# Fixed permutation parameters so signatures agree across processes and restarts
+_PERMUTATIONS = [
+    (int.from_bytes(hashlib.sha256(f"a{i}".encode()).digest()[:8], 'big') % (_MERSENNE - 1) + 1,
+     int.from_bytes(hashlib.sha256(f"b{i}".encode()).digest()[:8], 'big') % _MERSENNE)
+    for i in range(SIGNATURE_SIZE)
+]
+
+
+def _iso_date(match):
+    month = match.group('month')
+    month = _MONTHS.get(month.rstrip('.'), None) if not month.isdigit() else int(month)
+    day, year = int(match.group('day')), int(match.group('year'))
+    if not month or not 1 <= month <= 12 or not 1 <= day <= 31:
+        return match.group(0)
+    return f"{year:04d}-{month:02d}-{day:02d}"
+
+
+def normalize_prompt(text):
+    """Canonical form of a prompt for cache keys (see the module docstring)."""
+    text = html.unescape(_TAG_RE.sub(' ', text or ''))
+    text = unicodedata.normalize('NFKC', text).lower()
+    for pattern in (_ISO_DATE_RE, _NUMERIC_DATE_RE, _MONTH_FIRST_RE, _DAY_FIRST_RE):
+        text = pattern.sub(_iso_date, text)
+    text = _FILLER_RE.sub(' ', text)
+    text = _PUNCTUATION_RE.sub(' ', text)
+    return _WHITESPACE_RE.sub(' ', text).strip()
+
+
+def _shingles(tokens):
+    """Words and adjacent word pairs, hashed to 64-bit integers."""
+    grams = set(tokens)
+    grams.update(f"{first} {second}" for first, second in zip(tokens, tokens[1:]))
+    return frozenset(struct.unpack('>Q', hashlib.blake2b(gram.encode('utf-8'), digest_size=8).digest())[0]
+                     for gram in grams)
+
+
+def _signature(shingles):
+    return tuple(min((a * value + b) % _MERSENNE for value in shingles) for a, b in _PERMUTATIONS)
+
+
+class _Entry:
+    __slots__ = ('key', 'shingles', 'words', 'bands')
+
+    def __init__(self, key, shingles, words, bands):
+        self.key = key
+        self.shingles = shingles
+        self.words = words
+        self.bands = bands
+
+
+class NearDuplicateIndex:
+    """
+    MinHash/LSH index from normalized prompts to code-cache keys, per namespace (model and
+    system prompt), holding the `max_entries` most recently added prompts. Thread-safe.
+    """
+
+    def __init__(self, threshold=0.9, max_entries=5000):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # (namespace, normalized prompt) -> _Entry, oldest first
+        self._buckets = {} # (namespace, band index, band hash) -> set of (namespace, normalized prompt)
+        self.lookups = 0
+        self.matches = 0
+
+    @staticmethod
+    def _features(normalized_prompt):
+        tokens = _TOKEN_RE.findall(normalized_prompt)
+        if not tokens:
+            return None
+        shingles = _shingles(tokens)
+        signature = _signature(shingles)
+        rows = SIGNATURE_SIZE // BANDS
+        bands = tuple(hash(signature[i * rows:(i + 1) * rows]) for i in range(BANDS))
+        words = tuple(sorted(tokens)) # The multiset of words: only their order may differ between matches
+        return shingles, words, bands
+
+    def add(self, namespace, normalized_prompt, key):
+        features = self._features(normalized_prompt)
+        if features is None:
+            return
+        entry = _Entry(key, *features)
+        ident = (namespace, normalized_prompt)
+        with self._lock:
+            self._remove(ident)
+            self._entries[ident] = entry
+            for band_index, band in enumerate(entry.bands):
+                self._buckets.setdefault((namespace, band_index, band), set()).add(ident)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def discard(self, namespace, key):
+        """Drops the prompts that point at `key` (its cache entry is gone)."""
+        with self._lock:
+            for ident in [ident for ident, entry in self._entries.items() if ident[0] == namespace and entry.key == key]:
+                self._remove(ident)
+
+    def _remove(self, ident):
+        # Caller holds the lock
+        entry = self._entries.pop(ident, None)
+        if entry is None:
+            return
+        for band_index, band in enumerate(entry.bands):
+            bucket = self._buckets.get((ident[0], band_index, band))
+            if bucket is not None:
+                bucket.discard(ident)
+                if not bucket:
+                    del self._buckets[(ident[0], band_index, band)]
+
+    def lookup(self, namespace, normalized_prompt):
+        """Returns (key, similarity) of the most similar indexed prompt at or above the threshold, or None."""
+        features = self._features(normalized_prompt)
+        if features is None:
+            return None
+        shingles, words, bands = features
+        with self._lock:
+            self.lookups += 1
+            candidates = set()
+            for band_index, band in enumerate(bands):
+                candidates.update(self._buckets.get((namespace, band_index, band), ()))
+            best = None
+            for ident in candidates:
+                entry = self._entries[ident]
+                if entry.words != words:
+                    continue
+                similarity = len(shingles & entry.shingles) / len(shingles | entry.shingles)
+                if similarity >= self.threshold and (best is None or similarity > best[1]):
+                    best = (entry.key, similarity)
+            if best is not None:
+                self.matches += 1
+            return best
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'threshold': self.threshold,
+                'lookups': self.lookups,
+                'matches': self.matches,
+            }
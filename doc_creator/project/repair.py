@@ -0,0 +1,98 @@
+"""
+Server-side repair of generated scripts that failed validation or execution.
+
+Instead of failing the request, the pipeline sends the failed script back to the code
+model together with what went wrong (the validator's rule, or a trimmed traceback) and
+asks for a corrected script, a bounded number of times within a total time budget.
+
+A `RepairSession` holds the conversation: the user's request, then for every round the
+model's script and the failure report. It is sent as a list of {'role', 'parts'} turns,
+the same history google.generativeai's ChatSession sends, through the code model's
+regular generate_content(): the system instruction (and any cached context) is reused,
+and the call goes through the same client limits, deadline and circuit breaker.
+"""
+import re
+import time
+
+# Failure reasons (DocumentGenerationError.reason) a corrected script can plausibly fix.
+# Timeouts are not retried: another run of a slow script would eat the whole budget.
+REPAIRABLE_REASONS = frozenset({
+    'validation_failed', 'script_error', 'resource_limit', 'missing_output', 'invalid_output', 'execution_error',
+})
+MAX_DIAGNOSTIC_CHARS = 1500 # Of the failure report sent to the model (the end of a traceback is what matters)
+MIN_ROUND_SECONDS = 5 # A round needs at least this much of the budget left to be worth starting
+MIN_RUN_SECONDS = 2 # A repaired script is only run with at least this much of the budget left
+
+# Frames of the runner (sandbox bootstrap, worker pool, runpy) say nothing about the script
+_RUNNER_FRAME_RE = re.compile(r'^\s*File "[^"]*(?:sandbox\.py|worker_pool\.py|runpy\.py|<frozen runpy>)", line \d+')
+_SCRIPT_FRAME_RE = re.compile(r'File "[^"]*generated_script\.py", line (\d+)')
+
+REPAIR_INSTRUCTIONS = (
+    "The script you wrote failed on the server:\n\n{report}\n\n"
+    "Fix the problem and answer with the complete corrected script in a single ```python block. "
+    "All the original rules still apply (only the allowed imports, save exactly one output.docx, "
+    "output.pptx or output.pdf in the current directory, no print())."
+)
+
+
+def trim_traceback(text, code=None, limit=MAX_DIAGNOSTIC_CHARS):
+    """
+    Drops the runner's frames and host paths from a traceback and keeps at most its last `limit`
+    characters. Frames of the script get their source line from `code` when the traceback has none
+    (the warm workers compile the script from a string).
+    """
+    source = code.splitlines() if code else []
+    raw = (text or '').strip().splitlines()
+    lines = []
+    skip_source_line = False
+    for index, line in enumerate(raw):
+        if skip_source_line:
+            skip_source_line = False
+            if line.startswith('    '):
+                continue
+        if _RUNNER_FRAME_RE.match(line):
+            skip_source_line = True # The next line is the runner's source line
+            continue
+        frame = _SCRIPT_FRAME_RE.search(line)
+        if frame is None:
+            lines.append(line)
+            continue
+        lines.append(line[:frame.start()] + f'File "generated_script.py", line {frame.group(1)}' + line[frame.end():])
+        line_number = int(frame.group(1))
+        has_source = index + 1 < len(raw) and raw[index + 1].startswith('    ')
+        if not has_source and 0 < line_number <= len(source):
+            lines.append('    ' + source[line_number - 1].strip())
+    trimmed = '\n'.join(lines)
+    if len(trimmed) > limit:
+        trimmed = '...\n' + trimmed[-limit:]
+    return trimmed
+
+
+class RepairSession:
+    """The repair conversation of one request, with its round and time budget."""
+
+    def __init__(self, user_prompt, max_rounds=2, budget_seconds=60.0):
+        self.max_rounds = max_rounds
+        self.deadline_at = time.monotonic() + budget_seconds
+        self.rounds = 0
+        self.last_reason = None
+        self.turns = [{'role': 'user', 'parts': [user_prompt]}]
+
+    def remaining(self):
+        return max(0.0, self.deadline_at - time.monotonic())
+
+    def can_repair(self, reason):
+        return (reason in REPAIRABLE_REASONS and self.rounds < self.max_rounds
+                and self.remaining() >= MIN_ROUND_SECONDS)
+
+    def can_run(self):
+        """False once the repair request has left too little of the budget to run the repaired script."""
+        return self.remaining() >= MIN_RUN_SECONDS
+
+    def next_request(self, code, reason, report):
+        """Records the failed script and its failure; returns the turns to send for the next round."""
+        self.rounds += 1
+        self.last_reason = reason
+        self.turns.append({'role': 'model', 'parts': [f"```python\n{code}\n```"]})
+        self.turns.append({'role': 'user', 'parts': [REPAIR_INSTRUCTIONS.format(report=trim_traceback(report, code) or reason)]})
+        return list(self.turns)
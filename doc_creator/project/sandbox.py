@@ -0,0 +1,238 @@
+"""
+Resource-limited execution of generated scripts (`run_in_sandbox`).
+
+The script runs in a fresh interpreter started with `-I` (no user site-packages, no
+PYTHON* variables, no script directory on sys.path) and an empty environment, in its
+own process group. Before the script starts, this module (re-executed as a small
+bootstrap) applies hard rlimits to the process:
+
+  RLIMIT_AS      address space: a giant table fails with MemoryError instead of swapping the host
+  RLIMIT_CPU     CPU seconds: a busy loop is killed (SIGXCPU) even while the wall clock allows it
+  RLIMIT_NOFILE  open file descriptors
+  RLIMIT_FSIZE   largest file the script may write
+  RLIMIT_CORE    0, no core dumps
+
+Hard limits are lowered too (for CPU, one second above the soft limit), so the script
+cannot raise them again. Optionally the
+interpreter starts inside new user/network/IPC namespaces via unshare(1) (no network
+at all, even for code that got past validation). The wall-clock timeout kills the
+whole process group.
+
+CPU time of every run comes from the kernel's accounting for the child (wait4), so it
+covers the script even when it is killed. Peak RSS is reported by the bootstrap at exit
+(VmHWM of the fresh interpreter): wait4's ru_maxrss would include the web server's own
+RSS at fork time. Runs killed by a signal have no peak RSS.
+
+The warm worker pool (worker_pool.py) applies the same limits with `apply_limits`, except
+the CPU limit, which it sets per job.
+"""
+import os
+import sys
+import json
+import signal
+import shutil
+import threading
+import subprocess
+
+try:
+    import resource # Unix only; without it scripts run unlimited (and unmeasured)
+except ImportError:
+    resource = None
+
+SCRIPT_FILENAME = 'generated_script.py'
+MAX_CAPTURED_OUTPUT = 1024 * 1024 # Bytes of stdout / stderr kept per run (stderr keeps its tail: the traceback)
+UNSHARE_ARGS = ('--user', '--map-root-user', '--net', '--ipc')
+
+
+class SandboxLimits:
+    """Per-script resource limits; 0 / None disables a limit."""
+
+    def __init__(self, memory_mb=1024, cpu_seconds=15, max_open_files=64, max_file_mb=50):
+        self.memory_mb = memory_mb
+        self.cpu_seconds = cpu_seconds
+        self.max_open_files = max_open_files
+        self.max_file_mb = max_file_mb
+
+    def to_dict(self):
+        return {
+            'memory_mb': self.memory_mb,
+            'cpu_seconds': self.cpu_seconds,
+            'max_open_files': self.max_open_files,
+            'max_file_mb': self.max_file_mb,
+        }
+
+
+def apply_limits(limits, cpu=True):
+    """Applies `limits` (a SandboxLimits.to_dict()) to the current process. Irreversible."""
+    if resource is None:
+        return
+    settings = [(resource.RLIMIT_CORE, 0)]
+    if limits.get('memory_mb'):
+        settings.append((resource.RLIMIT_AS, limits['memory_mb'] * 1024 * 1024))
+    if cpu and limits.get('cpu_seconds'):
+        settings.append((resource.RLIMIT_CPU, int(limits['cpu_seconds'])))
+    if limits.get('max_open_files'):
+        settings.append((resource.RLIMIT_NOFILE, limits['max_open_files']))
+    if limits.get('max_file_mb'):
+        settings.append((resource.RLIMIT_FSIZE, limits['max_file_mb'] * 1024 * 1024))
+    for which, value in settings:
+        _, hard = resource.getrlimit(which)
+        if hard != resource.RLIM_INFINITY:
+            value = min(value, hard) # Never try to raise a limit the server itself runs under
+        # One extra CPU second between SIGXCPU (soft) and SIGKILL (hard) so the exit names the limit
+        new_hard = value + 1 if which == resource.RLIMIT_CPU and (hard == resource.RLIM_INFINITY or value < hard) else value
+        resource.setrlimit(which, (value, new_hard))
+
+
+def describe_exit(returncode, stderr=''):
+    """Names the limit (or signal) that ended a run, or returns None for a normal exit."""
+    if returncode is not None and returncode < 0:
+        signum = -returncode
+        if signum == getattr(signal, 'SIGXCPU', None):
+            return 'cpu time limit'
+        if signum == signal.SIGKILL:
+            return 'killed (cpu time or wall-clock limit)'
+        try:
+            return f"signal {signal.Signals(signum).name}"
+        except ValueError:
+            return f"signal {signum}"
+    if returncode:
+        tail = stderr[-2000:]
+        if 'MemoryError' in tail:
+            return 'memory limit'
+        if 'Too many open files' in tail:
+            return 'open files limit'
+        if 'File too large' in tail:
+            return 'file size limit'
+    return None
+
+
+def _drain(stream, sink, keep_tail):
+    """Reads `stream` to EOF keeping at most MAX_CAPTURED_OUTPUT bytes (the head, or the tail)."""
+    size = 0
+    for block in iter(lambda: stream.read(64 * 1024), b''):
+        sink.append(block)
+        size += len(block)
+        while size > MAX_CAPTURED_OUTPUT and len(sink) > 1:
+            size -= len(sink.pop(0 if keep_tail else -1))
+    stream.close()
+
+
+def run_in_sandbox(code, cwd, timeout, limits=None, unshare=False, python_executable=None):
+    """
+    Writes `code` to cwd/generated_script.py and runs it there under `limits`.
+    Returns a subprocess.CompletedProcess with extra `cpu_seconds`, `peak_rss_kb` and
+    `limit` (see describe_exit) attributes; raises subprocess.TimeoutExpired after
+    `timeout` wall-clock seconds, like subprocess.run.
+    """
+    limits = limits or SandboxLimits()
+    python_executable = python_executable or sys.executable
+    script_path = os.path.join(cwd, SCRIPT_FILENAME)
+    with open(script_path, 'w', encoding='utf-8') as f:
+        f.write(code)
+
+    report_read, report_write = os.pipe() # The bootstrap writes its peak RSS here at exit
+    command = [python_executable, '-I', os.path.abspath(__file__), '--run', json.dumps(limits.to_dict()),
+               str(report_write), SCRIPT_FILENAME]
+    if unshare:
+        command = [shutil.which('unshare') or 'unshare', *UNSHARE_ARGS, *command]
+
+    if resource is None or not hasattr(os, 'wait4'):
+        # No rlimits / per-child accounting on this platform: plain isolated run
+        os.close(report_read)
+        os.close(report_write)
+        result = subprocess.run(command[command.index(python_executable):], cwd=cwd, env={}, capture_output=True,
+                                text=True, timeout=timeout, check=False)
+        result.cpu_seconds = result.peak_rss_kb = result.limit = None
+        return result
+
+    try:
+        proc = subprocess.Popen(command, cwd=cwd, env={}, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, start_new_session=True, pass_fds=(report_write,))
+    finally:
+        os.close(report_write)
+    report = []
+    stdout, stderr = [], []
+    readers = [threading.Thread(target=_drain, args=(proc.stdout, stdout, False), daemon=True),
+               threading.Thread(target=_drain, args=(proc.stderr, stderr, True), daemon=True),
+               threading.Thread(target=_drain, args=(os.fdopen(report_read, 'rb'), report, False), daemon=True)]
+    for reader in readers:
+        reader.start()
+
+    timed_out = threading.Event()
+
+    def kill_group():
+        timed_out.set()
+        _kill_group(proc.pid)
+
+    timer = threading.Timer(timeout, kill_group)
+    timer.daemon = True
+    timer.start()
+    try:
+        # wait4 reaps the child and returns the kernel's resource usage for it (and its reaped children)
+        _, status, usage = os.wait4(proc.pid, 0)
+    finally:
+        timer.cancel()
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    _kill_group(proc.pid) # Anything the script left running in its group goes too
+    for reader in readers:
+        reader.join(timeout=5)
+
+    out = b''.join(stdout).decode('utf-8', errors='replace')
+    err = b''.join(stderr).decode('utf-8', errors='replace')
+    if timed_out.is_set():
+        raise subprocess.TimeoutExpired([SCRIPT_FILENAME], timeout, output=out, stderr=err)
+
+    result = subprocess.CompletedProcess([SCRIPT_FILENAME], proc.returncode, out, err)
+    result.cpu_seconds = usage.ru_utime + usage.ru_stime
+    try:
+        result.peak_rss_kb = json.loads(b''.join(report))['peak_rss_kb']
+    except (ValueError, KeyError, TypeError):
+        result.peak_rss_kb = None # Killed before it could report
+    result.limit = describe_exit(proc.returncode, err)
+    return result
+
+
+def _kill_group(pgid):
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def self_peak_rss_kb():
+    """High-water RSS of this process image (VmHWM resets on exec, unlike ru_maxrss)."""
+    try:
+        with open('/proc/self/status', encoding='ascii') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource is not None else 0
+    # ru_maxrss is reported in bytes on macOS and kilobytes on Linux
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def _bootstrap_main(argv):
+    """Child side: apply the limits, then run the script as __main__ (like `python generated_script.py`)."""
+    import runpy
+    import atexit
+    limits, report_fd, script = json.loads(argv[0]), int(argv[1]), argv[2]
+
+    def report():
+        # Runs on normal exit and after an uncaught exception (e.g. MemoryError), not when killed
+        try:
+            os.write(report_fd, json.dumps({'peak_rss_kb': self_peak_rss_kb()}).encode())
+            os.close(report_fd)
+        except OSError:
+            pass
+
+    atexit.register(report)
+    apply_limits(limits)
+    sys.argv = [script]
+    runpy.run_path(script, run_name='__main__')
+
+
+if __name__ == '__main__' and len(sys.argv) == 5 and sys.argv[1] == '--run':
+    _bootstrap_main(sys.argv[2:])
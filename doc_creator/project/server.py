@@ -1,17 +1,48 @@
 import os
+import stat
+import mimetypes
 import subprocess
 import shutil
 import tempfile
 import re
-import ast
 import uuid
+import time
 import logging
 from logging.handlers import RotatingFileHandler
-from flask import Flask, request, jsonify, send_file, render_template, abort
+from flask import Flask, request, jsonify, send_file, render_template, abort, Response, stream_with_context
 from werkzeug.security import safe_join
+from werkzeug.exceptions import HTTPException
+from urllib.parse import quote as url_quote
 from flask_wtf.csrf import CSRFProtect, CSRFError
 from dotenv import load_dotenv
 from functools import wraps
+from contextlib import contextmanager
+import threading
+import atexit
+import json
+import queue
+import sqlite3
+from worker_pool import WorkerPool
+from sandbox import SandboxLimits, run_in_sandbox
+from admission import CostModel, AdmissionController, Overloaded
+from jobs import JobQueue, JobQueueFull
+from code_cache import CodeCache, make_cache_key
+from artifact_cache import ArtifactCache, artifact_key, link_or_copy
+from code_validator import CodeValidator, ValidationResult
+from code_extractor import StreamingCodeExtractor
+from janitor import SessionJanitor, owned_bytes
+from batch import run_concurrently, iter_zip
+from llm_client import LLMClient, LLMUnavailable, LLMDeadlineExceeded, is_retryable
+from llm_backends import create_backend
+from metrics import Counter, Histogram, REGISTRY, CONTENT_TYPE as METRICS_CONTENT_TYPE
+import structured_logging
+import doc_templates
+import document_ir
+import contextvars
+import storage
+import speculative
+from repair import RepairSession
+from prompt_index import NearDuplicateIndex, normalize_prompt
 
 load_dotenv()
 
@@ -42,22 +73,171 @@ app.config.update({
         'random',
         # --- DO NOT ADD 'os', 'sys', 'subprocess', 'shutil', 'requests', 'socket', etc. ---
      },
-    'EXECUTION_TIMEOUT': 15, # Slightly increased timeout
+    'EXECUTION_TIMEOUT': 15, # Slightly increased timeout (with ADAPTIVE_TIMEOUT: used until enough runs were observed)
+    # Adaptive timeout (see admission.py): p95 of similar scripts (document type, size) x factor, within these bounds
+    'ADAPTIVE_TIMEOUT': os.getenv('ADAPTIVE_TIMEOUT', '1') != '0',
+    'EXECUTION_TIMEOUT_MIN': float(os.getenv('EXECUTION_TIMEOUT_MIN', 5)),
+    'EXECUTION_TIMEOUT_MAX': float(os.getenv('EXECUTION_TIMEOUT_MAX', 60)),
+    'EXECUTION_TIMEOUT_FACTOR': float(os.getenv('EXECUTION_TIMEOUT_FACTOR', 3)),
+    # Admission control: defer scripts while the predicted work in flight exceeds this many seconds per execution slot
+    # (or the load average per CPU exceeds ADMISSION_MAX_LOAD, 0 = ignore), shed them with a 503 after ADMISSION_MAX_WAIT
+    'ADMISSION_CONTROL': os.getenv('ADMISSION_CONTROL', '1') != '0',
+    'ADMISSION_MAX_QUEUE_SECONDS': float(os.getenv('ADMISSION_MAX_QUEUE_SECONDS', 10)),
+    'ADMISSION_MAX_WAIT': float(os.getenv('ADMISSION_MAX_WAIT', 5)),
+    'ADMISSION_MAX_LOAD': float(os.getenv('ADMISSION_MAX_LOAD', 2.0)),
     'EXPECTED_OUTPUT_FILENAMES': {'output.docx', 'output.pdf', 'output.pptx'}, # Expected output names from generated script
+    # Warm worker pool: long-lived interpreters with docx/pptx/reportlab preloaded (set DOCGEN_WORKER_POOL=0 to spawn 'python' per request)
+    'USE_WORKER_POOL': os.getenv('DOCGEN_WORKER_POOL', '1') != '0',
+    'WORKER_POOL_SIZE': int(os.getenv('WORKER_POOL_SIZE', 2)),
+    'WORKER_MAX_JOBS': int(os.getenv('WORKER_MAX_JOBS', 50)), # Recycle a worker after this many scripts
+    'WORKER_MAX_RSS_MB': int(os.getenv('WORKER_MAX_RSS_MB', 512)), # ...or once its peak memory grows past this
+    # Sandbox (see sandbox.py): rlimits for every generated script, on the worker pool and the subprocess path
+    'SANDBOX_MEMORY_MB': int(os.getenv('SANDBOX_MEMORY_MB', 1024)), # Address space (RLIMIT_AS)
+    'SANDBOX_CPU_SECONDS': int(os.getenv('SANDBOX_CPU_SECONDS', 15)), # CPU time per script (RLIMIT_CPU)
+    'SANDBOX_MAX_OPEN_FILES': int(os.getenv('SANDBOX_MAX_OPEN_FILES', 64)),
+    'SANDBOX_MAX_FILE_MB': int(os.getenv('SANDBOX_MAX_FILE_MB', 50)), # Largest file a script may write (RLIMIT_FSIZE)
+    # Subprocess path only: start scripts in new user/network/IPC namespaces via unshare(1) (no network access)
+    'SANDBOX_UNSHARE': os.getenv('SANDBOX_UNSHARE', '0') == '1',
+    # Async mode (POST /generate-file?async=1): executor threads and the bounded queue feeding them
+    'ASYNC_JOB_WORKERS': int(os.getenv('ASYNC_JOB_WORKERS', 4)),
+    'ASYNC_JOB_QUEUE_SIZE': int(os.getenv('ASYNC_JOB_QUEUE_SIZE', 32)),
+    'ASYNC_JOB_RESULT_TTL': int(os.getenv('ASYNC_JOB_RESULT_TTL', 3600)), # Seconds a finished job stays pollable
+    # Batch generation (/generate-batch): items per request and pipeline runs in flight per batch
+    'BATCH_MAX_ITEMS': int(os.getenv('BATCH_MAX_ITEMS', 200)),
+    'BATCH_CONCURRENCY': int(os.getenv('BATCH_CONCURRENCY', 8)),
+    # Default generation mode: 'code' (the model writes a script that is validated and executed) or
+    # 'ir' (the model writes a JSON document tree rendered in-process, see document_ir.py); requests may pass 'mode'
+    'GENERATION_MODE': os.getenv('GENERATION_MODE', 'code'),
+    # Template fast path (see doc_templates.py): requests with JSON 'content' that match a template are rendered in-process
+    'TEMPLATE_FAST_PATH': os.getenv('TEMPLATE_FAST_PATH', '1') != '0',
+    # Speculative generation (see speculative.py): K > 1 concurrent AI generations per prompt, each validated and
+    # executed as it arrives; the first to produce a document wins and the others are cancelled (K x model spend)
+    'SPECULATIVE_CANDIDATES': max(1, int(os.getenv('SPECULATIVE_CANDIDATES', 1))),
+    # Self-repair (see repair.py): a script that fails validation or execution goes back to the model with the
+    # failure, up to REPAIR_ATTEMPTS times (0 = off) within REPAIR_BUDGET seconds from the first failure
+    'REPAIR_ATTEMPTS': int(os.getenv('REPAIR_ATTEMPTS', 2)),
+    'REPAIR_BUDGET': float(os.getenv('REPAIR_BUDGET', 60)),
+    'STREAM_KEEPALIVE_INTERVAL': 15, # Seconds between keep-alive comments on idle /generate-file/stream responses
+    'GEMINI_MODEL_NAME': os.getenv('GEMINI_MODEL_NAME', 'gemini-2.0-flash-thinking-exp-01-21'),
+    'GEMINI_TRANSPORT': os.getenv('GEMINI_TRANSPORT') or None, # 'grpc' (library default) or 'rest'
+    # Provider-side cached context for the system prompt (see llm_backends.ContextCache), kept alive for this
+    # many seconds and extended while in use; 0 sends the system prompt with every request. Off by default:
+    # SYSTEM_PROMPT (~2.5k tokens) is below the API's minimum cacheable size and the default (experimental)
+    # model cannot cache. Worth enabling with a stable model and a prompt above GEMINI_CONTEXT_CACHE_MIN_TOKENS.
+    'GEMINI_CONTEXT_CACHE_TTL': float(os.getenv('GEMINI_CONTEXT_CACHE_TTL', 0)),
+    'GEMINI_CONTEXT_CACHE_MIN_TOKENS': int(os.getenv('GEMINI_CONTEXT_CACHE_MIN_TOKENS', 4096)), # The model's minimum
+    # Model backend (see llm_backends.py): 'gemini', or 'replay' to serve recorded responses offline (load tests)
+    'LLM_BACKEND': os.getenv('LLM_BACKEND', 'gemini'),
+    'LLM_REPLAY_CORPUS': os.getenv('LLM_REPLAY_CORPUS', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks', 'corpus')),
+    'LLM_REPLAY_TTFT': os.getenv('LLM_REPLAY_TTFT', 'fixed:0'), # e.g. 'lognormal:2,0.5' (median seconds, sigma)
+    'LLM_REPLAY_IR_CORPUS': os.getenv('LLM_REPLAY_IR_CORPUS', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks', 'corpus_ir')),
+    'LLM_REPLAY_CHUNK_INTERVAL': os.getenv('LLM_REPLAY_CHUNK_INTERVAL', 'fixed:0'),
+    'LLM_REPLAY_CHUNKS': int(os.getenv('LLM_REPLAY_CHUNKS', 8)),
+    'LLM_REPLAY_ERROR_RATE': float(os.getenv('LLM_REPLAY_ERROR_RATE', 0)),
+    'LLM_REPLAY_SEED': int(os.getenv('LLM_REPLAY_SEED', 0)),
+    # AI call layer (see llm_client.py): in-flight limit, hard deadline, retries and circuit breaker
+    'LLM_MAX_CONCURRENCY': int(os.getenv('LLM_MAX_CONCURRENCY', 8)),
+    'LLM_DEADLINE': float(os.getenv('LLM_DEADLINE', 120)), # Seconds per AI request, retries included
+    'LLM_MAX_RETRIES': int(os.getenv('LLM_MAX_RETRIES', 3)),
+    'LLM_BACKOFF_BASE': float(os.getenv('LLM_BACKOFF_BASE', 0.5)),
+    'LLM_BACKOFF_MAX': float(os.getenv('LLM_BACKOFF_MAX', 8)),
+    'LLM_BREAKER_THRESHOLD': int(os.getenv('LLM_BREAKER_THRESHOLD', 5)), # Consecutive failed calls before failing fast
+    'LLM_BREAKER_RESET': float(os.getenv('LLM_BREAKER_RESET', 30)), # Seconds to fail fast before a trial call
+    # Generated-code cache: identical (normalized prompt, model, SYSTEM_PROMPT) requests skip the AI call.
+    # Prompts are normalized by prompt_index.normalize_prompt (case, markup, punctuation, date formats, filler words)
+    'CODE_CACHE_ENABLED': os.getenv('CODE_CACHE_ENABLED', '1') != '0',
+    'CODE_CACHE_PATH': os.getenv('CODE_CACHE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'code_cache.sqlite3')),
+    'CODE_CACHE_TTL': int(os.getenv('CODE_CACHE_TTL', 7 * 24 * 3600)), # Seconds
+    'CODE_CACHE_MAX_ENTRIES': int(os.getenv('CODE_CACHE_MAX_ENTRIES', 5000)),
+    'CODE_CACHE_MAX_BYTES': int(os.getenv('CODE_CACHE_MAX_BYTES', 64 * 1024 * 1024)),
+    # Opt-in: prompts with exactly the same words in a different order (see prompt_index.py) reuse the cached
+    # code of the most similar recent prompt when their word/word-pair Jaccard similarity reaches the
+    # threshold (e.g. 0.5); 0 turns the index off
+    'NEAR_DUPLICATE_THRESHOLD': float(os.getenv('NEAR_DUPLICATE_THRESHOLD', 0)),
+    'NEAR_DUPLICATE_INDEX_SIZE': int(os.getenv('NEAR_DUPLICATE_INDEX_SIZE', 5000)), # Most recent prompts indexed
+    # Rendered-artifact cache: identical scripts reuse the output file instead of being executed again.
+    # Keep it on the same filesystem as GENERATED_FILES_DIR so files can be hard-linked instead of copied.
+    'ARTIFACT_CACHE_ENABLED': os.getenv('ARTIFACT_CACHE_ENABLED', '1') != '0',
+    'ARTIFACT_CACHE_DIR': os.getenv('ARTIFACT_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'artifacts')),
+    'ARTIFACT_CACHE_MAX_BYTES': int(os.getenv('ARTIFACT_CACHE_MAX_BYTES', 512 * 1024 * 1024)), # Whole directory, shared by all workers
+    'ARTIFACT_CACHE_TTL': int(os.getenv('ARTIFACT_CACHE_TTL', 24 * 3600)), # Re-render daily so date-stamped documents stay current
+    # Session janitor: deletes generated_files/<session> directories by age and total size
+    'JANITOR_ENABLED': os.getenv('JANITOR_ENABLED', '1') != '0',
+    'JANITOR_INDEX_PATH': os.getenv('JANITOR_INDEX_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'sessions.sqlite3')),
+    'JANITOR_INTERVAL': int(os.getenv('JANITOR_INTERVAL', 300)), # Seconds between passes
+    'SESSION_TTL': int(os.getenv('SESSION_TTL', 24 * 3600)), # Sessions older than this are deleted (0 = keep forever)
+    'SESSION_QUOTA_BYTES': int(os.getenv('SESSION_QUOTA_BYTES', 1024 * 1024 * 1024)), # Least recently downloaded evicted above this (0 = no quota); files shared with the artifact cache don't count
+    # Store sessions as generated_files/ab/cd/<uuid>/ instead of one flat directory (see storage.py migrate)
+    'SHARDED_STORAGE': os.getenv('SHARDED_STORAGE', '1') != '0',
+    # Downloads: session files never change, so clients and proxies may cache them for the session lifetime
+    'DOWNLOAD_CACHE_MAX_AGE': int(os.getenv('DOWNLOAD_CACHE_MAX_AGE', 24 * 3600)),
+    # Behind nginx: internal location mapped to GENERATED_FILES_DIR, e.g. '/protected-files/' (empty = serve directly)
+    'DOWNLOAD_ACCEL_REDIRECT_PREFIX': os.getenv('DOWNLOAD_ACCEL_REDIRECT_PREFIX', ''),
+    # Behind Apache mod_xsendfile / lighttpd: Flask's built-in X-Sendfile offload
+    'USE_X_SENDFILE': os.getenv('USE_X_SENDFILE', '0') == '1',
+    # Logging: 'json' (one object per line, with request/session ids) or 'text' (the classic line format)
+    'LOG_FORMAT': os.getenv('LOG_FORMAT', 'json'),
+    'LOG_QUEUE_SIZE': int(os.getenv('LOG_QUEUE_SIZE', 10000)), # Records beyond this are dropped rather than blocking requests
+    # Startup (see create_app): import the heavy libraries once in the gunicorn master so forked workers share them
+    'PRELOAD_MODULES': os.getenv('PRELOAD_MODULES', '1') != '0',
 })
 
 # --- Logging Configuration ---
+# Set up by create_app(): the listener thread must be started in the process that serves requests
 log_file = os.path.join(os.path.dirname(__file__), 'app.log')
-# Increased size/count, consider log rotation strategy for production
-handler = RotatingFileHandler(log_file, maxBytes=10 * 1024 * 1024, backupCount=5) # 10MB per file
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(process)d - %(thread)d - %(message)s') # Added process/thread ID
-handler.setFormatter(formatter)
-handler.setLevel(logging.INFO) # Log INFO level and above
-if app.debug:
-    handler.setLevel(logging.DEBUG) # More verbose logging in debug mode
-app.logger.addHandler(handler)
-app.logger.setLevel(logging.INFO) # Ensure app logger respects level
-logging.getLogger('werkzeug').setLevel(logging.INFO) # Quieter Werkzeug logs unless debugging
+handler = None
+log_queue_handler = None
+log_listener = None
+
+def configure_logging():
+    """Routes app.logger through a queue to the rotating log file (again after a fork: threads do not survive it)."""
+    global handler, log_queue_handler, log_listener
+    if log_queue_handler is not None:
+        # Forked from a configured process: reuse its handlers behind a new queue and listener thread
+        app.logger.removeHandler(log_queue_handler)
+        handlers = list(log_listener.handlers)
+    else:
+        # Increased size/count, consider log rotation strategy for production
+        handler = RotatingFileHandler(log_file, maxBytes=10 * 1024 * 1024, backupCount=5) # 10MB per file
+        if app.config['LOG_FORMAT'] == 'json':
+            formatter = structured_logging.JsonFormatter()
+        else:
+            formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(process)d - %(thread)d - %(request_id)s - %(message)s') # Added process/thread ID
+        handler.setFormatter(formatter)
+        handler.setLevel(logging.INFO) # Log INFO level and above
+        if app.debug:
+            handler.setLevel(logging.DEBUG) # More verbose logging in debug mode
+        handlers = [handler]
+    # Request threads only enqueue records; a listener thread formats them and writes (and rotates) the file
+    log_queue_handler, log_listener = structured_logging.setup_queue_logging(app.logger, handlers, queue_size=app.config['LOG_QUEUE_SIZE'])
+    app.logger.setLevel(logging.INFO) # Ensure app logger respects level
+    logging.getLogger('werkzeug').setLevel(logging.INFO) # Quieter Werkzeug logs unless debugging
+
+@app.before_request
+def ensure_app_created():
+    """Fallback for servers given the bare module app ('gunicorn server:app', 'flask --app server run')."""
+    if _app_pid != os.getpid():
+        create_app(preload=False) # Logging and the storage directory; the heavy imports happen on use anyway
+
+
+# --- Request Ids ---
+REQUEST_ID_RE = re.compile(r'[A-Za-z0-9._-]{1,64}')
+
+@app.before_request
+def bind_request_id():
+    """Tags every log record of this request with an id (the client's X-Request-ID if it looks sane)."""
+    request_id = request.headers.get('X-Request-ID', '')
+    if not REQUEST_ID_RE.fullmatch(request_id):
+        request_id = uuid.uuid4().hex
+    structured_logging.clear() # Threads are reused across requests
+    structured_logging.bind(request_id=request_id)
+
+@app.after_request
+def add_request_id_header(response):
+    request_id = structured_logging.request_id_var.get()
+    if request_id:
+        response.headers['X-Request-ID'] = request_id
+    return response
 
 
 # --- Security ---
@@ -355,350 +535,569 @@ doc.save('output.docx')
 """
 
 # --- AI Configuration ---
-model = None # Initialize model variable
-genai = None # Initialize genai library variable
-
-if not GEMINI_API_KEY:
-    app.logger.critical("GEMINI_API_KEY environment variable not set. AI features will fail.")
-    # Optionally, raise an exception or exit if the key is essential for startup
-    # raise ValueError("GEMINI_API_KEY must be set")
-else:
+# `model` is any backend exposing generate_content() (see llm_backends.py)
+def create_model(system_prompt, replay_corpus, generation_config=None):
+    """Builds the configured LLM backend for one system prompt; returns None (after logging why) if it cannot."""
+    if app.config['LLM_BACKEND'] == 'replay':
+        try:
+            replay = create_backend(
+                'replay',
+                corpus_dir=replay_corpus,
+                ttft=app.config['LLM_REPLAY_TTFT'],
+                chunk_interval=app.config['LLM_REPLAY_CHUNK_INTERVAL'],
+                chunks=app.config['LLM_REPLAY_CHUNKS'],
+                error_rate=app.config['LLM_REPLAY_ERROR_RATE'],
+                seed=app.config['LLM_REPLAY_SEED'],
+            )
+            app.logger.warning(f"Using the replay LLM backend ({len(replay.responses)} recorded responses) - not for production.")
+            return replay
+        except (OSError, ValueError) as e:
+            app.logger.critical(f"Failed to set up the replay LLM backend: {e}")
+            return None
+    if app.config['LLM_BACKEND'] != 'gemini':
+        app.logger.critical(f"Unknown LLM_BACKEND '{app.config['LLM_BACKEND']}'. AI features will fail.")
+        return None
+    if not GEMINI_API_KEY:
+        app.logger.critical("GEMINI_API_KEY environment variable not set. AI features will fail.")
+        # Optionally, raise an exception or exit if the key is essential for startup
+        # raise ValueError("GEMINI_API_KEY must be set")
+        return None
     try:
-        import google.generativeai as genai
-        genai.configure(api_key=GEMINI_API_KEY)
         # Choose a model - check availability and features
         # e.g., 'gemini-1.5-flash', 'gemini-1.0-pro'
         # Initialize the model with the system prompt
-        model = genai.GenerativeModel(
-            'gemini-2.0-flash-thinking-exp-01-21', # Using a standard reliable model
-            system_instruction=SYSTEM_PROMPT # Pass the system prompt here
+        gemini = create_backend(
+            'gemini',
+            api_key=GEMINI_API_KEY,
+            model_name=app.config['GEMINI_MODEL_NAME'], # Using a standard reliable model
+            system_prompt=system_prompt, # Pass the system prompt here
+            transport=app.config['GEMINI_TRANSPORT'],
+            generation_config=generation_config,
+            context_cache_ttl=app.config['GEMINI_CONTEXT_CACHE_TTL'],
+            context_cache_min_tokens=app.config['GEMINI_CONTEXT_CACHE_MIN_TOKENS'],
+            logger=app.logger,
         )
         app.logger.info("Google Generative AI configured successfully with system prompt.")
+        return gemini
     except ImportError:
         app.logger.critical("google.generativeai library not installed. Run 'pip install google-generativeai'")
-        genai = None # Ensure genai is None if import fails
     except Exception as e:
         app.logger.critical(f"Failed to configure Google Generative AI: {e}")
-        genai = None # Ensure genai is None if config fails
-        model = None # Ensure model is None if config fails
-
+    return None # Ensure model is None if config fails
+
+# Created on first use (get_model): importing google.generativeai and building the client is most of the
+# startup cost, and its channels must not be shared across a fork. Tests and benchmarks may assign a stand-in.
+model = None
+_model_initialized = False
+_model_lock = threading.Lock()
+
+def get_model():
+    """Returns the code-generation backend, creating it on first use (None if unavailable)."""
+    global model, _model_initialized
+    if model is None and not _model_initialized:
+        with _model_lock:
+            if model is None and not _model_initialized:
+                model = create_model(SYSTEM_PROMPT, app.config['LLM_REPLAY_CORPUS'])
+                _model_initialized = True # Not retried per request if it failed; the reason is logged once
+    return model
+
+# Document IR mode (see document_ir.py): same provider, JSON-tree system prompt; created on first IR request
+_ir_model = None
+_ir_model_initialized = False
+_ir_model_lock = threading.Lock()
+
+def get_ir_model():
+    """Returns the backend that answers with document trees instead of scripts (None if unavailable)."""
+    global _ir_model, _ir_model_initialized
+    if _ir_model is None and not _ir_model_initialized:
+        with _ir_model_lock:
+            if _ir_model is None and not _ir_model_initialized:
+                _ir_model = create_model(document_ir.IR_SYSTEM_PROMPT, app.config['LLM_REPLAY_IR_CORPUS'],
+                                         generation_config={'response_mime_type': 'application/json'})
+                _ir_model_initialized = True # Like get_model: a failed setup is not retried per request
+    return _ir_model
+
+
+# --- AI Call Layer ---
+_llm_client = None
+_llm_client_lock = threading.Lock()
+
+def get_llm_client():
+    """Returns the process-wide AI call layer wrapping `model` (see llm_client.py)."""
+    global _llm_client
+    current = get_model()
+    # Rebuilt if `model` was replaced (e.g. a stand-in swapped in by a benchmark or test)
+    if _llm_client is None or _llm_client.model is not current:
+        with _llm_client_lock:
+            if _llm_client is None or _llm_client.model is not current:
+                _llm_client = LLMClient(
+                    current,
+                    max_concurrency=app.config['LLM_MAX_CONCURRENCY'],
+                    deadline=app.config['LLM_DEADLINE'],
+                    max_retries=app.config['LLM_MAX_RETRIES'],
+                    backoff_base=app.config['LLM_BACKOFF_BASE'],
+                    backoff_max=app.config['LLM_BACKOFF_MAX'],
+                    breaker_threshold=app.config['LLM_BREAKER_THRESHOLD'],
+                    breaker_reset=app.config['LLM_BREAKER_RESET'],
+                    logger=app.logger,
+                )
+    return _llm_client
+
+
+# --- Sandbox Limits ---
+def sandbox_limits():
+    """Resource limits every generated script runs under (see sandbox.py)."""
+    return SandboxLimits(
+        memory_mb=app.config['SANDBOX_MEMORY_MB'],
+        cpu_seconds=app.config['SANDBOX_CPU_SECONDS'],
+        max_open_files=app.config['SANDBOX_MAX_OPEN_FILES'],
+        max_file_mb=app.config['SANDBOX_MAX_FILE_MB'],
+    )
+
+
+# --- Execution Cost Model and Admission Control (see admission.py) ---
+_cost_model = None
+_admission_controller = None
+_admission_lock = threading.Lock()
+
+def get_cost_model():
+    """Returns the process-wide model of script execution times."""
+    global _cost_model
+    if _cost_model is None:
+        with _admission_lock:
+            if _cost_model is None:
+                _cost_model = CostModel(
+                    default_timeout=app.config['EXECUTION_TIMEOUT'],
+                    min_timeout=app.config['EXECUTION_TIMEOUT_MIN'],
+                    max_timeout=app.config['EXECUTION_TIMEOUT_MAX'],
+                    timeout_factor=app.config['EXECUTION_TIMEOUT_FACTOR'],
+                )
+    return _cost_model
+
+def get_admission_controller():
+    """Returns the process-wide admission controller, or None if ADMISSION_CONTROL is off."""
+    global _admission_controller
+    if _admission_controller is None and app.config['ADMISSION_CONTROL']:
+        with _admission_lock:
+            if _admission_controller is None:
+                # Scripts run in parallel on the pool's workers, or on every CPU with one subprocess each
+                slots = app.config['WORKER_POOL_SIZE'] if app.config['USE_WORKER_POOL'] else (os.cpu_count() or 1)
+                _admission_controller = AdmissionController(
+                    slots,
+                    max_queue_seconds=app.config['ADMISSION_MAX_QUEUE_SECONDS'],
+                    max_wait=app.config['ADMISSION_MAX_WAIT'],
+                    max_load=app.config['ADMISSION_MAX_LOAD'],
+                )
+    return _admission_controller
+
+
+# --- Execution Worker Pool ---
+# Created lazily so that processes which never execute scripts (e.g. the debug reloader parent) don't spawn workers.
+_worker_pool = None
+_worker_pool_lock = threading.Lock()
+
+def get_worker_pool():
+    """Returns the process-wide warm worker pool, starting it on first use."""
+    global _worker_pool
+    if _worker_pool is None:
+        with _worker_pool_lock:
+            if _worker_pool is None:
+                _worker_pool = WorkerPool(
+                    size=app.config['WORKER_POOL_SIZE'],
+                    max_jobs=app.config['WORKER_MAX_JOBS'],
+                    max_rss_mb=app.config['WORKER_MAX_RSS_MB'],
+                    logger=app.logger,
+                    limits=sandbox_limits(),
+                )
+                atexit.register(_worker_pool.shutdown)
+    return _worker_pool
 
-# --- Directory Setup ---
-os.makedirs(app.config['GENERATED_FILES_DIR'], exist_ok=True)
 
+_HTML_TAG_RE = re.compile(r'<[^>]+>')
+_WHITESPACE_RE = re.compile(r'\s+')
 
 def remove_html_tags(script):
     # Remove all HTML tags using regular expression
-    text = re.sub(r'<[^>]+>', '', script)
+    text = _HTML_TAG_RE.sub('', script)
     # Replace any whitespace sequences (including newlines and tabs) with a single space
-    text = re.sub(r'\s+', ' ', text)
+    text = _WHITESPACE_RE.sub(' ', text)
     # Strip leading/trailing spaces and convert to lowercase
     return text.strip().lower()
 
 
 # --- Code Validation Logic ---
-def validate_generated_code(code: str) -> bool:
+# Rule tables are compiled once at import; results are memoized by code hash (see code_validator.py)
+code_validator = CodeValidator(app.config['ALLOWED_MODULES'])
+
+def validate_generated_code(code: str) -> ValidationResult:
     """
     Perform security checks on AI-generated Python code.
     Checks for dangerous patterns, forbidden modules, and potentially harmful built-ins.
+    Returns a ValidationResult, which is falsy on failure and names the rule that failed.
 
     NOTE: This validation is helpful but NOT foolproof. Strong sandboxing is essential.
     """
-    app.logger.debug(f"Validating code (first 200 chars): {code[:200]}...")
-
-    # 1. Length Check
-    MAX_CODE_LENGTH = 1000000 # Define max length clearly
-    if len(code) > MAX_CODE_LENGTH:
-        app.logger.warning(f"Code length ({len(code)}) exceeded limit ({MAX_CODE_LENGTH}).")
-        # Avoid logging potentially huge code blocks fully
-        app.logger.warning(f"Code start: {code[:500]}...")
-        return False
-
-    # 2. Forbidden Patterns (Regex) - Stricter and more focused
-    #    Focus on explicit calls to dangerous functions/modules.
-    #    AST checking handles imports better, regex is a first line of defense.
-    #    Using raw strings (r'...') is important for regex patterns.
-    forbidden_patterns = [
-        # # Explicit blocking of dangerous modules even if AST missed them somehow
-        # r'\bimport\s+(os|sys|subprocess|shutil|socket|requests|urllib|httpx|pickle|ctypes)\b',
-        # r'\bfrom\s+(os|sys|subprocess|shutil|socket|requests|urllib|httpx|pickle|ctypes)\s+import\b',
-        # # Direct calls to dangerous functions
-        # r'\b(eval|exec|compile|open|input|__import__)\s*\(',
-        # # Accessing system/environment variables/dunder methods that could be risky
-        # r'os\.(system|popen|environ|getenv|putenv|listdir|scandir|remove|unlink|rmdir|makedirs|chmod|chown)',
-        # r'subprocess\.(run|call|check_call|check_output|Popen)',
-        # r'shutil\.(move|copyfile|copytree|rmtree|disk_usage)', # Allow only expected libs
-        # r'socket\.',
-        # r'requests\.',
-        # r'urllib\.',
-        # r'httpx\.',
-        # r'pickle\.(load|loads|dump|dumps)',
-        # r'ctypes\.',
-        # # Dynamic execution/attribute access
-        # r'\bgetattr\s*\(',
-        # r'\bsetattr\s*\(',
-        # r'\bglobals\s*\(',
-        # r'\blocals\s*\(',
-        # # Direct file writing attempts with open (basic check)
-        # r'open\s*\([^)]+,[^)]*[\'"](w|a|x|wb|ab|xb)[\'"]',
-        # # Common command injection keywords (crude but can catch simple cases)
-        # # r'\b(rm|del|mv|cp|chmod|chown|sudo|apt|yum|dnf|pacman|git|wget|curl)\s+',
-        # # Trying to access sensitive paths (examples)
-        # r'(/|\\)(etc|root|home|users|windows|system32)(\\|/|$)',
-        # r'(\\.ssh|\\.git|\\.aws|\\.azure|\\.gcp)',
-    ]
-
-    for pattern in forbidden_patterns:
-        if re.search(pattern, code, re.IGNORECASE): # Ignore case for broader matching
-            app.logger.warning(f"Forbidden pattern detected in generated code: {pattern}")
-            # Log only a snippet for security reasons if code is large
-            app.logger.warning(f"Code snippet: {code[:500]}...")
-            return False
-
-    # 3. AST Analysis (Abstract Syntax Tree)
-    try:
-        tree = ast.parse(code)
-        allowed_modules = app.config['ALLOWED_MODULES']
-
-        for node in ast.walk(tree):
-            # Check Imports more reliably
-            if isinstance(node, ast.Import):
-                for alias in node.names:
-                    module_name = alias.name.split('.')[0] # Get base module
-                    if module_name not in allowed_modules:
-                        app.logger.warning(f"AST Check: Disallowed module imported: {module_name}")
-                        return False
-            elif isinstance(node, ast.ImportFrom):
-                # Handle 'from . import X' cases (relative imports, should likely be disallowed)
-                if node.level > 0:
-                    app.logger.warning(f"AST Check: Disallowed relative import.")
-                    return False
-                module_name = node.module.split('.')[0] if node.module else None # Get base module
-                if module_name and module_name not in allowed_modules:
-                     app.logger.warning(f"AST Check: Disallowed module imported via 'from': {module_name}")
-                     return False
-                # Optionally, check imported names (node.names) for specific dangerous functions from allowed modules if needed
-
-            # Check Dangerous Built-in Functions/Attributes (AST is more precise than regex)
-            # Check for function calls
-            if isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
-                if node.func.id in ['eval', 'exec', 'compile', 'open', 'input', '__import__', 'globals', 'locals', 'getattr', 'setattr']:
-                    app.logger.warning(f"AST Check: Potentially dangerous built-in function called: {node.func.id}")
-                    return False
-            # Check for direct attribute access on disallowed modules (belt-and-suspenders)
-            # Example: If 'os' somehow passed import checks, catch os.system here
-            if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name):
-                 if node.value.id in ['os', 'sys', 'subprocess', 'shutil', 'socket', 'requests', 'urllib', 'httpx', 'pickle', 'ctypes']:
-                     # Check specific dangerous attributes if needed
-                     # e.g., if node.value.id == 'os' and node.attr == 'system': return False
-                     app.logger.warning(f"AST Check: Detected attribute access on potentially disallowed module '{node.value.id}' (Attribute: {node.attr})")
-                     # Be cautious here, might be too broad. Focus on known dangerous attributes.
-                     if node.value.id == 'os' and node.attr in ['system', 'popen', 'environ', 'getenv', 'putenv', 'listdir', 'scandir', 'remove', 'unlink', 'rmdir', 'makedirs', 'chmod', 'chown']:
-                         return False
-                     if node.value.id == 'subprocess' and node.attr in ['run', 'call', 'check_call', 'check_output', 'Popen']:
-                         return False
-                     # Add more specific checks as needed
-
-    except SyntaxError as e:
-        app.logger.error(f"Syntax error parsing generated code: {e}")
-        # Log snippet for debugging
-        app.logger.error(f"Code snippet with error: {code[max(0, e.lineno-2):e.lineno+1]}")
-        return False
-    except Exception as e:
-        # Catch potential recursion errors with deep ASTs etc.
-        app.logger.error(f"Unexpected error during AST parsing: {e}", exc_info=True)
-        return False # Fail safe
+    result = code_validator.validate(code)
+    for warning in result.warnings:
+        app.logger.warning("AST Check: %s", warning)
+    if not result:
+        app.logger.warning("Code validation failed [%s]: %s", result.rule, result.detail)
+        # Log only a snippet for security reasons if code is large
+        app.logger.warning("Code snippet: %s...", code[:500])
+        return result
 
     app.logger.debug("Code validation passed.")
-    return True
+    return result
 
 
-# --- Flask Routes ---
-@app.route('/')
-def index():
-    """Renders the main HTML page."""
-    return render_template('index.html')
+# --- Document Generation Pipeline ---
+# The stages below are independent of the Flask request so they can be driven both by the
+# synchronous /generate-file route and by the background job workers (?async=1).
 
-@app.route('/generate-file', methods=['POST'])
-# @csrf.exempt # Keep CSRF protection unless specifically handled otherwise (e.g., API keys)
-# If using API Key auth primarily, CSRF might be less critical *for this specific endpoint*,
-# but it's safer to keep it unless it interferes with the client implementation.
-# Let's assume API key is the primary auth here, so exempting for simplicity with non-browser clients.
-@csrf.exempt # Exempt CSRF for API-key protected endpoint often used by scripts/non-browsers
-# @require_api_key # Apply the API key check decorator
-def generate_file():
-    """
-    Handles the POST request to generate a document file using AI-generated code.
-    Requires a valid API Key and JSON payload with a 'prompt'.
-    """
-    app.logger.info(f"File generation request received from {request.remote_addr}")
+class DocumentGenerationError(Exception):
+    """Raised by a pipeline stage with a client-safe error message and the HTTP status to report."""
 
-    # --- Input Validation ---
-    if not request.is_json:
-        app.logger.warning("Invalid content type: Expected application/json")
-        return jsonify({"error": "Invalid content type, requires application/json"}), 400
+    def __init__(self, message, status_code=500, retry_after=None, reason='internal', diagnostics=None):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+        self.retry_after = retry_after # Seconds, reported as a Retry-After header where possible
+        self.reason = reason # Failure branch, the label of docgen_generation_failures_total
+        self.diagnostics = diagnostics # Server-side detail (validator rule, script stderr) for the repair loop; never sent to clients
 
-    data = request.get_json()
-    if not data:
-         app.logger.warning("Empty JSON payload received")
-         return jsonify({"error": "Empty request body"}), 400
 
-    user_prompt = data.get('prompt')
-    if not user_prompt or not isinstance(user_prompt, str) or not user_prompt.strip():
-        app.logger.warning("Missing, invalid, or empty 'prompt' in request JSON")
-        return jsonify({"error": "Missing, invalid, or empty 'prompt' field"}), 400
+class GenerationCancelled(DocumentGenerationError):
+    """Raised from an event callback when the client went away (e.g. closed the stream)."""
 
-    # Limit prompt length server-side as well
-    MAX_PROMPT_LENGTH = 1000000 # Increased limit slightly
-    user_prompt = user_prompt[:MAX_PROMPT_LENGTH].strip() # Trim whitespace too
-    app.logger.debug(f"Processing prompt (first 100 chars): {user_prompt[:100]}...")
+    def __init__(self):
+        super().__init__("Generation cancelled by client", 499, reason='cancelled') # 499 Client Closed Request (nginx convention)
 
-    # --- AI Code Generation ---
-    if not genai or not model:
-         app.logger.error("AI model not configured or failed to initialize. Cannot generate code.")
-         # 503 Service Unavailable is appropriate if the AI backend is down/unconfigured
-         return jsonify({"error": "AI service not available"}), 503
 
+def _emit(on_event, event, **data):
+    """Reports a pipeline stage to the optional progress callback (used by /generate-file/stream)."""
+    if on_event is not None:
+        on_event(event, data)
+
+
+# --- Stage Timing ---
+# Observers are called as observer(stage, seconds) for the pipeline stages: llm, extraction,
+# validation, execution and file_move, plus render / template_render for in-process rendering
+# (used by benchmarks/bench_pipeline.py).
+STAGE_OBSERVERS = []
+
+def _observe_stage(stage, seconds):
+    for observer in STAGE_OBSERVERS:
+        observer(stage, seconds)
+
+
+# --- Metrics (exposed on /metrics, see metrics.py) ---
+TOKEN_BUCKETS = (16, 64, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768, 65536)
+SIZE_BUCKETS = (1024, 10 * 1024, 50 * 1024, 100 * 1024, 500 * 1024, 1024 ** 2, 5 * 1024 ** 2, 10 * 1024 ** 2, 50 * 1024 ** 2)
+
+STAGE_SECONDS = Histogram('docgen_stage_duration_seconds', "Wall time per pipeline stage (llm is the Gemini call, execution the script run).", ['stage'])
+LLM_TOKENS = Histogram('docgen_llm_tokens', "Tokens per AI request as reported by the model (cached: prompt tokens served from the context cache).", ['kind'], buckets=TOKEN_BUCKETS)
+LLM_FIRST_CHUNK_SECONDS = Histogram('docgen_llm_first_chunk_seconds', "Time to the first streamed chunk, by whether the prompt hit the provider's context cache.", ['context_cache'])
+EXECUTION_CPU_SECONDS = Histogram('docgen_execution_cpu_seconds', "CPU time used by generated scripts.")
+EXECUTION_PEAK_RSS_BYTES = Histogram('docgen_execution_peak_rss_bytes', "Peak resident memory of the process that ran a script (worker pool: the whole worker).", buckets=SIZE_BUCKETS[3:] + (100 * 1024 ** 2, 250 * 1024 ** 2, 500 * 1024 ** 2, 1024 ** 3, 2 * 1024 ** 3))
+OUTPUT_FILE_BYTES = Histogram('docgen_output_file_bytes', "Size of generated documents.", buckets=SIZE_BUCKETS)
+DOWNLOAD_SECONDS = Histogram('docgen_download_duration_seconds', "Time to prepare a download response.", ['status'])
+GENERATIONS = Counter('docgen_generations', "Document generations by outcome.", ['outcome'])
+GENERATION_FAILURES = Counter('docgen_generation_failures', "Failed document generations by failure branch.", ['reason'])
+CACHE_HITS = Counter('docgen_cache_hits', "Pipeline stages skipped thanks to a cache.", ['cache'])
+EXECUTION_TIMEOUT_SECONDS = Histogram('docgen_execution_timeout_seconds', "Timeout given to each script (adaptive, see admission.py).")
+ADMISSION_DECISIONS = Counter('docgen_admission_decisions', "Script executions admitted or shed by admission control.", ['decision'])
+TEMPLATE_RENDERS = Counter('docgen_template_renders', "Documents rendered from a template without calling the AI.", ['template'])
+REPAIRS = Counter('docgen_repairs', "Repair rounds by the failure that triggered them and whether the repaired script worked.", ['reason', 'outcome'])
+SPECULATIVE_OUTCOMES = Counter('docgen_speculative_candidates', "Speculative generations by outcome (won, failed, cancelled).", ['outcome'])
+
+STAGE_OBSERVERS.append(lambda stage, seconds: STAGE_SECONDS.observe(seconds, stage=stage))
+
+
+@contextmanager
+def _timed_stage(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _observe_stage(stage, time.perf_counter() - started)
+
+
+def _finish_reason_name(finish_reason):
+    """Finish reasons are enums in the real client and plain strings in stand-ins; compare them by name."""
+    if finish_reason is None:
+        return None
+    return getattr(finish_reason, 'name', finish_reason)
+
+
+def request_generated_code(user_prompt: str, on_chunk=None, mode='code', check=None, contents=None, deadline=None) -> str:
+    """
+    Sends the user's prompt to the AI model and extracts the Python code from the response
+    (with mode='ir', the JSON document tree from the IR model, see document_ir.py).
+    The response is streamed: `on_chunk`, if given, receives every text delta as it arrives, and
+    the stream is closed as soon as the fenced code block is complete (the model tends to append
+    long explanations after the code, which we would otherwise wait and pay for).
+    `check`, if given, is called after every chunk and may raise to abandon the request
+    (speculative.Cancelled when another candidate already won); the stream is closed first.
+    `contents` (a list of conversation turns, see repair.py) is sent instead of the prompt, and
+    `deadline` (seconds) shortens the AI call's deadline.
+    Raises DocumentGenerationError if the request is blocked or no usable code comes back.
+    """
+    started = time.perf_counter()
+    extraction_seconds = 0.0 # Extraction is interleaved with streaming; timed separately from the model
     try:
         app.logger.info("Sending request to AI model...")
         # The detailed instructions are now in the system_instruction used when initializing the model.
         # We only need to send the user's specific request here.
-        response = model.generate_content(remove_html_tags(user_prompt)) # Pass only the user prompt
+        # Calls go through the shared client layer: bounded concurrency, deadline, retries, circuit breaker
+        response = get_llm_client().stream(contents or remove_html_tags(user_prompt), # Pass only the user prompt
+                                           deadline=deadline,
+                                           model=get_ir_model() if mode == 'ir' else None)
 
         # --- Response Processing ---
-        # Check for safety ratings or blocks if the API provides them
-        if hasattr(response, 'prompt_feedback') and response.prompt_feedback.block_reason:
-            app.logger.warning(f"AI generation blocked for prompt. Reason: {response.prompt_feedback.block_reason}")
-            return jsonify({"error": f"Request blocked by safety filter: {response.prompt_feedback.block_reason}"}), 400
-
-        if not response.candidates:
+        # Every streamed chunk is a complete response object of its own; the aggregated `response`
+        # cannot be inspected once we stop iterating early, so all checks happen per chunk.
+        extractor = StreamingCodeExtractor()
+        received_candidates = False
+        finish_reason = None
+        stopped_early = False
+        usage = None
+        first_chunk_seconds = None
+        try:
+            for chunk in response:
+                if first_chunk_seconds is None:
+                    first_chunk_seconds = time.perf_counter() - started
+                usage = getattr(chunk, 'usage_metadata', None) or usage # Running totals; the last chunk has the final ones
+                # Check for safety ratings or blocks if the API provides them
+                if hasattr(chunk, 'prompt_feedback') and chunk.prompt_feedback.block_reason:
+                    app.logger.warning(f"AI generation blocked for prompt. Reason: {chunk.prompt_feedback.block_reason}")
+                    raise DocumentGenerationError(f"Request blocked by safety filter: {chunk.prompt_feedback.block_reason}", 400, reason='blocked')
+                if not chunk.candidates:
+                    continue
+                received_candidates = True
+
+                candidate = chunk.candidates[0]
+                # Extract generated code from the candidate's content
+                # Assuming the code is within the 'parts' of the content
+                chunk_text = "".join(part.text for part in candidate.content.parts if hasattr(part, 'text'))
+                if chunk_text:
+                    if on_chunk is not None:
+                        on_chunk(chunk_text)
+                    extract_started = time.perf_counter()
+                    extractor.feed(chunk_text)
+                    extraction_seconds += time.perf_counter() - extract_started
+
+                # Only the final chunk carries a finish reason
+                if _finish_reason_name(candidate.finish_reason) not in (None, 'FINISH_REASON_UNSPECIFIED'):
+                    finish_reason = _finish_reason_name(candidate.finish_reason)
+                    # Handle potential safety blocks here too
+                    if finish_reason == 'SAFETY':
+                        safety_ratings_str = ", ".join([f"{rating.category}: {rating.probability}" for rating in candidate.safety_ratings])
+                        app.logger.warning(f"Safety block details: {safety_ratings_str}")
+                        raise DocumentGenerationError(f"Generation stopped due to safety concerns ({finish_reason}).", 400, reason='blocked')
+
+                if check is not None:
+                    check()
+
+                if extractor.complete:
+                    stopped_early = True
+                    app.logger.debug("Closing code fence received, stopped reading the AI response early.")
+                    break
+        finally:
+            response.close() # Closes the AI stream and frees the call slot, also when a check or callback raised
+
+        if not received_candidates:
              app.logger.error("AI model returned no candidates.")
              raise ValueError("AI returned no candidates")
 
-        # Check safety ratings of the first candidate if available
-        candidate = response.candidates[0]
-        if candidate.finish_reason != 'STOP':
-             app.logger.warning(f"AI generation finished unexpectedly. Reason: {candidate.finish_reason}")
-             # Handle potential safety blocks here too
-             if candidate.finish_reason == 'SAFETY':
-                 safety_ratings_str = ", ".join([f"{rating.category}: {rating.probability}" for rating in candidate.safety_ratings])
-                 app.logger.warning(f"Safety block details: {safety_ratings_str}")
-                 return jsonify({"error": f"Generation stopped due to safety concerns ({candidate.finish_reason})."}), 400
-             # else: # Other reasons like MAX_TOKENS, RECITATION etc. might warrant errors or specific handling
-             #     return jsonify({"error": f"Generation incomplete ({candidate.finish_reason})."}), 500
-
-        # Extract generated code from the candidate's content
-        # Assuming the code is within the 'parts' of the content
-        generated_code = "".join(part.text for part in candidate.content.parts if hasattr(part, 'text'))
+        if not stopped_early and finish_reason != 'STOP':
+             app.logger.warning(f"AI generation finished unexpectedly. Reason: {finish_reason}")
+             # Other reasons like MAX_TOKENS, RECITATION etc. might warrant errors or specific handling
+             #     raise DocumentGenerationError(f"Generation incomplete ({finish_reason}).", 500)
 
         # --- Basic Code Extraction (if markdown format is used) ---
-        # This tries to strip common markdown code blocks if present
-        code_match = re.search(r"```(?:python)?\s*([\s\S]+?)\s*```", generated_code, re.IGNORECASE)
-        if code_match:
-            generated_code = code_match.group(1).strip()
+        # Strips the markdown code block if present; otherwise assumes the whole response is code
+        # and drops full-line comments (see code_extractor.py)
+        extract_started = time.perf_counter()
+        generated_code, from_block = extractor.result()
+        if mode == 'ir' and not from_block:
+            generated_code = extractor.text.strip() # Bare JSON (JSON response mode): nothing to strip
+        extraction_seconds += time.perf_counter() - extract_started
+        if from_block:
             app.logger.debug("Extracted code from markdown block.")
         else:
-            # Fallback: assume the whole response might be code, clean basic comments/whitespace
-             generated_code = '\n'.join([line for line in generated_code.split('\n')
-                                       if not line.strip().startswith('#')]).strip() # Simple comment removal + strip
              app.logger.debug("No markdown block found, using raw response (comments stripped).")
 
 
         if not generated_code:
             app.logger.error("AI model returned empty code after extraction.")
             # Check if the raw response text had content before extraction
-            raw_text = response.text if hasattr(response, 'text') else "(No raw text available)"
-            app.logger.error(f"Raw response text (first 500): {raw_text[:500]}")
+            app.logger.error(f"Raw response text (first 500): {extractor.text[:500]}")
             raise ValueError("AI returned empty code after extraction")
 
-        app.logger.debug(f"Generated code received (first 500 chars):\n{generated_code[:500]}...")
-
+        if usage is not None:
+            for kind, field in (('prompt', 'prompt_token_count'), ('output', 'candidates_token_count'),
+                                ('cached', 'cached_content_token_count')):
+                count = getattr(usage, field, None)
+                if count:
+                    LLM_TOKENS.observe(count, kind=kind)
+        # Savings of the context cache: cached tokens per request, and hit vs miss time to first chunk
+        cached_tokens = getattr(usage, 'cached_content_token_count', 0) or 0
+        if first_chunk_seconds is not None:
+            LLM_FIRST_CHUNK_SECONDS.observe(first_chunk_seconds, context_cache='hit' if cached_tokens else 'miss')
+        app.logger.debug("AI response: first chunk after %.2fs, %s of %s prompt tokens from the context cache",
+                         first_chunk_seconds or 0.0, cached_tokens, getattr(usage, 'prompt_token_count', '?'))
+
+        app.logger.debug("Generated code received (first 500 chars):\n%s...", generated_code[:500])
+        return generated_code
+
+    except (DocumentGenerationError, speculative.Cancelled):
+        raise # Already carries a client-safe message / abandoned on purpose
+    except LLMUnavailable as e:
+        app.logger.warning(f"AI request refused without calling the provider: {e}")
+        raise DocumentGenerationError("AI service is temporarily unavailable", 503, retry_after=e.retry_after, reason='llm_unavailable')
+    except LLMDeadlineExceeded:
+        app.logger.error(f"AI request exceeded its {app.config['LLM_DEADLINE']}s deadline.")
+        raise DocumentGenerationError("AI service timed out", 504, reason='llm_timeout')
     except Exception as e:
+        if is_retryable(e):
+            app.logger.error(f"AI provider error persisted after retries: {e}")
+            raise DocumentGenerationError("AI service is temporarily unavailable", 503, reason='llm_error')
         app.logger.error(f"AI code generation or processing failed: {e}", exc_info=True)
         # Provide a more generic error to the client
-        return jsonify({"error": "Failed to generate document code from AI"}), 500
+        raise DocumentGenerationError("Failed to generate document code from AI", 500, reason='llm_error')
+    finally:
+        _observe_stage('extraction', extraction_seconds)
+        _observe_stage('llm', time.perf_counter() - started - extraction_seconds)
 
-    # --- Code Validation ---
-    app.logger.info("Validating generated code...")
-    if not validate_generated_code(generated_code):
-        app.logger.warning("Generated code failed validation.")
-        # Do not expose details of validation failure to the client
-        return jsonify({"error": "Generated code is invalid or potentially unsafe"}), 400
-    app.logger.info("Code validation successful.")
 
+STDERR_LOG_CHARS = 2000 # Tail of a failed script's stderr kept in the log
 
+def execute_generated_code(generated_code: str, max_timeout=None):
+    """
+    Runs validated code in an isolated temporary directory and moves the produced output file
+    into a fresh session directory. Returns (session_id, final_filename).
+    The script is admitted against the predicted work in flight and gets a timeout fitted to
+    similar scripts (see admission.py), at most `max_timeout`; raises DocumentGenerationError(503) when shed.
+    """
+    estimate = get_cost_model().estimate(generated_code)
+    timeout = estimate.timeout if app.config['ADAPTIVE_TIMEOUT'] else app.config['EXECUTION_TIMEOUT']
+    if max_timeout is not None:
+        timeout = min(timeout, max_timeout)
+    EXECUTION_TIMEOUT_SECONDS.observe(timeout)
+
+    admission = get_admission_controller()
+    cost = None
+    if admission is not None:
+        try:
+            cost = admission.acquire(estimate.expected)
+        except Overloaded as e:
+            ADMISSION_DECISIONS.inc(decision='shed')
+            app.logger.warning(f"Shedding script execution: host saturated ({admission.stats()}), retry after {e.retry_after}s")
+            raise DocumentGenerationError("Server is busy, please retry later", 503, retry_after=e.retry_after, reason='overloaded')
+        ADMISSION_DECISIONS.inc(decision='admitted')
+
+    app.logger.debug("Executing %s script (%d chars): expected %ss, timeout %.1fs (%s)", estimate.doc_type,
+                     len(generated_code), estimate.expected, timeout, estimate.basis)
+    started = time.perf_counter()
+    try:
+        result = _execute_generated_code(generated_code, timeout)
+    except DocumentGenerationError as e:
+        if e.reason == 'timeout':
+            # Censored at the timeout, but it still pushes the estimate for this kind of script up
+            get_cost_model().record(estimate.doc_type, len(generated_code), timeout)
+        raise
+    finally:
+        if cost is not None:
+            admission.release(cost)
+    get_cost_model().record(estimate.doc_type, len(generated_code), time.perf_counter() - started)
+    return result
+
+
+def _execute_generated_code(generated_code, timeout):
     # --- Secure Code Execution ---
-    # CRITICAL: This section requires robust sandboxing (Docker, nsjail, firecracker, etc.)
-    # The TemporaryDirectory provides *filesystem* isolation but NOT process/network isolation.
-    # The process still runs with the web server's user permissions.
-    # DO NOT RUN IN PRODUCTION WITHOUT A REAL SANDBOX.
+    # Scripts run under rlimits (memory, CPU time, open files, file size; see sandbox.py) and,
+    # on the subprocess path, in `-I` mode with an empty environment and optionally without network.
+    # The TemporaryDirectory provides *filesystem* isolation only: the process still runs with the
+    # web server's user permissions. Use a container/VM boundary (Docker, nsjail, firecracker) as well.
     output_filename = None
     final_filename = None
     file_moved = False
     generated_file_path = None # Keep track of the final path
+    failure_reason = 'execution_error' # Metrics label for the ValueError/RuntimeError/OSError branch below
+    script_stderr = '' # Kept for the repair loop (repair.py)
 
     # Use a unique subdirectory within the main generated files dir for better organization
     # and to simplify cleanup if needed.
     session_id = uuid.uuid4()
-    session_dir = os.path.join(app.config['GENERATED_FILES_DIR'], str(session_id))
+    structured_logging.bind(session_id=session_id)
+    session_dir = new_session_dir(session_id)
     os.makedirs(session_dir, exist_ok=True) # Create a directory for this specific generation
 
     # Consider using a temporary directory that is *outside* the main GENERATED_FILES_DIR initially
     # for execution, then moving the result *into* the session_dir. This adds a layer.
     with tempfile.TemporaryDirectory() as exec_temp_dir:
-        script_path = os.path.join(exec_temp_dir, 'generated_script.py')
         try:
-            with open(script_path, 'w', encoding='utf-8') as f:
-                f.write(generated_code)
-
             app.logger.info(f"Executing generated script in isolated temporary directory: {exec_temp_dir}")
 
-            # *** SANDBOXING PLACEHOLDER ***
-            # This is where you would replace subprocess.run with your sandboxing mechanism.
-            # Example:
-            # result = run_in_sandbox(
-            #     script_path,
-            #     execution_environment=exec_temp_dir, # Mount or map this directory in the sandbox
-            #     allowed_network=False,
-            #     cpu_limit='1s', # Resource limits
-            #     memory_limit='128m',
-            #     timeout=app.config['EXECUTION_TIMEOUT']
-            # )
-            # The result object should contain stdout, stderr, returncode, and potentially info about created files.
-
-            # Current implementation (UNSAFE for production):
+            # Both paths report stdout, stderr, returncode, cpu_seconds, peak_rss_kb and the limit that stopped the script
+            execution_started = time.perf_counter()
             try:
-                 result = subprocess.run(
-                    ['python', script_path], # Use isolated mode '-I' for extra safety
-                    cwd=exec_temp_dir,        # Execute within the temp dir
-                    capture_output=True,
-                    text=True,
-                    timeout=app.config['EXECUTION_TIMEOUT'],
-                    check=False,              # Don't raise exception on non-zero exit, check manually
-                    # env={},                   # Clear environment variables for the subprocess
-                )
+                worker_pool = get_worker_pool() if app.config['USE_WORKER_POOL'] else None
+                if worker_pool is not None and worker_pool.live_workers == 0:
+                    # Every worker is (re)starting, e.g. after failed spawns: don't queue behind the pool
+                    app.logger.warning("No live execution worker, running the script in a one-off sandbox process.")
+                    worker_pool = None
+                if worker_pool is not None:
+                    # Warm interpreter: same cwd/output.* contract, limits and timeout as the subprocess path below
+                    result = worker_pool.run(
+                        generated_code,
+                        cwd=exec_temp_dir,
+                        timeout=timeout,
+                    )
+                else:
+                    result = run_in_sandbox(
+                        generated_code,
+                        cwd=exec_temp_dir, # Execute within the temp dir
+                        timeout=timeout,
+                        limits=sandbox_limits(),
+                        unshare=app.config['SANDBOX_UNSHARE'],
+                    )
+            except subprocess.TimeoutExpired:
+                raise # Handled below with a 504
             except FileNotFoundError:
-                 app.logger.critical("'python' command not found. Ensure Python is installed and in PATH for the server process.")
+                 app.logger.critical("Python executable (or unshare, with SANDBOX_UNSHARE=1) not found for the sandboxed script.")
                  raise RuntimeError("Python executable not found.")
             except Exception as subproc_err: # Catch broader errors during subprocess creation/execution
                  app.logger.error(f"Subprocess execution failed unexpectedly: {subproc_err}", exc_info=True)
                  raise RuntimeError("Failed to run the generated script.")
-
-
-            app.logger.debug(f"Script execution finished. Return code: {result.returncode}")
+            execution_seconds = time.perf_counter() - execution_started
+            _observe_stage('execution', execution_seconds)
+            if getattr(result, 'cpu_seconds', None) is not None:
+                EXECUTION_CPU_SECONDS.observe(result.cpu_seconds)
+            if getattr(result, 'peak_rss_kb', None):
+                EXECUTION_PEAK_RSS_BYTES.observe(result.peak_rss_kb * 1024)
+            app.logger.info("Script finished: exit %s, %.2fs wall, %s CPU, peak RSS %s",
+                            result.returncode, execution_seconds,
+                            f"{result.cpu_seconds:.2f}s" if getattr(result, 'cpu_seconds', None) is not None else 'n/a',
+                            f"{result.peak_rss_kb // 1024} MB" if getattr(result, 'peak_rss_kb', None) else 'n/a')
+
+            app.logger.debug("Script execution finished. Return code: %s", result.returncode)
             # Log stdout/stderr cautiously (limit size)
             if result.stdout:
-                app.logger.debug(f"Script stdout (limited):\n{result.stdout[:1000]}")
-            if result.stderr:
+                app.logger.debug("Script stdout (limited):\n%s", result.stdout[:1000])
+            if result.stderr and result.returncode == 0:
                 # Treat stderr as a potential error/warning
-                app.logger.warning(f"Script stderr (limited):\n{result.stderr[:1000]}")
+                app.logger.warning("Script stderr (limited):\n%s", result.stderr[:1000])
 
+            script_stderr = result.stderr or ''
             if result.returncode != 0:
-                app.logger.error(f"Generated script execution failed with return code {result.returncode}.")
                 # Avoid sending detailed stderr to client unless it's specifically sanitized/allowed
-                # Potentially include stderr snippet in server logs for debugging
-                app.logger.error(f"Script stderr detail: {result.stderr}")
-                raise ValueError(f"Script execution failed (code: {result.returncode})")
+                # One record with the end of stderr, where the traceback's actual error is
+                app.logger.error("Generated script execution failed with return code %s. Script stderr (last %d chars):\n%s",
+                                 result.returncode, STDERR_LOG_CHARS, result.stderr[-STDERR_LOG_CHARS:])
+                limit = getattr(result, 'limit', None) # e.g. 'memory limit', 'cpu time limit', 'signal SIGSEGV'
+                failure_reason = 'resource_limit' if limit and 'limit' in limit else 'script_error'
+                raise ValueError(f"Script execution failed ({limit or f'code: {result.returncode}'})")
 
             # --- Find, Validate, and Move Output File ---
             found_expected_file = False
@@ -718,6 +1117,7 @@ def generate_file():
                          # Clean up the large file before raising
                          try: os.remove(temp_output_path)
                          except OSError: pass
+                         failure_reason = 'invalid_output'
                          raise ValueError(f"Generated file size exceeds limit ({MAX_FILE_SIZE_MB} MB)")
                     elif file_size == 0:
                          app.logger.warning(f"Generated file '{expected_name}' is empty.")
@@ -725,6 +1125,7 @@ def generate_file():
                          # For now, treat as error as it's likely unintentional
                          try: os.remove(temp_output_path)
                          except OSError: pass
+                         failure_reason = 'invalid_output'
                          raise ValueError("Generated file is empty")
 
                     # Generate a unique final filename within the session directory
@@ -747,8 +1148,10 @@ def generate_file():
                         app.logger.error(f"Could not create safe destination path or path escaped base directory for: {final_filename} in {session_dir}")
                         raise ValueError("Invalid destination path generated")
 
+                    OUTPUT_FILE_BYTES.observe(file_size)
                     app.logger.info(f"Moving expected output file '{expected_name}' to final location: {dest_path}")
-                    shutil.move(temp_output_path, dest_path) # Move from exec_temp_dir to session_dir
+                    with _timed_stage('file_move'):
+                        shutil.move(temp_output_path, dest_path) # Move from exec_temp_dir to session_dir
                     generated_file_path = dest_path # Store the final path
                     file_moved = True
                     found_expected_file = True
@@ -763,76 +1166,930 @@ def generate_file():
                     app.logger.error(f"Contents of execution directory: {dir_contents}")
                 except OSError as list_err:
                     app.logger.error(f"Could not list execution directory contents: {list_err}")
+                failure_reason = 'missing_output'
                 raise ValueError("Script did not create the expected output file")
 
         except subprocess.TimeoutExpired:
-            app.logger.error(f"Generated script timed out after {app.config['EXECUTION_TIMEOUT']} seconds.")
+            app.logger.error(f"Generated script timed out after {timeout:g} seconds.")
             # Attempt cleanup of the session directory if timeout occurred
             shutil.rmtree(session_dir, ignore_errors=True)
-            return jsonify({"error": "Document generation timed out"}), 504 # 504 Gateway Timeout might be suitable
+            raise DocumentGenerationError("Document generation timed out", 504, reason='timeout') # 504 Gateway Timeout might be suitable
         except (ValueError, RuntimeError, OSError) as script_err: # Catch specific errors from execution/validation
             app.logger.error(f"Error during script execution or file handling: {script_err}", exc_info=True)
             # Attempt cleanup of the session directory on error
             shutil.rmtree(session_dir, ignore_errors=True)
             # Return specific error message if it's user-safe, otherwise generic
             user_error_message = str(script_err) if isinstance(script_err, ValueError) else "Failed to create or save the document"
-            return jsonify({"error": user_error_message}), 500
+            raise DocumentGenerationError(user_error_message, 500, reason=failure_reason,
+                                          diagnostics=f"{script_err}\n{script_stderr}".strip())
         except Exception as e: # Catch-all for unexpected errors
             app.logger.error(f"Unexpected error during script execution phase: {e}", exc_info=True)
             # Attempt cleanup
             shutil.rmtree(session_dir, ignore_errors=True)
             # Generic error to client
-            return jsonify({"error": "An unexpected error occurred during document creation"}), 500
+            raise DocumentGenerationError("An unexpected error occurred during document creation", 500)
         # The 'finally' block for the tempfile.TemporaryDirectory handles cleanup of exec_temp_dir
 
-    # --- Success Response ---
+    # --- Success ---
     if file_moved and generated_file_path and final_filename:
-        # Construct the download URL relative path (session_id/filename)
-        relative_download_path = f"{session_id}/{final_filename}"
-        app.logger.info(f"Successfully generated file: {generated_file_path}. Download URL segment: {relative_download_path}")
-        return jsonify({
-            # The download URL now needs to include the session ID part
-            "download_url": f"/download/{relative_download_path}",
-            "filename": final_filename # Return the simple filename for display
-        }), 200
+        app.logger.info(f"Successfully generated file: {generated_file_path}")
+        return session_id, final_filename
     else:
         # This state should ideally not be reachable if logic above is correct
         app.logger.error("Reached end of generation process without a valid file state (file_moved=%s, path=%s, name=%s).",
                          file_moved, generated_file_path, final_filename)
         # Attempt cleanup
         shutil.rmtree(session_dir, ignore_errors=True)
-        return jsonify({"error": "An unexpected error occurred during file finalization"}), 500
+        raise DocumentGenerationError("An unexpected error occurred during file finalization", 500)
+
+
+def new_session_dir(session_id):
+    """Directory a new session's output is written to (sharded unless SHARDED_STORAGE is off)."""
+    return storage.session_dir(app.config['GENERATED_FILES_DIR'], session_id, app.config['SHARDED_STORAGE'])
+
+
+def publish_cached_artifact(cached_path):
+    """
+    Links a previously rendered output file into a fresh session directory without running anything.
+    Returns (session_id, final_filename).
+    """
+    session_id = uuid.uuid4()
+    structured_logging.bind(session_id=session_id)
+    session_dir = new_session_dir(session_id)
+    final_filename = os.path.basename(cached_path)
+    dest_path = safe_join(session_dir, final_filename)
+    if not dest_path or final_filename not in app.config['EXPECTED_OUTPUT_FILENAMES']:
+        raise OSError(f"Refusing to publish unexpected cached file: {cached_path}")
+    os.makedirs(session_dir, exist_ok=True)
+    try:
+        method = link_or_copy(cached_path, dest_path)
+    except OSError:
+        shutil.rmtree(session_dir, ignore_errors=True)
+        raise
+    app.logger.info(f"Served cached artifact via {method}: {dest_path}")
+    return session_id, final_filename
+
+
+def render_document_ir(document, stage='render'):
+    """
+    Renders a validated document tree (document_ir.py) in this process into a fresh session directory.
+    Returns (session_id, final_filename).
+    """
+    session_id = uuid.uuid4()
+    structured_logging.bind(session_id=session_id)
+    session_dir = new_session_dir(session_id)
+    final_filename = document_ir.output_filename(document)
+    os.makedirs(session_dir, exist_ok=True)
+    # Render under a temporary name so a half-written file is never downloadable
+    temp_path = os.path.join(session_dir, f".{final_filename}.partial")
+    try:
+        with _timed_stage(stage):
+            document_ir.render(document, temp_path)
+        os.replace(temp_path, os.path.join(session_dir, final_filename))
+    except Exception as e:
+        shutil.rmtree(session_dir, ignore_errors=True)
+        app.logger.error(f"Rendering {final_filename} failed: {e}", exc_info=True)
+        raise DocumentGenerationError("An unexpected error occurred while rendering the document", 500, reason='render_error')
+    OUTPUT_FILE_BYTES.observe(os.path.getsize(os.path.join(session_dir, final_filename)))
+    app.logger.info(f"Rendered document tree to {final_filename}")
+    return session_id, final_filename
+
+
+def render_document_template(template_name, content):
+    """
+    Fills a template (doc_templates.py) with `content` and renders it in this process: no AI call, no script.
+    Returns (session_id, final_filename).
+    """
+    try:
+        document = doc_templates.build(template_name, content)
+    except doc_templates.TemplateError as e:
+        app.logger.warning(f"Content rejected by template '{template_name}': {e}")
+        raise DocumentGenerationError(f"Invalid content for template '{template_name}': {e}", 400, reason='invalid_template_content')
+    session_id, final_filename = render_document_ir(document, stage='template_render')
+    TEMPLATE_RENDERS.inc(template=template_name)
+    return session_id, final_filename
+
+
+def generate_document(user_prompt: str, on_event=None, template=None, content=None, mode=None) -> dict:
+    """
+    Runs the whole pipeline (AI generation, validation, execution) for one prompt.
+    Returns the JSON payload for a successful response, raises DocumentGenerationError otherwise.
+    `on_event(event, data)` is called at every stage; it may raise GenerationCancelled to stop early.
+    With structured `content`, a matching template (named by `template` or picked by
+    doc_templates.classify) is rendered directly instead. `mode` ('code' or 'ir') overrides GENERATION_MODE.
+    """
+    try:
+        payload = _generate_document(user_prompt, on_event, template, content, mode)
+    except DocumentGenerationError as e:
+        GENERATIONS.inc(outcome='failure')
+        GENERATION_FAILURES.inc(reason=e.reason)
+        raise
+    except Exception:
+        GENERATIONS.inc(outcome='failure')
+        GENERATION_FAILURES.inc(reason='internal')
+        raise
+    GENERATIONS.inc(outcome='success')
+    return payload
+
+
+def _model_id():
+    """Identifies the backend in cache keys: replayed responses must never be served from (or into) the real model's entries."""
+    if app.config['LLM_BACKEND'] == 'gemini':
+        return app.config['GEMINI_MODEL_NAME']
+    return f"{app.config['LLM_BACKEND']}:{app.config['LLM_REPLAY_CORPUS']}"
+
+
+# Failures that are the script's own fault: cached code that hits one of these is discarded
+CODE_FAULT_REASONS = frozenset({'validation_failed', 'script_error', 'resource_limit', 'missing_output', 'invalid_output'})
+
+def _generate_document(user_prompt, on_event, template=None, content=None, mode=None):
+    # --- Template Fast Path ---
+    if content is not None:
+        template_name = template
+        if template_name is None and app.config['TEMPLATE_FAST_PATH']:
+            template_name = doc_templates.classify(user_prompt, content)
+        if template_name is not None:
+            _emit(on_event, 'template_matched', template=template_name)
+            session_id, final_filename = render_document_template(template_name, content)
+            return finish_session(session_id, final_filename)
+        # No template fits: the model lays out the supplied content instead
+        app.logger.info("No template matches the supplied content, falling back to AI generation.")
+        user_prompt = f"{user_prompt or 'Create a document'}\n\nUse this content (JSON):\n{json.dumps(content, ensure_ascii=False)}"
+
+    if (mode or app.config['GENERATION_MODE']) == 'ir':
+        return _generate_document_ir(user_prompt, on_event)
+
+    # --- Generated-Code Cache ---
+    # Retried or repeated prompts (e.g. from the websocket client) reuse code that already produced a document
+    code_cache = get_code_cache()
+    cache_key = hit_key = None
+    if code_cache is not None:
+        cache_key, hit_key, generated_code = _code_cache_lookup(code_cache, user_prompt, SYSTEM_PROMPT)
+        if generated_code is not None:
+            app.logger.info(f"Code cache hit ({hit_key[:12]}), skipping AI request.")
+            _emit(on_event, 'code_cache_hit')
+            try:
+                session_id, final_filename = _validate_and_execute(generated_code, on_event)
+            except DocumentGenerationError as e:
+                if e.reason not in CODE_FAULT_REASONS:
+                    raise # Cancelled, overloaded or timed out: says nothing about the cached code
+                # Don't keep serving code that no longer produces a document; ask the AI for new code instead
+                app.logger.warning(f"Cached code failed ({e.reason}), discarding it and generating new code.")
+                _code_cache_discard(code_cache, hit_key, SYSTEM_PROMPT)
+                hit_key = None
+            else:
+                # Code reused for a near-duplicate prompt is also stored under this prompt's key, so its repeats hit exactly
+                if hit_key != cache_key:
+                    _code_cache_store(code_cache, cache_key, generated_code, user_prompt, SYSTEM_PROMPT)
+                return finish_session(session_id, final_filename)
+
+    # --- AI Code Generation ---
+    if get_model() is None:
+         app.logger.error("AI model not configured or failed to initialize. Cannot generate code.")
+         # 503 Service Unavailable is appropriate if the AI backend is down/unconfigured
+         raise DocumentGenerationError("AI service not available", 503, reason='llm_unavailable')
+
+    if app.config['SPECULATIVE_CANDIDATES'] > 1:
+        return _generate_document_speculatively(user_prompt, on_event, code_cache)
+
+    _emit(on_event, 'llm_started')
+    on_chunk = (lambda text: _emit(on_event, 'llm_chunk', text=text)) if on_event is not None else None
+    generated_code = request_generated_code(user_prompt, on_chunk=on_chunk)
+
+    # --- Validation and Execution, with Repair ---
+    # Fresh code that fails validation or execution goes back to the model with the failure
+    # (see repair.py) instead of failing the request, within REPAIR_ATTEMPTS and REPAIR_BUDGET
+    repair = None
+    while True:
+        try:
+            session_id, final_filename = _validate_and_execute(
+                generated_code, on_event, max_timeout=repair.remaining() if repair is not None else None)
+            break
+        except DocumentGenerationError as e:
+            if repair is not None:
+                REPAIRS.inc(reason=repair.last_reason, outcome='failed')
+            if isinstance(e, GenerationCancelled) or app.config['REPAIR_ATTEMPTS'] <= 0:
+                raise
+            if repair is None:
+                repair = RepairSession(remove_html_tags(user_prompt), app.config['REPAIR_ATTEMPTS'], app.config['REPAIR_BUDGET'])
+            if not repair.can_repair(e.reason):
+                raise
+            generated_code = _repair_generated_code(repair, generated_code, e, on_event)
+            if not repair.can_run():
+                # The repair request used up the budget: report why the script failed, not a run without time left
+                app.logger.warning("Repair budget exhausted before the repaired script could run, reporting the original failure.")
+                REPAIRS.inc(reason=repair.last_reason, outcome='failed')
+                raise e
+    if repair is not None:
+        REPAIRS.inc(reason=repair.last_reason, outcome='succeeded')
+        app.logger.info(f"Script repaired after {repair.rounds} round(s).")
+
+    # Only code that validated *and* produced a document is worth caching
+    if code_cache is not None:
+        _code_cache_store(code_cache, cache_key, generated_code, user_prompt, SYSTEM_PROMPT)
+
+    return finish_session(session_id, final_filename)
+
+
+def _validate_and_execute(generated_code, on_event, max_timeout=None):
+    """Validates a script and runs it (or reuses its cached output). Returns (session_id, final_filename)."""
+    # --- Code Validation ---
+    app.logger.info("Validating generated code...")
+    with _timed_stage('validation'):
+        validation = validate_generated_code(generated_code)
+    if not validation:
+        app.logger.warning("Generated code failed validation.")
+        # Do not expose details of validation failure to the client
+        raise DocumentGenerationError("Generated code is invalid or potentially unsafe", 400, reason='validation_failed',
+                                      diagnostics=f"Rejected by the server's code checks ({validation.rule}): {validation.detail}")
+    app.logger.info("Code validation successful.")
+    _emit(on_event, 'validated')
+
+    # --- Rendered-Artifact Cache ---
+    # The same validated script always renders the same document: reuse the earlier output file
+    artifact_cache = get_artifact_cache()
+    code_hash = artifact_key(generated_code)
+    cached_artifact = artifact_cache.lookup(code_hash) if artifact_cache is not None else None
+    if cached_artifact:
+        try:
+            session_id, final_filename = publish_cached_artifact(cached_artifact)
+            CACHE_HITS.inc(cache='artifact')
+            return session_id, final_filename
+        except OSError as e:
+            app.logger.warning(f"Could not reuse cached artifact {cached_artifact}, executing script instead: {e}")
+
+    _emit(on_event, 'execution_started')
+    session_id, final_filename = execute_generated_code(generated_code, max_timeout=max_timeout)
+    if artifact_cache is not None:
+        try:
+            artifact_cache.store(code_hash, os.path.join(new_session_dir(session_id), final_filename))
+        except OSError as e:
+            app.logger.warning(f"Could not add output to artifact cache: {e}")
+    return session_id, final_filename
+
+
+def _repair_generated_code(repair, generated_code, error, on_event):
+    """
+    One repair round: sends the failed script and its failure report back to the model and returns
+    the corrected script. If the model cannot be reached, the original failure is what gets reported.
+    """
+    _emit(on_event, 'repair_started', attempt=repair.rounds + 1, reason=error.reason)
+    app.logger.info(f"Asking the AI to repair the script (round {repair.rounds + 1}/{repair.max_rounds}, {error.reason}).")
+    contents = repair.next_request(generated_code, error.reason, error.diagnostics or error.message)
+    try:
+        return request_generated_code(None, contents=contents,
+                                      deadline=min(app.config['LLM_DEADLINE'], repair.remaining()))
+    except GenerationCancelled:
+        raise
+    except DocumentGenerationError as repair_error:
+        app.logger.warning(f"Repair request failed ({repair_error.reason}), reporting the original failure.")
+        REPAIRS.inc(reason=error.reason, outcome='failed')
+        raise error
+
+
+def _speculative_candidate(index, race, user_prompt, on_event):
+    """One speculative attempt: generate, validate and execute. Only the race winner keeps its session."""
+    def emit(event, **data):
+        _emit(on_event, event, candidate=index, **data)
+
+    emit('llm_started')
+    on_chunk = (lambda text: emit('llm_chunk', text=text)) if on_event is not None else None
+    generated_code = request_generated_code(user_prompt, on_chunk=on_chunk, check=race.check)
+    race.check()
+    with _timed_stage('validation'):
+        validation = validate_generated_code(generated_code)
+    if not validation:
+        app.logger.warning(f"Candidate {index}: generated code failed validation.")
+        raise DocumentGenerationError("Generated code is invalid or potentially unsafe", 400, reason='validation_failed')
+    emit('validated')
+    race.check() # Don't take an execution slot once another candidate has a document
+    emit('execution_started')
+    session_id, final_filename = execute_generated_code(generated_code)
+    if not race.claim(index):
+        # Finished at the same time as the winner: drop this document (not yet known to the janitor)
+        shutil.rmtree(new_session_dir(session_id), ignore_errors=True)
+        raise speculative.Cancelled()
+    return generated_code, session_id, final_filename
+
+
+def _generate_document_speculatively(user_prompt, on_event, code_cache):
+    """
+    Runs SPECULATIVE_CANDIDATES generations of the prompt at once and keeps the first that
+    validates and produces a document; the rest stop at their next chunk or stage boundary.
+    Fails (with the earliest candidate's error) only if every candidate fails.
+    """
+    candidates = app.config['SPECULATIVE_CANDIDATES']
+    app.logger.info(f"Starting {candidates} speculative generations.")
+    started = time.perf_counter()
+    try:
+        winner, (generated_code, session_id, final_filename), failed = speculative.race(
+            lambda index, race: _speculative_candidate(index, race, user_prompt, on_event),
+            candidates,
+            failures=(DocumentGenerationError,),
+            abort_on=(GenerationCancelled,), # The streaming client went away: stop every candidate
+        )
+    except DocumentGenerationError as e:
+        if isinstance(e, GenerationCancelled):
+            raise
+        SPECULATIVE_OUTCOMES.inc(candidates, outcome='failed')
+        app.logger.warning(f"All {candidates} speculative generations failed; reporting the first error ({e.reason}).")
+        raise
+    SPECULATIVE_OUTCOMES.inc(outcome='won')
+    SPECULATIVE_OUTCOMES.inc(len(failed), outcome='failed')
+    SPECULATIVE_OUTCOMES.inc(candidates - 1 - len(failed), outcome='cancelled')
+    app.logger.info(f"Candidate {winner} won after {time.perf_counter() - started:.2f}s "
+                    f"({len(failed)} failed: {', '.join(e.reason for e in failed.values()) or 'none'}).")
+
+    artifact_cache = get_artifact_cache()
+    if artifact_cache is not None:
+        try:
+            artifact_cache.store(artifact_key(generated_code), os.path.join(new_session_dir(session_id), final_filename))
+        except OSError as e:
+            app.logger.warning(f"Could not add output to artifact cache: {e}")
+    if code_cache is not None:
+        _code_cache_store(code_cache, None, generated_code, user_prompt, SYSTEM_PROMPT)
+    return finish_session(session_id, final_filename)
+
+
+def _generate_document_ir(user_prompt, on_event):
+    """IR mode: the model returns a document tree that is checked and rendered in-process (no script, no sandbox)."""
+    # Cached trees share the code cache; the IR system prompt in the key keeps them apart from scripts
+    code_cache = get_code_cache()
+    cache_key = hit_key = None
+    ir_text = None
+    if code_cache is not None:
+        cache_key, hit_key, ir_text = _code_cache_lookup(code_cache, user_prompt, document_ir.IR_SYSTEM_PROMPT)
+        if ir_text is not None:
+            app.logger.info(f"Code cache hit ({hit_key[:12]}) for document tree, skipping AI request.")
+            _emit(on_event, 'code_cache_hit')
+    from_cache = ir_text is not None
+
+    if ir_text is None:
+        if get_ir_model() is None:
+            app.logger.error("AI model not configured or failed to initialize. Cannot generate a document tree.")
+            raise DocumentGenerationError("AI service not available", 503, reason='llm_unavailable')
+        _emit(on_event, 'llm_started')
+        on_chunk = (lambda text: _emit(on_event, 'llm_chunk', text=text)) if on_event is not None else None
+        ir_text = request_generated_code(user_prompt, on_chunk=on_chunk, mode='ir')
+
+    # --- Document Tree Validation ---
+    try:
+        with _timed_stage('validation'):
+            document = document_ir.parse(ir_text)
+    except document_ir.IRError as e:
+        app.logger.warning(f"AI returned an invalid document tree: {e}")
+        if from_cache:
+            _code_cache_discard(code_cache, hit_key, document_ir.IR_SYSTEM_PROMPT)
+        raise DocumentGenerationError("AI returned an invalid document structure", 400, reason='invalid_ir')
+    _emit(on_event, 'validated')
+
+    _emit(on_event, 'render_started')
+    session_id, final_filename = render_document_ir(document)
+    if code_cache is not None and hit_key != cache_key:
+        _code_cache_store(code_cache, cache_key, ir_text, user_prompt, document_ir.IR_SYSTEM_PROMPT)
+    return finish_session(session_id, final_filename)
+
+
+def finish_session(session_id, final_filename):
+    """Registers a finished session with the janitor and builds the response payload."""
+    session_janitor = get_session_janitor()
+    if session_janitor is not None:
+        try:
+            # Output hard-linked from the artifact cache doesn't count: deleting the session frees none of it
+            size = owned_bytes(new_session_dir(session_id))
+            session_janitor.register(session_id, storage.session_rel_dir(session_id, app.config['SHARDED_STORAGE']), size)
+        except (OSError, sqlite3.Error) as e:
+            app.logger.warning(f"Could not register session {session_id} with the janitor: {e}")
+
+    # Construct the download URL relative path (session_id/filename)
+    relative_download_path = f"{session_id}/{final_filename}"
+    app.logger.info(f"Download URL segment: {relative_download_path}")
+    return {
+        # The download URL now needs to include the session ID part
+        "download_url": f"/download/{relative_download_path}",
+        "filename": final_filename # Return the simple filename for display
+    }
+
+
+def run_generation_job(user_prompt, template=None, content=None, mode=None):
+    """Job handler for the async queue: maps pipeline errors to the same (payload, status) pairs as the sync route."""
+    try:
+        return generate_document(user_prompt, template=template, content=content, mode=mode), 200
+    except DocumentGenerationError as e:
+        return {"error": e.message}, e.status_code
+    except Exception as e:
+        app.logger.error(f"Unexpected error in generation job: {e}", exc_info=True)
+        return {"error": "An unexpected error occurred during document creation"}, 500
+
+
+# --- Generated-Code Cache ---
+_code_cache = None
+_code_cache_lock = threading.Lock()
+
+def get_code_cache():
+    """Returns the process-wide generated-code cache, or None if caching is disabled or unavailable."""
+    global _code_cache
+    if _code_cache is None and app.config['CODE_CACHE_ENABLED']:
+        with _code_cache_lock:
+            if _code_cache is None:
+                try:
+                    _code_cache = CodeCache(
+                        app.config['CODE_CACHE_PATH'],
+                        ttl=app.config['CODE_CACHE_TTL'],
+                        max_entries=app.config['CODE_CACHE_MAX_ENTRIES'],
+                        max_bytes=app.config['CODE_CACHE_MAX_BYTES'],
+                        logger=app.logger,
+                    )
+                except Exception as e:
+                    # A broken cache must never take generation down with it
+                    app.logger.error(f"Could not open code cache at {app.config['CODE_CACHE_PATH']}: {e}")
+                    app.config['CODE_CACHE_ENABLED'] = False
+    return _code_cache
+
+
+# --- Near-Duplicate Prompt Index ---
+# Cache keys are built from normalize_prompt(), which already folds formatting, dates, filler words
+# and punctuation; the opt-in index additionally finds prompts that only differ in word order (prompt_index.py).
+_prompt_index = None
+_prompt_index_lock = threading.Lock()
+
+def get_prompt_index():
+    """
+    Returns the process-wide near-duplicate index, warm-started from the most recently used
+    cache entries, or None if it or the code cache is disabled.
+    """
+    global _prompt_index
+    if _prompt_index is None and app.config['NEAR_DUPLICATE_THRESHOLD'] > 0:
+        code_cache = get_code_cache()
+        if code_cache is None:
+            return None
+        with _prompt_index_lock:
+            if _prompt_index is None:
+                index = NearDuplicateIndex(app.config['NEAR_DUPLICATE_THRESHOLD'], app.config['NEAR_DUPLICATE_INDEX_SIZE'])
+                try:
+                    rows = code_cache.recent_prompts(app.config['NEAR_DUPLICATE_INDEX_SIZE'])
+                except sqlite3.Error as e:
+                    app.logger.warning(f"Could not load recent prompts into the near-duplicate index: {e}")
+                    rows = []
+                for namespace, prompt, key in reversed(rows): # Oldest first, so the most recent stay on eviction
+                    index.add(namespace, prompt, key)
+                app.logger.debug("Near-duplicate index loaded with %d prompts", len(rows))
+                _prompt_index = index
+    return _prompt_index
+
+
+def _cache_namespace(system_prompt):
+    """Entries are only comparable when generated by the same model with the same system prompt."""
+    return make_cache_key('', _model_id(), system_prompt)[:16]
+
+
+def _code_cache_lookup(code_cache, user_prompt, system_prompt):
+    """
+    Looks a prompt up in the code cache: its own key first, then the most similar indexed prompt.
+    Returns (cache_key, hit_key, cached): the prompt's key, the key the cached text came from
+    (None on a miss) and the text (None on a miss).
+    """
+    normalized = normalize_prompt(user_prompt)
+    cache_key = make_cache_key(normalized, _model_id(), system_prompt)
+    cached = code_cache.get(cache_key)
+    if cached is not None:
+        CACHE_HITS.inc(cache='code')
+        return cache_key, cache_key, cached
+
+    prompt_index = get_prompt_index()
+    if prompt_index is None:
+        return cache_key, None, None
+    namespace = _cache_namespace(system_prompt)
+    match = prompt_index.lookup(namespace, normalized)
+    if match is None:
+        return cache_key, None, None
+    near_key, similarity = match
+    cached = code_cache.get(near_key)
+    if cached is None:
+        prompt_index.discard(namespace, near_key) # Expired or evicted since it was indexed
+        return cache_key, None, None
+    app.logger.info(f"Near-duplicate prompt (similarity {similarity:.2f}) reuses cache entry {near_key[:12]}.")
+    CACHE_HITS.inc(cache='code_near_duplicate')
+    return cache_key, near_key, cached
+
+
+def _code_cache_store(code_cache, cache_key, text, user_prompt, system_prompt):
+    """Caches `text` for the prompt (under `cache_key`, or the key computed here) and indexes the prompt."""
+    normalized = normalize_prompt(user_prompt)
+    cache_key = cache_key or make_cache_key(normalized, _model_id(), system_prompt)
+    namespace = _cache_namespace(system_prompt)
+    code_cache.put(cache_key, text, prompt=normalized, namespace=namespace)
+    prompt_index = get_prompt_index()
+    if prompt_index is not None:
+        prompt_index.add(namespace, normalized, cache_key)
+
+
+def _code_cache_discard(code_cache, key, system_prompt):
+    """Drops a cache entry and the indexed prompts that led to it."""
+    code_cache.discard(key)
+    if _prompt_index is not None:
+        _prompt_index.discard(_cache_namespace(system_prompt), key)
+
+
+# --- Rendered-Artifact Cache ---
+_artifact_cache = None
+_artifact_cache_lock = threading.Lock()
+
+def get_artifact_cache():
+    """Returns the process-wide rendered-artifact cache, or None if disabled or unavailable."""
+    global _artifact_cache
+    if _artifact_cache is None and app.config['ARTIFACT_CACHE_ENABLED']:
+        with _artifact_cache_lock:
+            if _artifact_cache is None:
+                try:
+                    _artifact_cache = ArtifactCache(
+                        app.config['ARTIFACT_CACHE_DIR'],
+                        max_bytes=app.config['ARTIFACT_CACHE_MAX_BYTES'],
+                        ttl=app.config['ARTIFACT_CACHE_TTL'],
+                        logger=app.logger,
+                    )
+                except Exception as e:
+                    app.logger.error(f"Could not open artifact cache at {app.config['ARTIFACT_CACHE_DIR']}: {e}")
+                    app.config['ARTIFACT_CACHE_ENABLED'] = False
+    return _artifact_cache
+
+
+# --- Session Janitor ---
+_session_janitor = None
+_session_janitor_lock = threading.Lock()
+
+def get_session_janitor():
+    """Returns the process-wide session janitor (starting its background thread), or None if disabled."""
+    global _session_janitor
+    if _session_janitor is None and app.config['JANITOR_ENABLED']:
+        with _session_janitor_lock:
+            if _session_janitor is None:
+                try:
+                    _session_janitor = SessionJanitor(
+                        app.config['GENERATED_FILES_DIR'],
+                        app.config['JANITOR_INDEX_PATH'],
+                        ttl=app.config['SESSION_TTL'],
+                        max_bytes=app.config['SESSION_QUOTA_BYTES'],
+                        interval=app.config['JANITOR_INTERVAL'],
+                        logger=app.logger,
+                    )
+                    _session_janitor.start()
+                    atexit.register(_session_janitor.stop)
+                except Exception as e:
+                    app.logger.error(f"Could not start session janitor: {e}", exc_info=True)
+                    app.config['JANITOR_ENABLED'] = False
+    return _session_janitor
+
+
+# --- Async Job Queue ---
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+def get_job_queue():
+    """Returns the process-wide async job queue, starting its executor threads on first use."""
+    global _job_queue
+    if _job_queue is None:
+        with _job_queue_lock:
+            if _job_queue is None:
+                _job_queue = JobQueue(
+                    run_generation_job,
+                    workers=app.config['ASYNC_JOB_WORKERS'],
+                    max_queued=app.config['ASYNC_JOB_QUEUE_SIZE'],
+                    result_ttl=app.config['ASYNC_JOB_RESULT_TTL'],
+                    logger=app.logger,
+                )
+    return _job_queue
+
+
+# --- Flask Routes ---
+@app.route('/')
+def index():
+    """Renders the main HTML page."""
+    return render_template('index.html')
+
+# Limit prompt length server-side as well
+MAX_PROMPT_LENGTH = 1000000 # Increased limit slightly
+
+def clean_prompt(value):
+    """Returns the trimmed prompt, or None if `value` is not a non-empty string."""
+    if not value or not isinstance(value, str) or not value.strip():
+        return None
+    return value[:MAX_PROMPT_LENGTH].strip() # Trim whitespace too
+
+def parse_prompt_request():
+    """
+    Validates the JSON body of a generation request.
+    Returns (params, None) on success or (None, error_response) to be returned by the route;
+    params holds 'user_prompt' plus the optional 'template' and 'content' of the template fast path
+    and the generation 'mode' ('code' or 'ir').
+    """
+    # --- Input Validation ---
+    if not request.is_json:
+        app.logger.warning("Invalid content type: Expected application/json")
+        return None, (jsonify({"error": "Invalid content type, requires application/json"}), 400)
+
+    data = request.get_json()
+    if not data:
+         app.logger.warning("Empty JSON payload received")
+         return None, (jsonify({"error": "Empty request body"}), 400)
+
+    # Optional structured content for the template fast path (see doc_templates.py)
+    template = data.get('template')
+    content = data.get('content')
+    if template is not None and template not in doc_templates.TEMPLATES:
+        app.logger.warning(f"Unknown template requested: {template!r}")
+        return None, (jsonify({"error": f"Unknown template (available: {', '.join(sorted(doc_templates.TEMPLATES))})"}), 400)
+    if content is not None and not isinstance(content, dict):
+        return None, (jsonify({"error": "'content' must be a JSON object"}), 400)
+    if template is not None and content is None:
+        content = {} # A bare template name renders the template's defaults
+
+    mode = data.get('mode')
+    if mode is not None and mode not in ('code', 'ir'):
+        return None, (jsonify({"error": "'mode' must be 'code' or 'ir'"}), 400)
+
+    # The prompt may be left out when structured content is supplied
+    user_prompt = clean_prompt(data.get('prompt'))
+    if user_prompt is None and content is None:
+        app.logger.warning("Missing, invalid, or empty 'prompt' in request JSON")
+        return None, (jsonify({"error": "Missing, invalid, or empty 'prompt' field"}), 400)
+
+    if user_prompt:
+        app.logger.debug("Processing prompt (first 100 chars): %s...", user_prompt[:100])
+    return {'user_prompt': user_prompt, 'template': template, 'content': content, 'mode': mode}, None
+
+
+@app.route('/generate-file', methods=['POST'])
+# @csrf.exempt # Keep CSRF protection unless specifically handled otherwise (e.g., API keys)
+# If using API Key auth primarily, CSRF might be less critical *for this specific endpoint*,
+# but it's safer to keep it unless it interferes with the client implementation.
+# Let's assume API key is the primary auth here, so exempting for simplicity with non-browser clients.
+@csrf.exempt # Exempt CSRF for API-key protected endpoint often used by scripts/non-browsers
+# @require_api_key # Apply the API key check decorator
+def generate_file():
+    """
+    Handles the POST request to generate a document file using AI-generated code.
+    Requires a valid API Key and JSON payload with a 'prompt', and/or structured 'content'
+    (optionally with a 'template' name, see GET /templates) for the in-process template fast path.
+    'mode': 'ir' asks the model for a JSON document tree instead of a script (see document_ir.py).
+    With ?async=1 the work is queued and a job id is returned immediately (poll GET /jobs/<job_id>).
+    """
+    app.logger.info(f"File generation request received from {request.remote_addr}")
+
+    params, error_response = parse_prompt_request()
+    if error_response:
+        return error_response
+
+    # --- Asynchronous Mode ---
+    if request.args.get('async', '').lower() in ('1', 'true', 'yes'):
+        try:
+            job = get_job_queue().submit(params['user_prompt'], params['template'], params['content'], params['mode'])
+        except JobQueueFull as e:
+            app.logger.warning(f"Async job queue full, rejecting request from {request.remote_addr}")
+            response = jsonify({"error": "Server is busy, please retry later"})
+            response.headers['Retry-After'] = str(e.retry_after)
+            return response, 503
+        app.logger.info(f"Queued generation job {job.id}")
+        response = jsonify(job.to_dict())
+        response.headers['Location'] = f"/jobs/{job.id}"
+        return response, 202
+
+    try:
+        return jsonify(generate_document(**params)), 200
+    except DocumentGenerationError as e:
+        response = jsonify({"error": e.message})
+        if e.retry_after:
+            response.headers['Retry-After'] = str(e.retry_after)
+        return response, e.status_code
+
+
+@app.route('/generate-file/stream', methods=['POST'])
+@csrf.exempt # Same reasoning as /generate-file
+# @require_api_key
+def generate_file_stream():
+    """
+    Streaming variant of /generate-file. Emits pipeline stages as Server-Sent Events
+    (or newline-delimited JSON with ?format=ndjson) while the document is being built:
+    accepted, template_matched {template}, code_cache_hit, llm_started, llm_chunk {text}, validated,
+    execution_started (or render_started in IR mode), repair_started {attempt, reason} before each repair round,
+    then either done {download_url, filename} or error {error, status_code}.
+    With SPECULATIVE_CANDIDATES > 1 the AI stage events carry a `candidate` index.
+    Closing the connection cancels the pipeline at the next stage boundary / LLM chunk.
+    """
+    app.logger.info(f"Streaming file generation request received from {request.remote_addr}")
+
+    params, error_response = parse_prompt_request()
+    if error_response:
+        return error_response
+
+    ndjson = request.args.get('format', '').lower() == 'ndjson'
+    events = queue.Queue()
+    cancelled = threading.Event()
+
+    def on_event(event, data):
+        if cancelled.is_set():
+            raise GenerationCancelled()
+        events.put((event, data))
+
+    def run_pipeline():
+        try:
+            payload = generate_document(on_event=on_event, **params)
+            events.put(('done', payload))
+        except GenerationCancelled:
+            app.logger.info("Streaming generation cancelled by client.")
+        except DocumentGenerationError as e:
+            events.put(('error', {"error": e.message, "status_code": e.status_code}))
+        except Exception as e:
+            app.logger.error(f"Unexpected error in streaming generation: {e}", exc_info=True)
+            events.put(('error', {"error": "An unexpected error occurred during document creation", "status_code": 500}))
+        finally:
+            events.put(None) # End of stream
+
+    def format_event(event, data):
+        if ndjson:
+            return json.dumps({"event": event, **data}) + "\n"
+        return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+    def stream():
+        # The pipeline runs on its own thread so a slow stage never blocks keep-alives,
+        # and a client disconnect (GeneratorExit here) can be signalled back to it.
+        threading.Thread(target=contextvars.copy_context().run, args=(run_pipeline,), name="docgen-stream", daemon=True).start()
+        try:
+            yield format_event('accepted', {})
+            while True:
+                try:
+                    item = events.get(timeout=app.config['STREAM_KEEPALIVE_INTERVAL'])
+                except queue.Empty:
+                    yield "\n" if ndjson else ": keep-alive\n\n"
+                    continue
+                if item is None:
+                    break
+                yield format_event(*item)
+        finally:
+            cancelled.set()
+
+    response = Response(stream_with_context(stream()),
+                        mimetype='application/x-ndjson' if ndjson else 'text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no' # Stop nginx from buffering the event stream
+    return response
+
+
+@app.route('/generate-batch', methods=['POST'])
+@csrf.exempt # Same reasoning as /generate-file
+# @require_api_key
+def generate_batch():
+    """
+    Generates one document per prompt in {"prompts": [...]}, running up to BATCH_CONCURRENCY
+    pipelines at once (model calls overlap; scripts run on the worker-process pool).
+    Returns per-item results in request order: {index, status_code, download_url, filename}
+    or {index, status_code, error}. With ?format=zip the documents are streamed back as
+    one ZIP archive as they finish, followed by a manifest.json holding the same results.
+    """
+    app.logger.info(f"Batch generation request received from {request.remote_addr}")
+
+    data = request.get_json(silent=True) if request.is_json else None
+    prompts = data.get('prompts') if isinstance(data, dict) else None
+    if not isinstance(prompts, list) or not prompts:
+        app.logger.warning("Missing or empty 'prompts' list in batch request")
+        return jsonify({"error": "Request body must be JSON with a non-empty 'prompts' list"}), 400
+    if len(prompts) > app.config['BATCH_MAX_ITEMS']:
+        return jsonify({"error": f"Too many prompts (maximum {app.config['BATCH_MAX_ITEMS']} per batch)"}), 400
+    prompts = [clean_prompt(prompt) for prompt in prompts]
+    invalid = [index for index, prompt in enumerate(prompts) if prompt is None]
+    if invalid:
+        return jsonify({"error": "Missing, invalid, or empty prompt(s)", "indexes": invalid}), 400
+
+    as_zip = request.args.get('format', '').lower() == 'zip'
+    concurrency = app.config['BATCH_CONCURRENCY']
+    app.logger.info(f"Running batch of {len(prompts)} prompts with concurrency {concurrency} (zip={as_zip})")
+
+    def item_result(index, payload, status):
+        return {"index": index, "status_code": status, **payload}
+
+    if not as_zip:
+        results = [None] * len(prompts)
+        for index, (payload, status) in run_concurrently(run_generation_job, prompts, concurrency):
+            results[index] = item_result(index, payload, status)
+        succeeded = sum(1 for result in results if result['status_code'] == 200)
+        app.logger.info(f"Batch finished: {succeeded}/{len(prompts)} documents generated")
+        return jsonify({"results": results, "succeeded": succeeded, "failed": len(prompts) - succeeded}), 200
+
+    def members():
+        # Documents are added in completion order; the manifest maps them back to prompts
+        results = [None] * len(prompts)
+        for index, (payload, status) in run_concurrently(run_generation_job, prompts, concurrency):
+            results[index] = result = item_result(index, payload, status)
+            if status != 200:
+                continue
+            _, _, session_id, filename = payload['download_url'].split('/', 3)
+            session_dir_path = storage.resolve_session_dir(app.config['GENERATED_FILES_DIR'], session_id)
+            if session_dir_path is None:
+                result.update(status_code=500, error="Generated file disappeared before it could be archived")
+                continue
+            result['archive_name'] = f"{index:04d}_{filename}"
+            yield result['archive_name'], os.path.join(session_dir_path, filename)
+        yield 'manifest.json', json.dumps({"results": results}, indent=2).encode('utf-8')
+
+    response = Response(stream_with_context(iter_zip(members())), mimetype='application/zip')
+    response.headers['Content-Disposition'] = 'attachment; filename=documents.zip'
+    response.headers['X-Accel-Buffering'] = 'no' # Let nginx pass archive chunks through as they are produced
+    return response
+
+
+@app.route('/templates')
+def list_templates():
+    """Lists the document templates of the fast path with their output format and content fields."""
+    return jsonify({
+        name: {"format": template.extension, "fields": sorted(template.fields)}
+        for name, template in doc_templates.TEMPLATES.items()
+    })
+
+
+@app.route('/jobs/<uuid:job_id>')
+def job_status(job_id):
+    """Reports the state (queued/running/done/failed) of an async generation job."""
+    job = get_job_queue().get(str(job_id))
+    if job is None:
+        abort(404, description="Job not found or expired.")
+    return jsonify(job.to_dict()), 200
+
+
+
+@app.route('/stats')
+def stats():
+    """Reports counters of the caches, job queue and worker pool started in this process."""
+    data = {}
+    if _code_cache is not None:
+        data['code_cache'] = _code_cache.stats()
+    if _prompt_index is not None:
+        data['near_duplicate_index'] = _prompt_index.stats()
+    if _artifact_cache is not None:
+        data['artifact_cache'] = _artifact_cache.stats()
+    if _job_queue is not None:
+        data['jobs'] = _job_queue.stats()
+    if _worker_pool is not None:
+        data['worker_pool'] = _worker_pool.stats()
+    if _session_janitor is not None:
+        data['storage'] = _session_janitor.metrics()
+    if _llm_client is not None:
+        data['llm'] = _llm_client.stats()
+    context_cache = getattr(model, 'context_cache', None)
+    if context_cache is not None:
+        data['context_cache'] = context_cache.stats()
+    elif model is not None and app.config['LLM_BACKEND'] == 'gemini':
+        data['context_cache'] = {'active': False, 'unavailable_reason': "disabled (GEMINI_CONTEXT_CACHE_TTL=0)"}
+    if _admission_controller is not None:
+        data['admission'] = _admission_controller.stats()
+    if _cost_model is not None:
+        data['execution_cost'] = _cost_model.stats()
+    data['validator'] = code_validator.stats()
+    if log_queue_handler is not None:
+        data['logging'] = {'queued': log_queue_handler.queue.qsize(), 'dropped': log_queue_handler.dropped}
+    return jsonify(data), 200
+
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus scrape endpoint (text exposition format) for this process."""
+    return Response(REGISTRY.expose(), content_type=METRICS_CONTENT_TYPE)
 
 
 @app.route('/download/<uuid:session_id>/<path:filename>')
 def download_file(session_id, filename):
     """Serves the generated file for download from its session directory."""
     app.logger.info(f"Download request for: {filename} in session {session_id} from {request.remote_addr}")
+    download_started = time.perf_counter()
+    structured_logging.bind(session_id=session_id)
     try:
-        # Construct the path including the session ID directory
-        # Ensure session_id is treated as a string for path joining
+        # Locate the session directory: sharded ab/cd/<uuid>/ first, then the legacy flat <uuid>/
+        # layout so links issued before the migration keep working
         session_dir_name = str(session_id)
+        session_dir_path = storage.resolve_session_dir(app.config['GENERATED_FILES_DIR'], session_id)
+        if session_dir_path is None:
+            app.logger.warning(f"Session directory not found for session {session_dir_name}")
+            abort(404, description="File not found.")
         # safe_join is crucial here to prevent filename from having traversal components
-        # It joins the base directory, the session directory, and the filename safely
-        safe_path = safe_join(app.config['GENERATED_FILES_DIR'], session_dir_name, filename)
+        # It joins the session directory and the filename safely
+        safe_path = safe_join(session_dir_path, filename)
 
         if safe_path is None:
              app.logger.warning(f"Download aborted: safe_join failed for session '{session_id}', filename '{filename}'. Potential path traversal attempt.")
              abort(404, description="File path is invalid.")
 
-        # Check if the file actually exists
-        if not os.path.isfile(safe_path):
+        # Check if the file actually exists (one stat, reused for the ETag below)
+        try:
+            file_stat = os.stat(safe_path)
+        except OSError:
+            file_stat = None
+        if file_stat is None or not stat.S_ISREG(file_stat.st_mode):
             app.logger.warning(f"File not found at path: {safe_path}")
-            # Log if the session directory itself exists for debugging
-            session_dir_path = os.path.join(app.config['GENERATED_FILES_DIR'], session_dir_name)
-            if not os.path.isdir(session_dir_path):
-                app.logger.warning(f"Session directory not found: {session_dir_path}")
-            else:
-                 try:
-                     dir_contents = os.listdir(session_dir_path)
-                     app.logger.warning(f"Contents of session directory {session_dir_name}: {dir_contents}")
-                 except OSError:
-                      app.logger.warning(f"Could not list contents of session directory {session_dir_name}")
+            # Log the session directory contents for debugging
+            try:
+                dir_contents = os.listdir(session_dir_path)
+                app.logger.warning(f"Contents of session directory {session_dir_name}: {dir_contents}")
+            except OSError:
+                 app.logger.warning(f"Could not list contents of session directory {session_dir_name}")
             abort(404, description="File not found.")
 
 
@@ -844,13 +2101,45 @@ def download_file(session_id, filename):
              abort(404, description="File not found (Security restriction).")
 
 
-        app.logger.info(f"Sending file: {safe_path}")
-        return send_file(safe_path, as_attachment=True)
+        # Downloads keep a session alive under the janitor's least-recently-used quota eviction
+        session_janitor = get_session_janitor()
+        if session_janitor is not None:
+            session_janitor.touch(session_id)
+
+        # Strong ETag from the content hash: a retried download of the same file gets a 304, and
+        # Range requests (resumed mobile downloads) are validated against it via If-Range
+        etag = storage.content_etag(abs_safe_path, file_stat)
+        max_age = app.config['DOWNLOAD_CACHE_MAX_AGE']
+
+        accel_prefix = app.config['DOWNLOAD_ACCEL_REDIRECT_PREFIX']
+        if accel_prefix:
+            # Hand the transfer (sendfile, Range) to nginx through an internal redirect
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+            else:
+                rel_path = os.path.relpath(abs_safe_path, abs_generated_dir).replace(os.sep, '/')
+                response = Response(mimetype=mimetypes.guess_type(abs_safe_path)[0] or 'application/octet-stream')
+                response.headers['X-Accel-Redirect'] = accel_prefix.rstrip('/') + '/' + url_quote(rel_path)
+                response.headers.set('Content-Disposition', 'attachment', filename=os.path.basename(abs_safe_path))
+            response.set_etag(etag)
+            response.cache_control.public = True
+            response.cache_control.max_age = max_age
+            app.logger.info(f"Offloading file to proxy: {safe_path}")
+        else:
+            # send_file handles Range/If-None-Match itself and streams through wsgi.file_wrapper,
+            # which servers such as gunicorn implement with sendfile()
+            response = send_file(abs_safe_path, as_attachment=True, conditional=True, etag=etag, max_age=max_age)
+            app.logger.info(f"Sending file: {safe_path} ({response.status_code})")
+        response.cache_control.immutable = True
+        DOWNLOAD_SECONDS.observe(time.perf_counter() - download_started, status=response.status_code)
+        return response
 
     except TypeError as e:
          # Catch potential errors if session_id wasn't a valid UUID string for the route converter
          app.logger.error(f"Invalid session ID format in URL: {session_id}. Error: {e}")
          abort(404, description="Invalid session ID format.")
+    except HTTPException:
+        raise # Let the 404s above through instead of turning them into a 500
     except Exception as e:
         app.logger.error(f"Error during file download for session {session_id}, file {filename}: {e}", exc_info=True)
         abort(500, description="Could not process file download.")
@@ -908,12 +2197,72 @@ def gateway_timeout_error(error):
     return jsonify({"error": "Gateway Timeout", "message": description}), 504
 
 
+# --- App Factory ---
+# Importing this module only defines the app (config, routes, prompts). Process-level setup happens in
+# create_app(), and every heavy client (model, caches, worker pool, janitor, job queue) is created on first
+# use by its get_X() in the process that serves requests. Under gunicorn (see gunicorn.conf.py) the master
+# imports the module and preloads the libraries once; each forked worker then only runs create_app() again.
+PRELOAD_DOCUMENT_MODULES = ('docx', 'pptx', 'reportlab.platypus', 'reportlab.lib.styles') # In-process rendering (document_ir.py)
+
+_app_pid = None
+_app_lock = threading.Lock()
+
+def preload_modules():
+    """
+    Imports the heavy libraries without creating any client, socket or thread, so a forking server
+    can share them copy-on-write with its workers. Returns {module: seconds}.
+    """
+    import importlib
+    names = list(PRELOAD_DOCUMENT_MODULES)
+    if app.config['LLM_BACKEND'] == 'gemini':
+        names.insert(0, 'google.generativeai')
+    timings = {}
+    for name in names:
+        started = time.perf_counter()
+        try:
+            importlib.import_module(name)
+        except ImportError as e:
+            app.logger.warning(f"Could not preload {name}: {e}")
+            continue
+        timings[name] = time.perf_counter() - started
+    app.logger.info(f"Preloaded {', '.join(f'{name} ({seconds:.2f}s)' for name, seconds in timings.items())}")
+    return timings
+
+def create_app(preload=None):
+    """
+    App factory (gunicorn: 'server:create_app()'). Sets up what must not be inherited across a fork
+    (the log listener thread) and the storage directory; runs once per process, so calling it again
+    in a forked worker redoes exactly that. `preload` (default PRELOAD_MODULES) also imports the heavy libraries.
+    """
+    global _app_pid
+    if _app_pid != os.getpid():
+        with _app_lock:
+            if _app_pid != os.getpid():
+                configure_logging()
+                os.makedirs(app.config['GENERATED_FILES_DIR'], exist_ok=True)
+                if app.config['PRELOAD_MODULES'] if preload is None else preload:
+                    preload_modules()
+                _app_pid = os.getpid()
+    return app
+
+def warm_up():
+    """
+    Starts the execution workers and the janitor ahead of the first request. Both do their
+    work in the background: the workers fork their processes, and the janitor thread runs
+    its one-off adoption scan (in a single process) before its first pass.
+    """
+    if app.config['USE_WORKER_POOL']:
+        get_worker_pool()
+    get_session_janitor()
+
+
 # --- Main Execution ---
 if __name__ == '__main__':
     # Production: Use a proper WSGI server (Gunicorn/uWSGI) behind a reverse proxy (Nginx/Caddy)
     # Development: Use Flask's built-in server (debug=True enables reloader and debugger)
     # Determine debug mode from environment variables
     is_debug = os.getenv('FLASK_ENV', '').lower() == 'development' or os.getenv('FLASK_DEBUG', '0') == '1'
+    create_app()
 
     if is_debug:
         app.logger.setLevel(logging.DEBUG) # Ensure logger is verbose in debug
@@ -927,6 +2276,10 @@ if __name__ == '__main__':
     host = os.getenv('FLASK_RUN_HOST', '0.0.0.0')
     port = int(os.getenv('PORT', 5000)) # PORT is common for PaaS like Heroku/Cloud Run
 
+    # Warm the execution workers and start the janitor up front, but not in the debug reloader's watcher process
+    if not is_debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        warm_up()
+
     app.logger.info(f"Starting Flask server on {host}:{port}")
     # Note: Flask's built-in server is NOT recommended for production.
     # 'debug=is_debug' controls the reloader and debugger.
@@ -0,0 +1,90 @@
+"""
+First-success racing of speculative attempts (used for K parallel generations of one prompt).
+
+`race(attempt, count)` runs attempt(index, race_state) for every index on its own thread
+and returns the result of the first attempt that succeeds. Attempts cooperate with the
+race through the `Race` object they receive:
+
+  - `check()` raises `Cancelled` once another attempt has won (call it between stages
+    and while streaming, so losers stop spending model tokens and execution slots);
+  - `claim()` must be called by an attempt before it returns a result with side effects
+    (e.g. a session directory): it returns False if another attempt already won, and the
+    loser then undoes its side effects itself. This way exactly one result is ever kept,
+    even when two attempts finish at the same moment.
+
+Exceptions of the `failures` types count as a failed attempt; when every attempt fails,
+the earliest failure is raised. Any other exception (a bug, or the caller cancelling the
+whole request) cancels the race and is raised at once.
+"""
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+class Cancelled(Exception):
+    """Another attempt already won the race."""
+
+
+class Race:
+    """State shared by the attempts of one race. Thread-safe."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+        self.winner = None
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def check(self):
+        if self._cancelled.is_set():
+            raise Cancelled()
+
+    def claim(self, index):
+        """Makes attempt `index` the winner unless another attempt got there first."""
+        with self._lock:
+            if self.winner is None and not self._cancelled.is_set():
+                self.winner = index
+                self._cancelled.set()
+                return True
+            return False
+
+    def cancel(self):
+        self._cancelled.set()
+
+
+def race(attempt, count, failures=(Exception,), abort_on=(), thread_name_prefix="docgen-speculative"):
+    """
+    Runs attempt(index, race_state) for index in range(count) concurrently and returns
+    (winner_index, result, failed), `failed` being {index: exception} of the attempts that
+    failed before the winner was found. Raises the earliest failure if all attempts fail.
+    Exceptions of the `abort_on` types end the race at once even if they are also `failures`.
+    Does not wait for the losers: they see the race cancelled and wind down on their own.
+    """
+    state = Race()
+    executor = ThreadPoolExecutor(max_workers=count, thread_name_prefix=thread_name_prefix)
+    try:
+        # Each attempt runs in a copy of the caller's context, so log records keep the request id
+        futures = {executor.submit(contextvars.copy_context().run, attempt, index, state): index for index in range(count)}
+        pending = set(futures)
+        failed = {}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in sorted(done, key=futures.get):
+                index = futures[future]
+                try:
+                    result = future.result()
+                except Cancelled:
+                    continue
+                except abort_on:
+                    raise
+                except failures as e:
+                    failed[index] = e
+                    continue
+                if state.winner == index:
+                    return index, result, failed
+        raise next(iter(failed.values())) if failed else Cancelled()
+    finally:
+        state.cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
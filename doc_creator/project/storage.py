@@ -0,0 +1,143 @@
+"""
+Sharded on-disk layout for generated session directories.
+
+Sessions used to be direct children of GENERATED_FILES_DIR, which turns every lookup,
+listing and backup into an operation on one huge directory. New sessions are stored
+two levels deep using the leading hex digits of their UUID:
+
+    generated_files/ab/cd/abcd1234-..../output.docx
+
+so each directory holds at most a few hundred entries even with millions of sessions.
+Lookups fall back to the old flat location so existing download links keep working
+during the transition, and this module doubles as the migration tool:
+
+    python storage.py migrate [--root DIR] [--index PATH] [--dry-run]
+"""
+import os
+import sys
+import uuid
+import hashlib
+import sqlite3
+import logging
+import argparse
+import threading
+from collections import OrderedDict
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def _uuid(session_id):
+    return session_id if isinstance(session_id, uuid.UUID) else uuid.UUID(str(session_id))
+
+
+def session_rel_dir(session_id, sharded=True):
+    """Path of a session directory relative to the storage root."""
+    session_id = _uuid(session_id)
+    if not sharded:
+        return str(session_id)
+    return os.path.join(session_id.hex[:2], session_id.hex[2:4], str(session_id))
+
+
+def session_dir(root, session_id, sharded=True):
+    """Absolute directory a new session should be written to."""
+    return os.path.join(root, session_rel_dir(session_id, sharded))
+
+
+def resolve_session_dir(root, session_id):
+    """Finds an existing session directory, preferring the sharded layout over the legacy flat one."""
+    for sharded in (True, False):
+        path = session_dir(root, session_id, sharded)
+        if os.path.isdir(path):
+            return path
+    return None
+
+
+# --- Content ETags ---
+# Session files never change after they are written, so each file is hashed once and the
+# digest is remembered for as long as its (inode, size, mtime) stays the same.
+_etag_memo = OrderedDict()
+_etag_lock = threading.Lock()
+ETAG_MEMO_SIZE = 4096
+
+
+def content_etag(path, st=None):
+    """Returns a strong ETag (hex SHA-256 of the file content) for `path`."""
+    st = st or os.stat(path)
+    key = (path, st.st_ino, st.st_size, st.st_mtime_ns)
+    with _etag_lock:
+        etag = _etag_memo.get(key)
+        if etag is not None:
+            _etag_memo.move_to_end(key)
+            return etag
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(block)
+    etag = digest.hexdigest()
+
+    with _etag_lock:
+        _etag_memo[key] = etag
+        if len(_etag_memo) > ETAG_MEMO_SIZE:
+            _etag_memo.popitem(last=False)
+    return etag
+
+
+def migrate_flat_sessions(root, index_path=None, dry_run=False, logger=None):
+    """
+    Moves legacy root/<uuid>/ session directories into the sharded layout.
+    If `index_path` points at the janitor's index, its stored paths are updated as well.
+    Returns the number of sessions moved.
+    """
+    logger = logger or logging.getLogger(__name__)
+    root = os.path.abspath(root)
+    db = sqlite3.connect(index_path, timeout=30) if index_path and os.path.exists(index_path) else None
+    moved = 0
+    try:
+        with os.scandir(root) as entries:
+            for entry in entries:
+                if not entry.is_dir(follow_symlinks=False):
+                    continue
+                try:
+                    session_id = uuid.UUID(entry.name)
+                except ValueError:
+                    continue # Shard directories, caches and other non-session entries
+                dest = session_dir(root, session_id)
+                if os.path.exists(dest):
+                    logger.warning(f"Skipping {entry.name}: {dest} already exists")
+                    continue
+                logger.info(f"{'Would move' if dry_run else 'Moving'} {entry.path} -> {dest}")
+                if not dry_run:
+                    os.makedirs(os.path.dirname(dest), exist_ok=True)
+                    os.rename(entry.path, dest) # Atomic on one filesystem, downloads see old or new path
+                    if db is not None:
+                        with db:
+                            db.execute("UPDATE sessions SET rel_path = ? WHERE session_id = ?",
+                                       (session_rel_dir(session_id), str(session_id)))
+                moved += 1
+    finally:
+        if db is not None:
+            db.close()
+    return moved
+
+
+def main(argv=None):
+    default_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'generated_files')
+    default_index = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'sessions.sqlite3')
+    parser = argparse.ArgumentParser(description="Generated-files storage maintenance.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    migrate = subparsers.add_parser('migrate', help="Move flat <uuid>/ session directories into the sharded layout")
+    migrate.add_argument('--root', default=os.getenv('GENERATED_FILES_DIR', default_root))
+    migrate.add_argument('--index', default=os.getenv('JANITOR_INDEX_PATH', default_index),
+                         help="Janitor index to keep in sync (skipped if missing)")
+    migrate.add_argument('--dry-run', action='store_true', help="Only report what would be moved")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    moved = migrate_flat_sessions(args.root, args.index, dry_run=args.dry_run)
+    print(f"{'Would move' if args.dry_run else 'Moved'} {moved} session directories.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
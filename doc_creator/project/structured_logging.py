@@ -0,0 +1,115 @@
+"""
+Non-blocking, structured logging for the server.
+
+Request threads only put log records on a bounded in-memory queue (`QueueHandler`);
+a single `QueueListener` thread formats them and does the file I/O, including the
+renames of `RotatingFileHandler` rollovers. Records are rendered as one JSON object
+per line and carry the request id and session id of the code that logged them,
+taken from context variables (see `bind`).
+
+Messages are formatted on the listener thread, so `logger.debug("... %s", value)`
+costs next to nothing on the request path when DEBUG is off and only a queue put
+when it is on. If the queue is full (the disk cannot keep up), records are dropped
+and counted instead of blocking requests.
+"""
+import copy
+import json
+import queue
+import atexit
+import logging
+import contextvars
+import logging.handlers
+
+request_id_var = contextvars.ContextVar('request_id', default=None)
+session_id_var = contextvars.ContextVar('session_id', default=None)
+
+
+def bind(request_id=None, session_id=None):
+    """Attaches ids to every record logged from the current context (thread / copied context)."""
+    if request_id is not None:
+        request_id_var.set(str(request_id))
+    if session_id is not None:
+        session_id_var.set(str(session_id))
+
+
+def clear():
+    request_id_var.set(None)
+    session_id_var.set(None)
+
+
+class ContextFilter(logging.Filter):
+    """Stamps records with the ids bound in the emitting thread's context."""
+
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        record.session_id = session_id_var.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record: time, level, logger, process/thread, ids, message, exception."""
+
+    def format(self, record):
+        entry = {
+            'ts': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'process': record.process,
+            'thread': record.threadName,
+            'request_id': getattr(record, 'request_id', None),
+            'session_id': getattr(record, 'session_id', None),
+            'message': record.getMessage(),
+        }
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        elif record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that leaves message formatting to the listener thread and never blocks.
+
+    The stock handler merges `msg % args` in the calling thread; here the record is
+    only copied. Exceptions are rendered eagerly (tracebacks reference live frames).
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_queue_logging(logger, handlers, queue_size=10000, level=logging.NOTSET):
+    """
+    Routes `logger` through a queue to `handlers` (file handlers etc.); handlers already
+    attached to the logger (e.g. Flask's stderr handler) move behind the queue too.
+    Returns (queue_handler, listener); the listener is stopped at exit so queued records
+    are flushed.
+    """
+    log_queue = queue.Queue(maxsize=queue_size)
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+    queue_handler.setLevel(level)
+    existing = list(logger.handlers)
+    for handler in existing:
+        logger.removeHandler(handler)
+    logger.addHandler(queue_handler)
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers, *existing, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return queue_handler, listener
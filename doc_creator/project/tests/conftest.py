@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The project's modules are imported flat (as server.py does), from doc_creator/project
+PROJECT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if PROJECT_DIR not in sys.path:
+    sys.path.insert(0, PROJECT_DIR)
@@ -0,0 +1,77 @@
+import threading
+import time
+
+import pytest
+
+from admission import MIN_SAMPLES, AdmissionController, CostModel, Overloaded, guess_doc_type
+
+DOCX_SCRIPT = "from docx import Document\nDocument().save('output.docx')\n"
+PDF_SCRIPT = "from reportlab.pdfgen import canvas\ncanvas.Canvas('output.pdf').save()\n"
+
+
+def test_guess_doc_type():
+    assert guess_doc_type(DOCX_SCRIPT) == 'docx'
+    assert guess_doc_type(PDF_SCRIPT) == 'pdf'
+    assert guess_doc_type("print('hi')") == 'unknown'
+
+
+def test_timeout_is_p95_times_factor():
+    model = CostModel(default_timeout=15, min_timeout=5, max_timeout=60, timeout_factor=3.0)
+    for seconds in range(1, MIN_SAMPLES + 1):
+        model.record('docx', len(DOCX_SCRIPT), seconds)
+    estimate = model.estimate(DOCX_SCRIPT)
+    assert estimate.basis == 'bucket'
+    assert estimate.expected == 10
+    assert estimate.timeout == 19 * 3.0
+
+
+def test_timeout_is_clamped():
+    model = CostModel(min_timeout=5, max_timeout=60, timeout_factor=3.0)
+    for _ in range(MIN_SAMPLES):
+        model.record('docx', len(DOCX_SCRIPT), 0.1)
+        model.record('pdf', len(PDF_SCRIPT), 100)
+    assert model.estimate(DOCX_SCRIPT).timeout == 5
+    assert model.estimate(PDF_SCRIPT).timeout == 60
+
+
+def test_estimate_falls_back_to_wider_buckets():
+    model = CostModel(default_timeout=15)
+    assert model.estimate(DOCX_SCRIPT).basis == 'default'
+    assert model.estimate(DOCX_SCRIPT).timeout == 15
+    for _ in range(MIN_SAMPLES):
+        model.record('docx', 10000, 2.0) # Another size class of the same type
+    assert model.estimate(DOCX_SCRIPT).basis == 'doc_type'
+    assert model.estimate(PDF_SCRIPT).basis == 'global'
+
+
+def test_empty_controller_always_admits():
+    admission = AdmissionController(slots=1, max_queue_seconds=1, max_wait=0, max_load=0)
+    cost = admission.acquire(100)
+    assert admission.stats()['in_flight'] == 1
+    admission.release(cost)
+    assert admission.stats()['in_flight'] == 0
+
+
+def test_work_beyond_the_queue_bound_is_shed_with_retry_after():
+    admission = AdmissionController(slots=2, max_queue_seconds=10, max_wait=0.05, max_load=0)
+    admission.acquire(15)
+    admission.acquire(5) # 20s of work on 2 slots drains in exactly 10s
+    with pytest.raises(Overloaded) as excinfo:
+        admission.acquire(10)
+    assert excinfo.value.retry_after == 1
+    stats = admission.stats()
+    assert stats['admitted'] == 2 and stats['deferred'] == 1 and stats['shed'] == 1
+
+
+def test_deferred_work_is_admitted_when_capacity_frees_up():
+    admission = AdmissionController(slots=1, max_queue_seconds=10, max_wait=5, max_load=0)
+    first = admission.acquire(8)
+    admitted = []
+    waiter = threading.Thread(target=lambda: admitted.append(admission.acquire(8)))
+    waiter.start()
+    time.sleep(0.05)
+    assert not admitted
+    admission.release(first)
+    waiter.join(5)
+    assert admitted == [8]
+    assert admission.stats()['deferred'] == 1
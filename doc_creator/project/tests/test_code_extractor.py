@@ -0,0 +1,65 @@
+"""
+StreamingCodeExtractor must give exactly the answer of extract_code() (the original regex)
+on the full response, however the response is split into chunks, including when the
+caller stops reading as soon as feed() reports the code block complete.
+"""
+import random
+
+import pytest
+
+from code_extractor import StreamingCodeExtractor, extract_code
+
+# Pieces that exercise split fences, language tags (in any case), empty blocks and stray backticks
+PIECES = [
+    '```', '```', '```python', '```Python', '```PYTHON', '```py', 'python', 'pyth', '`', '``',
+    ' ', '  ', '\n', '\n\n', '\t', 'x = 1', 'print(x)', '# comment', 'Here is the script:',
+    'doc.save("output.docx")', 'Explanation follows.',
+]
+CASES = 20000
+
+
+def random_text(rng):
+    return ''.join(rng.choice(PIECES) for _ in range(rng.randint(0, 14)))
+
+
+def random_chunks(rng, text):
+    """Splits `text` at random points, sometimes into single characters."""
+    if rng.random() < 0.1:
+        return list(text)
+    cuts = sorted(rng.sample(range(1, len(text)), min(len(text) - 1, rng.randint(0, 6)))) if len(text) > 1 else []
+    bounds = [0] + cuts + [len(text)]
+    return [text[start:end] for start, end in zip(bounds, bounds[1:])]
+
+
+def stream(chunks, stop_early):
+    extractor = StreamingCodeExtractor()
+    for chunk in chunks:
+        if extractor.feed(chunk) and stop_early:
+            break
+    return extractor
+
+
+@pytest.mark.parametrize('stop_early', [False, True])
+def test_matches_regex_on_random_chunkings(stop_early):
+    rng = random.Random(20240307 + stop_early)
+    for _ in range(CASES):
+        text = random_text(rng)
+        chunks = random_chunks(rng, text)
+        extractor = stream(chunks, stop_early)
+        assert extractor.result() == extract_code(text), (text, chunks)
+        if extractor.complete:
+            assert extract_code(text)[1]
+
+
+@pytest.mark.parametrize('text, expected', [
+    ("Sure!\n```python\nx = 1\n```\nThis creates x.", ("x = 1", True)),
+    ("```PYTHON\nx = 1\n```", ("x = 1", True)),
+    ("```\nx = 1\n```", ("x = 1", True)),
+    ("```python``` x = 1 ```", ("``` x = 1", True)),
+    ("# header\nx = 1\n# trailer", ("x = 1", False)),
+    ("```python\nx = 1", ("```python\nx = 1", False)), # Unterminated block: raw text
+])
+def test_fence_split_at_every_position(text, expected):
+    assert extract_code(text) == expected
+    for split in range(len(text) + 1):
+        assert stream([text[:split], text[split:]], stop_early=True).result() == expected, split
@@ -0,0 +1,110 @@
+"""
+CodeValidator is the security boundary in front of model-written code: every rejection is
+pinned to the rule that must report it, and the frozen pre-refactor validator
+(benchmarks/bench_validator.legacy_validate) must agree wherever it had a rule at all.
+"""
+import os
+import glob
+
+import pytest
+
+from code_validator import CodeValidator, MAX_CODE_LENGTH
+from benchmarks.bench_validator import ALLOWED_MODULES, build_script, legacy_validate
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks', 'corpus')
+
+ALLOWED = [
+    "from docx import Document\ndoc = Document()\ndoc.add_paragraph('Hello')\ndoc.save('output.docx')\n",
+    "import docx.shared\nfrom pptx import Presentation\nprs = Presentation()\nprs.save('output.pptx')\n",
+    "from reportlab.lib.pagesizes import letter\nimport datetime, random\nprint(datetime.date.today(), random.random())\n",
+    "class Builder:\n    def __init__(self):\n        super().__init__()\n        self.kind = type(self).__name__\n",
+    "if __name__ == '__main__':\n    pass\n",
+    "text = 'open eval exec __import__ os.system'\n", # Only code counts, not strings
+]
+
+# (snippet, rule, rejected by the legacy validator as well)
+FORBIDDEN = [
+    ("__import__('os').system('id')", 'dangerous_builtin', True),
+    ("f = open('/etc/passwd')", 'dangerous_builtin', True),
+    ("with open('output.docx', 'wb') as f:\n    pass", 'dangerous_builtin', True),
+    ("eval('1 + 1')", 'dangerous_builtin', True),
+    ("exec('x = 1')", 'dangerous_builtin', True),
+    ("code = compile('1', 'x', 'eval')", 'dangerous_builtin', True),
+    ("g = globals()", 'dangerous_builtin', True),
+    ("l = locals()", 'dangerous_builtin', True),
+    ("v = vars()", 'dangerous_builtin', False),
+    ("x = getattr(object, 'mro')", 'dangerous_builtin', True),
+    ("name = input()", 'dangerous_builtin', True),
+    ("import os", 'disallowed_import', True),
+    ("import os.path", 'disallowed_import', True),
+    ("import subprocess", 'disallowed_import', True),
+    ("from subprocess import run", 'disallowed_import', True),
+    ("from os import system", 'disallowed_import', True),
+    ("import docx, socket", 'disallowed_import', True),
+    ("from . import helpers", 'relative_import', True),
+    ("os.system('id')", 'dangerous_attribute', True),
+    ("home = os.environ['HOME']", 'dangerous_attribute', True),
+    ("subprocess.run(['id'])", 'dangerous_attribute', True),
+    ("subprocess.Popen(['id'])", 'dangerous_attribute', True),
+    ("classes = ().__class__.__bases__[0].__subclasses__()", 'dunder_access', False),
+    ("def f():\n    pass\ng = f.__globals__", 'dunder_access', False),
+    ("d = Document.__dict__", 'dunder_access', False),
+    ("b = __builtins__", 'dunder_access', False),
+    ("def f(x=(lambda: 1).__code__):\n    pass", 'dunder_access', False),
+    ("def broken(:\n    pass", 'syntax_error', True),
+]
+
+
+@pytest.fixture
+def validator():
+    return CodeValidator(ALLOWED_MODULES)
+
+
+@pytest.mark.parametrize('code', ALLOWED)
+def test_allowed_code_passes(validator, code):
+    result = validator.validate(code)
+    assert result.ok, (result.rule, result.detail)
+    assert result.rule is None
+    assert legacy_validate(code)
+
+
+@pytest.mark.parametrize('code, rule, legacy_rejects', FORBIDDEN)
+def test_forbidden_code_fails_its_rule(validator, code, rule, legacy_rejects):
+    result = validator.validate(code)
+    assert not result.ok
+    assert result.rule == rule, result.detail
+    assert legacy_validate(code) is not legacy_rejects
+
+
+@pytest.mark.parametrize('code, rule, legacy_rejects', FORBIDDEN)
+def test_forbidden_code_fails_when_nested(validator, code, rule, legacy_rejects):
+    if rule in ('syntax_error', 'relative_import'):
+        pytest.skip("Not expressible inside a function body")
+    nested = "def build():\n    if True:\n        for _ in range(1):\n" + ''.join(
+        f"            {line}\n" for line in code.splitlines())
+    assert validator.validate(nested).rule == rule
+
+
+def test_oversized_code_fails(validator):
+    assert validator.validate('#' * (MAX_CODE_LENGTH + 1)).rule == 'max_length'
+
+
+def test_memoized_result_is_identical(validator):
+    code = "import subprocess"
+    first = validator.validate(code)
+    assert validator.validate(code) == first
+    assert validator.stats()['memo_hits'] == 1
+
+
+@pytest.mark.parametrize('path', sorted(glob.glob(os.path.join(CORPUS_DIR, '*.py'))))
+def test_replay_corpus_scripts_pass(validator, path):
+    with open(path, encoding='utf-8') as f:
+        code = f.read()
+    result = validator.validate(code)
+    assert result.ok, (result.rule, result.detail)
+
+
+@pytest.mark.parametrize('kind', ['docx', 'pptx', 'pdf'])
+def test_benchmark_scripts_agree_with_legacy(validator, kind):
+    code = build_script(kind, 20000)
+    assert validator.validate(code).ok and legacy_validate(code)
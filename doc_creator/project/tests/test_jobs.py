@@ -0,0 +1,74 @@
+import threading
+import time
+
+import pytest
+
+from jobs import DONE, FAILED, RUNNING, JobQueue, JobQueueFull
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("condition not reached")
+        time.sleep(0.01)
+
+
+class BlockingHandler:
+    def __init__(self):
+        self.release = threading.Event()
+
+    def __call__(self, prompt):
+        self.release.wait(5)
+        return {'filename': prompt}, 200
+
+
+def test_full_queue_rejects_with_retry_after():
+    handler = BlockingHandler()
+    jobs = JobQueue(handler, workers=1, max_queued=1)
+    running = jobs.submit('first')
+    wait_for(lambda: running.status == RUNNING)
+    jobs.submit('second')
+
+    with pytest.raises(JobQueueFull) as excinfo:
+        jobs.submit('third')
+    # No finished job yet: 5s per job assumed, for the queued job and the running one
+    assert excinfo.value.retry_after == 10
+    assert jobs.stats()['queued'] == 1
+
+    handler.release.set()
+    wait_for(lambda: jobs.stats()[DONE] == 2)
+
+
+def test_retry_after_follows_observed_durations():
+    jobs = JobQueue(lambda prompt: ({}, 200), workers=1, max_queued=1)
+    for prompt in ('a', 'b', 'c'):
+        job = jobs.submit(prompt)
+        wait_for(lambda: job.status == DONE)
+
+    handler = BlockingHandler()
+    jobs.handler = handler
+    running = jobs.submit('slow')
+    wait_for(lambda: running.status == RUNNING)
+    jobs.submit('queued')
+    with pytest.raises(JobQueueFull) as excinfo:
+        jobs.submit('rejected')
+    assert excinfo.value.retry_after == 1
+    handler.release.set()
+
+
+def test_job_results_and_failures():
+    def handler(prompt):
+        if prompt == 'crash':
+            raise RuntimeError("boom")
+        return ({'error': 'bad'}, 400) if prompt == 'bad' else ({'filename': 'output.docx'}, 200)
+
+    jobs = JobQueue(handler, workers=2, max_queued=4)
+    submitted = [jobs.submit(prompt) for prompt in ('ok', 'bad', 'crash')]
+    wait_for(lambda: all(job.finished_at is not None for job in submitted))
+
+    ok, bad, crash = (job.to_dict() for job in submitted)
+    assert ok['status'] == DONE and ok['filename'] == 'output.docx' and ok['status_code'] == 200
+    assert bad['status'] == FAILED and bad['status_code'] == 400
+    assert crash['status'] == FAILED and crash['status_code'] == 500
+    assert jobs.get(submitted[0].id) is submitted[0]
@@ -0,0 +1,40 @@
+import os
+
+import pytest
+
+from llm_backends import LLMBackend, ReplayBackend, ReplayError, create_backend
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks', 'corpus')
+
+
+def test_incomplete_backend_cannot_be_created():
+    class Incomplete(LLMBackend):
+        name = 'incomplete'
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_replay_backend_streams_a_corpus_response():
+    backend = create_backend('replay', corpus_dir=CORPUS_DIR, chunks=3)
+    assert isinstance(backend, ReplayBackend)
+    text = ''.join(chunk.candidates[0].content.parts[0].text for chunk in backend.generate_content('prompt', stream=True))
+    assert text == backend.pick('prompt')[1]
+
+
+def test_replay_backend_raises_injected_errors_from_the_call():
+    backend = create_backend('replay', corpus_dir=CORPUS_DIR, error_rate=1.0)
+    with pytest.raises(ReplayError) as excinfo:
+        backend.generate_content('prompt', stream=True)
+    assert excinfo.value.code == 503
+
+
+def test_replay_backend_waits_for_the_first_chunk_in_the_call():
+    backend = create_backend('replay', corpus_dir=CORPUS_DIR, ttft='fixed:5')
+    with pytest.raises(TimeoutError):
+        backend.generate_content('prompt', stream=True, request_options={'timeout': 0.01})
+
+
+def test_unknown_backend_is_rejected():
+    with pytest.raises(ValueError):
+        create_backend('nope')
@@ -0,0 +1,147 @@
+import os
+import time
+
+import pytest
+
+from llm_backends import ReplayBackend, ReplayError
+from llm_client import CircuitBreaker, LLMClient, LLMDeadlineExceeded, LLMUnavailable, is_retryable
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks', 'corpus')
+
+
+class FlakyBackend(ReplayBackend):
+    """Replay backend whose next `failures` calls raise the given provider error."""
+
+    def __init__(self, failures=0, code=503, **options):
+        super().__init__(CORPUS_DIR, **options)
+        self.failures = failures
+        self.code = code
+        self.calls = 0
+
+    def generate_content(self, prompt, stream=False, request_options=None):
+        self.calls += 1
+        if self.failures:
+            self.failures -= 1
+            raise ReplayError(f"HTTP {self.code}", code=self.code)
+        return super().generate_content(prompt, stream=stream, request_options=request_options)
+
+
+def read(stream):
+    return ''.join(chunk.candidates[0].content.parts[0].text for chunk in stream)
+
+
+def client_for(backend, **options):
+    options = {'backoff_base': 0.001, 'backoff_max': 0.01, **options}
+    return LLMClient(backend, **options)
+
+
+def test_retryable_errors():
+    assert is_retryable(ReplayError("rate limited", code=429))
+    assert is_retryable(ConnectionError())
+    assert not is_retryable(ReplayError("bad request", code=400))
+
+
+def test_retries_with_backoff_until_the_call_succeeds():
+    backend = FlakyBackend(failures=2, code=429)
+    client = client_for(backend, max_retries=3)
+    assert read(client.stream('prompt')) == backend.pick('prompt')[1]
+    assert backend.calls == 3
+    assert client.stats()['retries'] == 2
+    assert client.stats()['failures'] == 0
+
+
+def test_gives_up_after_max_retries():
+    backend = FlakyBackend(failures=10, code=503)
+    client = client_for(backend, max_retries=2)
+    with pytest.raises(ReplayError):
+        read(client.stream('prompt'))
+    assert backend.calls == 3
+    assert client.stats()['failures'] == 1
+
+
+def test_non_retryable_errors_are_not_retried():
+    backend = FlakyBackend(failures=1, code=400)
+    client = client_for(backend, max_retries=3)
+    with pytest.raises(ReplayError):
+        read(client.stream('prompt'))
+    assert backend.calls == 1
+    assert client.breaker.state == 'closed'
+
+
+def test_backoff_is_capped_full_jitter():
+    client = LLMClient(None, backoff_base=0.5, backoff_max=2.0)
+    delays = [client._backoff(attempt) for attempt in range(10) for _ in range(20)]
+    assert all(0 <= delay <= 2.0 for delay in delays)
+
+
+def test_breaker_opens_then_half_open_trial_closes_it():
+    backend = FlakyBackend(failures=2, code=503)
+    client = client_for(backend, max_retries=0, breaker_threshold=2, breaker_reset=0.2)
+    for _ in range(2):
+        with pytest.raises(ReplayError):
+            read(client.stream('prompt'))
+    assert client.breaker.state == 'open'
+
+    # Open: fails fast without reaching the provider
+    with pytest.raises(LLMUnavailable) as excinfo:
+        read(client.stream('prompt'))
+    assert excinfo.value.retry_after >= 1
+    assert backend.calls == 2
+
+    time.sleep(0.25)
+    assert client.breaker.state == 'half_open'
+    assert read(client.stream('prompt'))
+    assert client.breaker.state == 'closed'
+    assert client.stats()['circuit_opened'] == 1
+
+
+def test_failed_half_open_trial_reopens_the_breaker():
+    breaker = CircuitBreaker(threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.before_call() is True
+    # Only one trial at a time
+    with pytest.raises(LLMUnavailable):
+        breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    assert breaker.times_opened == 2
+
+
+def test_slots_are_released_when_a_stream_is_closed_early():
+    backend = FlakyBackend(chunks=4)
+    client = client_for(backend, max_concurrency=1, deadline=1)
+    for _ in range(3):
+        stream = client.stream('prompt')
+        next(stream)
+        assert client.stats()['in_flight'] == 1
+        stream.close()
+        assert client.stats()['in_flight'] == 0
+
+
+def test_slots_are_released_after_failures():
+    backend = FlakyBackend(failures=1, code=400)
+    client = client_for(backend, max_concurrency=1, deadline=1)
+    with pytest.raises(ReplayError):
+        read(client.stream('prompt'))
+    assert read(client.stream('prompt'))
+    assert client.stats()['in_flight'] == 0
+
+
+def test_busy_client_rejects_when_no_slot_frees_up():
+    client = client_for(FlakyBackend(chunks=4), max_concurrency=1, deadline=0.05)
+    stream = client.stream('prompt')
+    next(stream)
+    with pytest.raises(LLMUnavailable):
+        read(client.stream('prompt'))
+    assert client.stats()['rejected'] == 1
+    stream.close()
+
+
+def test_deadline_between_chunks():
+    backend = FlakyBackend(chunks=4, chunk_interval='fixed:0.1')
+    client = client_for(backend, deadline=0.15)
+    with pytest.raises(LLMDeadlineExceeded):
+        read(client.stream('prompt'))
+    stats = client.stats()
+    assert stats['deadline_exceeded'] == 1 and stats['in_flight'] == 0
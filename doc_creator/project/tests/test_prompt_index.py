@@ -0,0 +1,86 @@
+import pytest
+
+from prompt_index import NearDuplicateIndex, normalize_prompt
+
+REPORT = ("Create a Word report for the board summarizing quarterly sales, regional performance, "
+          "key risks and next steps, with a summary table and two bar charts for the European market")
+
+
+@pytest.mark.parametrize('text, expected', [
+    ("<p>Hi, please create a <b>Word</b> report!</p>", "create a word report"),
+    ("Create   a\nWORD\treport.", "create a word report"),
+    ("Thanks! Kindly make slides &amp; notes", "make slides notes"),
+    ("Ｃｒｅａｔｅ a report", "create a report"), # NFKC folds full-width letters
+    ("Budget of 10,000 for version 1.5, please.", "budget of 10,000 for version 1.5"),
+    ("Hello", ""),
+    ("", ""),
+    (None, ""),
+])
+def test_normalize_prompt(text, expected):
+    assert normalize_prompt(text) == expected
+
+
+@pytest.mark.parametrize('text', [
+    "Report for March 3, 2024", "Report for 3 Mar 2024", "Report for 3rd of March 2024",
+    "Report for 2024-03-03", "Report for 2024/3/3", "Report for 03/03/2024", "Report for Mar. 3rd, 2024",
+])
+def test_date_formats_share_one_form(text):
+    assert normalize_prompt(text) == "report for 2024-03-03"
+
+
+def test_different_dates_stay_different():
+    assert normalize_prompt("Report for March 3, 2024") != normalize_prompt("Report for March 4, 2024")
+    assert normalize_prompt("Report for 13/13/2024") == "report for 13/13/2024" # Not a date: left alone
+
+
+@pytest.fixture
+def index():
+    index = NearDuplicateIndex(threshold=0.5)
+    index.add('ns', normalize_prompt(REPORT), 'report-key')
+    return index
+
+
+def test_reordered_prompt_matches(index):
+    reordered = REPORT.replace("regional performance, key risks", "key risks, regional performance")
+    key, similarity = index.lookup('ns', normalize_prompt(reordered))
+    assert key == 'report-key'
+    assert 0.5 <= similarity < 1
+
+
+def test_identical_prompt_matches(index):
+    assert index.lookup('ns', normalize_prompt(REPORT)) == ('report-key', 1.0)
+
+
+@pytest.mark.parametrize('prompt', [
+    REPORT + " in French", # Added words
+    REPORT.replace("risks", "opportunities"), # Changed word
+    REPORT.replace("two bar charts", "three bar charts"),
+    REPORT.replace("two bar charts", "2 bar charts"),
+    REPORT.replace("Word report", "PowerPoint deck"),
+    REPORT.replace("European", "Asian"),
+    REPORT.replace(" and next steps", ""), # Removed words
+    REPORT + " and next steps", # Repeated words
+])
+def test_prompts_asking_for_something_else_miss(index, prompt):
+    assert index.lookup('ns', normalize_prompt(prompt)) is None
+
+
+def test_namespaces_are_separate(index):
+    assert index.lookup('other', normalize_prompt(REPORT)) is None
+
+
+def test_discard_and_eviction():
+    index = NearDuplicateIndex(threshold=0.5, max_entries=2)
+    for i, prompt in enumerate(["sales report for q1", "sales report for q2", "sales report for q3"]):
+        index.add('ns', prompt, f'k{i}')
+    assert index.lookup('ns', "sales report for q1") is None # Evicted, oldest first
+    assert index.lookup('ns', "for q2 sales report")[0] == 'k1'
+    index.discard('ns', 'k1')
+    assert index.lookup('ns', "sales report for q2") is None
+    assert index.stats()['entries'] == 1
+
+
+def test_server_keeps_near_duplicates_off_by_default():
+    server = pytest.importorskip('server')
+    assert server.app.config['NEAR_DUPLICATE_THRESHOLD'] == 0
+    assert server.get_prompt_index() is None
@@ -0,0 +1,69 @@
+import repair
+from repair import MIN_ROUND_SECONDS, MIN_RUN_SECONDS, RepairSession, trim_traceback
+
+TRACEBACK = '''Traceback (most recent call last):
+  File "/srv/app/worker_pool.py", line 120, in _execute_job
+    exec(compiled, namespace)
+  File "/tmp/tmpabc123/generated_script.py", line 3, in <module>
+AttributeError: 'Document' object has no attribute 'add_paragraf'
+'''
+SCRIPT = "from docx import Document\nd = Document()\nd.add_paragraf('x')\n"
+
+
+def test_only_repairable_reasons_are_repaired():
+    session = RepairSession('make a report', max_rounds=2, budget_seconds=60)
+    assert session.can_repair('script_error')
+    assert session.can_repair('validation_failed')
+    for reason in ('timeout', 'overloaded', 'cancelled', 'llm_unavailable'):
+        assert not session.can_repair(reason)
+
+
+def test_rounds_are_bounded():
+    session = RepairSession('make a report', max_rounds=2, budget_seconds=60)
+    for _ in range(2):
+        assert session.can_repair('script_error')
+        session.next_request(SCRIPT, 'script_error', TRACEBACK)
+    assert not session.can_repair('script_error')
+
+
+def test_budget_bounds_rounds_and_runs(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(repair.time, 'monotonic', lambda: now[0])
+    session = RepairSession('make a report', max_rounds=5, budget_seconds=MIN_ROUND_SECONDS + 1)
+    assert session.can_repair('script_error') and session.can_run()
+
+    now[0] += 2 # Less than a round left, but enough to run a script
+    assert not session.can_repair('script_error')
+    assert session.can_run()
+
+    now[0] += MIN_ROUND_SECONDS - MIN_RUN_SECONDS
+    assert not session.can_run()
+    now[0] += 100
+    assert session.remaining() == 0.0
+
+
+def test_next_request_builds_the_conversation():
+    session = RepairSession('make a report')
+    turns = session.next_request(SCRIPT, 'script_error', TRACEBACK)
+    assert [turn['role'] for turn in turns] == ['user', 'model', 'user']
+    assert turns[0]['parts'] == ['make a report']
+    assert SCRIPT in turns[1]['parts'][0]
+    assert 'add_paragraf' in turns[2]['parts'][0]
+    assert session.rounds == 1 and session.last_reason == 'script_error'
+    # The returned turns are a snapshot: later rounds don't change them
+    session.next_request(SCRIPT, 'script_error', TRACEBACK)
+    assert len(turns) == 3 and len(session.turns) == 5
+
+
+def test_trim_traceback_drops_runner_frames_and_host_paths():
+    trimmed = trim_traceback(TRACEBACK, SCRIPT)
+    assert 'worker_pool.py' not in trimmed and 'exec(compiled' not in trimmed
+    assert '/tmp/tmpabc123' not in trimmed
+    assert 'File "generated_script.py", line 3' in trimmed
+    assert "    d.add_paragraf('x')" in trimmed # Source line filled in from the script
+
+
+def test_trim_traceback_keeps_the_end():
+    trimmed = trim_traceback('x' * 5000 + '\nValueError: last line', limit=100)
+    assert trimmed.startswith('...\n') and trimmed.endswith('ValueError: last line')
+    assert len(trimmed) <= 104
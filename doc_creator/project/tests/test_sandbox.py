@@ -0,0 +1,62 @@
+import os
+import subprocess
+import time
+
+import pytest
+
+import sandbox
+from sandbox import SandboxLimits, run_in_sandbox
+
+pytestmark = pytest.mark.skipif(sandbox.resource is None or not hasattr(os, 'wait4'),
+                                reason="rlimits and per-child accounting need a Unix platform")
+
+
+def process_gone(pid):
+    """True once `pid` no longer runs (reaped, or a zombie waiting for its new parent)."""
+    try:
+        with open(f'/proc/{pid}/status', encoding='ascii') as f:
+            return any(line.startswith('State:') and 'Z' in line.split()[1] for line in f)
+    except FileNotFoundError:
+        return True
+
+
+def test_script_runs_and_reports_usage(tmp_path):
+    result = run_in_sandbox("open('output.docx', 'w').write('x')\nprint('done')", str(tmp_path), timeout=30)
+    assert result.returncode == 0
+    assert result.stdout.strip() == 'done'
+    assert (tmp_path / 'output.docx').read_text() == 'x'
+    assert result.limit is None
+    assert result.cpu_seconds is not None and result.peak_rss_kb > 0
+
+
+def test_busy_loop_hits_the_cpu_limit(tmp_path):
+    started = time.monotonic()
+    result = run_in_sandbox("while True:\n    pass\n", str(tmp_path), timeout=30, limits=SandboxLimits(cpu_seconds=1))
+    assert result.limit in ('cpu time limit', 'killed (cpu time or wall-clock limit)')
+    assert result.cpu_seconds > 0.5 # Tick-based accounting may report slightly under the limit
+    assert time.monotonic() - started < 10
+
+
+def test_memory_limit_raises_memory_error(tmp_path):
+    result = run_in_sandbox("table = bytearray(512 * 1024 * 1024)\n", str(tmp_path), timeout=30,
+                            limits=SandboxLimits(memory_mb=256))
+    assert result.returncode != 0
+    assert result.limit == 'memory limit'
+
+
+def test_timeout_kills_the_whole_process_group(tmp_path):
+    code = (
+        "import subprocess, time\n"
+        "child = subprocess.Popen(['/bin/sleep', '60'])\n"
+        "open('child.pid', 'w').write(str(child.pid))\n"
+        "time.sleep(60)\n"
+    )
+    started = time.monotonic()
+    with pytest.raises(subprocess.TimeoutExpired):
+        run_in_sandbox(code, str(tmp_path), timeout=1)
+    assert time.monotonic() - started < 10
+    child_pid = int((tmp_path / 'child.pid').read_text())
+    deadline = time.monotonic() + 5
+    while not process_gone(child_pid) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert process_gone(child_pid)
@@ -0,0 +1,481 @@
+"""
+Warm worker pool for executing AI-generated document scripts.
+
+Each worker is a long-lived Python interpreter that imports the allowed document
+libraries (docx, pptx, reportlab) once at startup and then executes scripts sent
+to it over its stdin pipe. Every script runs in a fresh namespace inside the
+per-request working directory chosen by the server, so the `output.*` file
+contract is identical to running `python generated_script.py` in that directory.
+
+Workers are recycled after a fixed number of jobs or when their peak RSS grows
+past a limit, and a worker that exceeds the execution timeout is killed and
+replaced. Results are returned as `subprocess.CompletedProcess` objects and
+timeouts raise `subprocess.TimeoutExpired`, so callers can treat the pool as a
+drop-in replacement for `subprocess.run`.
+
+Given sandbox limits, every worker runs under the memory / open-file / file-size rlimits
+of sandbox.py once its libraries are loaded, and each job gets its own CPU-time budget.
+
+Unlike a fresh interpreter per script, jobs in one worker share the interpreter's module
+state. Each job gets a fresh namespace, a freshly seeded `random`, and reportlab's global
+state (registered fonts, sequencers, rl_config) reset after it. A job that leaves anything
+else changed in the document libraries (a replaced or added module or class attribute,
+e.g. a monkey-patched docx method, or a library module the worker had not imported) gets
+its worker recycled, so the next user's script never sees it. Changes made *inside*
+mutable library objects (e.g. appending to a module-level list) are not detected.
+
+NOTE: Like the plain subprocess path, this is NOT a security sandbox. It only
+removes interpreter start-up and library import cost from the hot path.
+"""
+import os
+import sys
+import io
+import json
+import time
+import queue
+import itertools
+import logging
+import threading
+import traceback
+import subprocess
+import contextlib
+import sandbox
+
+try:
+    import resource # Unix only; used to report peak RSS of a worker
+except ImportError:
+    resource = None
+
+# Modules imported once per worker. Anything that fails to import is skipped,
+# the generated script will then simply pay the import cost itself.
+PRELOAD_MODULES = (
+    'datetime',
+    'random',
+    'docx',
+    'docx.shared',
+    'docx.enum.text',
+    'docx.enum.style',
+    'docx.oxml.shared',
+    'docx.table',
+    'pptx',
+    'pptx.util',
+    'pptx.dml.color',
+    'pptx.enum.text',
+    'pptx.enum.shapes',
+    'reportlab',
+    'reportlab.lib.pagesizes',
+    'reportlab.lib.styles',
+    'reportlab.lib.units',
+    'reportlab.lib.enums',
+    'reportlab.platypus',
+    'reportlab.pdfbase.pdfmetrics',
+    'reportlab.pdfbase.ttfonts',
+    'reportlab.lib.colors',
+    'reportlab.rl_config',
+)
+
+# Packages whose modules and classes a job must leave as it found them (see _SharedState)
+TRACKED_PACKAGES = frozenset({'docx', 'pptx', 'reportlab', 'lxml', 'PIL', 'builtins', 'random', 'datetime'})
+# Set lazily by the interpreter itself (copyreg caches pickling slot names on classes)
+_BENIGN_ATTRIBUTES = frozenset({'__slotnames__'})
+_MISSING = object()
+
+SCRIPT_FILENAME = 'generated_script.py' # Name reported in tracebacks, matches the subprocess path
+WORKER_STARTUP_TIMEOUT = 60 # Seconds to wait for a fresh worker to finish preloading
+SPAWN_RETRY_DELAYS = (1, 2, 5, 10, 30, 60) # Seconds between attempts to replace a worker that failed to start (last one repeats)
+
+
+class WorkerError(RuntimeError):
+    """Raised when the pool cannot provide a working worker process."""
+
+
+# --- Worker Side (runs inside the child interpreter) ---
+
+def _peak_rss_kb():
+    # Not ru_maxrss: on Linux it includes the web server's RSS at the time the worker was forked
+    return sandbox.self_peak_rss_kb()
+
+
+def _set_job_cpu_budget(cpu_seconds):
+    """Soft RLIMIT_CPU at the worker's CPU time so far plus the budget: SIGXCPU ends a runaway job (and the worker)."""
+    if resource is None or not cpu_seconds:
+        return
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    resource.setrlimit(resource.RLIMIT_CPU, (int(usage.ru_utime + usage.ru_stime) + 1 + int(cpu_seconds), resource.RLIM_INFINITY))
+
+
+class _SharedState:
+    """
+    Snapshot of the attributes of every loaded module and class of TRACKED_PACKAGES, to tell
+    whether a job changed them. Compares by identity (then equality), about 10 ms per job.
+    """
+
+    def __init__(self):
+        self.capture()
+
+    def capture(self):
+        self.modules = set(sys.modules)
+        self.namespaces = []
+        for name, module in list(sys.modules.items()):
+            if module is None or name.partition('.')[0] not in TRACKED_PACKAGES:
+                continue
+            namespace = vars(module)
+            self.namespaces.append((name, namespace, dict(namespace)))
+            for value in list(namespace.values()):
+                if isinstance(value, type) and value.__module__ == name:
+                    self.namespaces.append((f"{name}.{value.__name__}", vars(value), dict(vars(value))))
+
+    def changes(self):
+        """Describes the first change a job left behind, or returns None (after re-capturing lazy initialization)."""
+        added = sorted(name for name in sys.modules.keys() - self.modules if name.partition('.')[0] in TRACKED_PACKAGES)
+        if added:
+            return f"imported {added[0]}"
+        lazy = len(sys.modules) != len(self.modules) # Other (standard library) modules loaded on demand
+        for name, current, saved in self.namespaces:
+            if len(current) == len(saved) and all(current.get(key, _MISSING) is value for key, value in saved.items()):
+                continue
+            for key in current.keys() | saved.keys():
+                before, after = saved.get(key, _MISSING), current.get(key, _MISSING)
+                if before is after or _same_value(before, after): # Resets rebind settings to equal values
+                    continue
+                if key in _BENIGN_ATTRIBUTES or before is None: # A cache filled on first use
+                    lazy = True
+                    continue
+                return f"changed {name}.{key}"
+        if lazy:
+            self.capture()
+        return None
+
+
+def _same_value(before, after):
+    # Functions and classes compare by identity, so a patched method is never "equal" to the original
+    try:
+        return type(before) is type(after) and bool(before == after)
+    except Exception:
+        return False
+
+
+def _reset_libraries():
+    """Puts back the library state that is global by design (reportlab's font registry, sequencers, rl_config)."""
+    rl_config = sys.modules.get('reportlab.rl_config')
+    if rl_config is not None:
+        try:
+            rl_config._reset()
+        except Exception:
+            pass
+
+
+def _execute_job(code, cwd, cpu_seconds=None):
+    """Runs one script in a fresh namespace inside `cwd`, emulating `python script.py`."""
+    import builtins
+    import random
+
+    _set_job_cpu_budget(cpu_seconds)
+    random.seed() # From os.urandom, as in a fresh interpreter
+    stdout, stderr = io.StringIO(), io.StringIO()
+    namespace = {'__name__': '__main__', '__file__': SCRIPT_FILENAME, '__builtins__': builtins}
+    returncode = 0
+    previous_cwd = os.getcwd()
+    cpu_started = time.process_time()
+    try:
+        os.chdir(cwd)
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            try:
+                exec(compile(code, SCRIPT_FILENAME, 'exec'), namespace)
+            except SystemExit as exit_exc:
+                # Mirror the interpreter's handling of sys.exit()/exit() codes
+                if exit_exc.code is None:
+                    returncode = 0
+                elif isinstance(exit_exc.code, int):
+                    returncode = exit_exc.code
+                else:
+                    print(exit_exc.code, file=sys.stderr)
+                    returncode = 1
+            except BaseException:
+                traceback.print_exc()
+                returncode = 1
+    except OSError as e:
+        stderr.write(f"Worker could not enter working directory {cwd}: {e}\n")
+        returncode = 1
+    finally:
+        os.chdir(previous_cwd)
+        namespace.clear()
+        _reset_libraries()
+
+    return {
+        'returncode': returncode,
+        'stdout': stdout.getvalue(),
+        'stderr': stderr.getvalue(),
+        'peak_rss_kb': _peak_rss_kb(),
+        'cpu_seconds': time.process_time() - cpu_started,
+    }
+
+
+def _worker_main(limits=None):
+    """Entry point of a worker process: preload libraries, then serve jobs from stdin."""
+    # Keep private copies of the protocol pipes and point fds 0/1 at /dev/null so that
+    # anything a script writes at the OS level cannot corrupt the JSON protocol stream.
+    proto_in = os.fdopen(os.dup(0), 'r', encoding='utf-8')
+    proto_out = os.fdopen(os.dup(1), 'w', encoding='utf-8', buffering=1)
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 0)
+    os.dup2(devnull, 1)
+    sys.stdin = io.StringIO()
+    sys.stdout = io.StringIO()
+
+    import importlib
+    for module_name in PRELOAD_MODULES:
+        try:
+            importlib.import_module(module_name)
+        except Exception:
+            pass
+
+    # Limits apply to the scripts, not to the preloading above (the CPU budget is set per job)
+    if limits:
+        sandbox.apply_limits(limits, cpu=False)
+
+    _reset_libraries()
+    shared_state = _SharedState()
+    proto_out.write(json.dumps({'ready': True, 'pid': os.getpid()}) + '\n')
+
+    for line in proto_in:
+        if not line.strip():
+            continue
+        job = json.loads(line)
+        result = _execute_job(job['code'], job['cwd'], (limits or {}).get('cpu_seconds'))
+        result['tainted'] = shared_state.changes() # The pool recycles the worker before anyone else uses it
+        proto_out.write(json.dumps(result) + '\n')
+
+
+# --- Pool Side (runs inside the web server process) ---
+
+class _Worker:
+    """Handle for a single worker process and the thread reading its replies."""
+
+    def __init__(self, python_executable, limits=None):
+        command = [python_executable, '-u', os.path.abspath(__file__), '--worker']
+        if limits:
+            command += ['--limits', json.dumps(limits)]
+        self.proc = subprocess.Popen(
+            command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+            encoding='utf-8',
+            bufsize=1,
+        )
+        self.jobs_done = 0
+        self.peak_rss_kb = 0
+        self.tainted = None # What the last job changed in the shared library state, if anything
+        # A reader thread + queue gives us receive-with-timeout on every platform (select() on pipes is Unix-only)
+        self._replies = queue.Queue()
+        self._reader = threading.Thread(target=self._read_replies, daemon=True)
+        self._reader.start()
+
+    def _read_replies(self):
+        try:
+            for line in self.proc.stdout:
+                try:
+                    self._replies.put(json.loads(line))
+                except ValueError:
+                    continue
+        except (OSError, ValueError):
+            pass
+        finally:
+            self._replies.put(None) # EOF marker: the worker exited
+
+    @property
+    def pid(self):
+        return self.proc.pid
+
+    def is_alive(self):
+        return self.proc.poll() is None
+
+    def wait_ready(self, timeout):
+        try:
+            message = self._replies.get(timeout=timeout)
+        except queue.Empty:
+            message = None
+        if not message or not message.get('ready'):
+            self.kill()
+            raise WorkerError("Execution worker failed to start.")
+
+    def run(self, code, cwd, timeout):
+        self.proc.stdin.write(json.dumps({'code': code, 'cwd': cwd}) + '\n')
+        self.proc.stdin.flush()
+        try:
+            reply = self._replies.get(timeout=timeout)
+        except queue.Empty:
+            self.kill()
+            raise subprocess.TimeoutExpired([SCRIPT_FILENAME], timeout)
+        self.jobs_done += 1
+        if reply is None:
+            # The interpreter died mid-job (crash, signal, resource limit...). Report it like a failed run.
+            returncode = self.proc.wait()
+            limit = sandbox.describe_exit(returncode)
+            result = subprocess.CompletedProcess([SCRIPT_FILENAME], returncode or 1, '',
+                                                 f"Execution worker exited unexpectedly (code {returncode}"
+                                                 f"{', ' + limit if limit else ''}).")
+            result.cpu_seconds = result.peak_rss_kb = None
+            result.limit = limit
+            return result
+        self.peak_rss_kb = max(self.peak_rss_kb, reply.get('peak_rss_kb', 0))
+        self.tainted = reply.get('tainted')
+        result = subprocess.CompletedProcess([SCRIPT_FILENAME], reply['returncode'], reply['stdout'], reply['stderr'])
+        result.cpu_seconds = reply.get('cpu_seconds') # CPU time of this job alone (the worker's own time excluded)
+        result.peak_rss_kb = reply.get('peak_rss_kb') # Peak of the whole worker so far (includes the preloaded libraries)
+        result.limit = sandbox.describe_exit(result.returncode, result.stderr)
+        return result
+
+    def kill(self):
+        try:
+            self.proc.kill()
+        except OSError:
+            pass
+        try:
+            self.proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            pass
+        for stream in (self.proc.stdin, self.proc.stdout):
+            try:
+                stream.close()
+            except (OSError, ValueError):
+                pass
+
+
+class WorkerPool:
+    """
+    Fixed-size pool of warm interpreters executing generated scripts.
+
+    `run()` blocks until a worker is idle, executes the script and hands the worker
+    back. Workers that time out, crash, exceed `max_jobs` or grow past `max_rss_mb`
+    are retired and replaced in the background.
+    """
+
+    def __init__(self, size=2, max_jobs=50, max_rss_mb=512, python_executable=None, logger=None, limits=None):
+        self.size = max(1, int(size))
+        self.max_jobs = max_jobs
+        self.max_rss_kb = max_rss_mb * 1024 if max_rss_mb else None
+        self.python_executable = python_executable or sys.executable
+        self.limits = limits.to_dict() if limits is not None else None # sandbox.SandboxLimits for every worker
+        self.logger = logger or logging.getLogger(__name__)
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._closing = threading.Event() # Wakes spawn retries up on shutdown
+        self._workers = set()
+        self.spawn_failures = 0
+        self.tainted_recycles = 0
+        for _ in range(self.size):
+            self._spawn_async()
+
+    def _spawn(self):
+        worker = _Worker(self.python_executable, self.limits)
+        try:
+            worker.wait_ready(WORKER_STARTUP_TIMEOUT)
+        except WorkerError:
+            self.logger.error("Execution worker (pid %s) failed to start.", worker.pid)
+            raise
+        with self._lock:
+            if self._closed:
+                worker.kill()
+                return
+            self._workers.add(worker)
+        self.logger.info(f"Execution worker started (pid {worker.pid}).")
+        self._idle.put(worker)
+
+    def _spawn_async(self):
+        # Starting a worker takes as long as importing the document libraries, keep it off the request path.
+        # A failed start (fork, import or resource trouble) is retried with backoff, so no slot is lost for good.
+        def spawn():
+            for attempt in itertools.count():
+                if self._closed:
+                    return
+                try:
+                    self._spawn()
+                    return
+                except Exception as e:
+                    delay = SPAWN_RETRY_DELAYS[min(attempt, len(SPAWN_RETRY_DELAYS) - 1)]
+                    with self._lock:
+                        self.spawn_failures += 1
+                    self.logger.error(f"Could not start execution worker (attempt {attempt + 1}), retrying in {delay}s: {e}",
+                                      exc_info=attempt == 0)
+                    if self._closing.wait(delay):
+                        return
+        threading.Thread(target=spawn, daemon=True).start()
+
+    def _retire(self, worker, reason):
+        self.logger.info(f"Recycling execution worker (pid {worker.pid}): {reason}")
+        worker.kill()
+        with self._lock:
+            self._workers.discard(worker)
+            closed = self._closed
+        if not closed:
+            self._spawn_async()
+
+    def run(self, code, cwd, timeout):
+        """
+        Executes `code` with `cwd` as working directory.
+        Returns a subprocess.CompletedProcess; raises subprocess.TimeoutExpired on timeout.
+        """
+        if self._closed:
+            raise WorkerError("Worker pool is shut down.")
+        try:
+            # Waiting for a free worker is bounded by the same timeout as the execution itself
+            worker = self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise WorkerError("No execution worker became available in time.")
+
+        try:
+            result = worker.run(code, cwd, timeout)
+        except subprocess.TimeoutExpired:
+            self._retire(worker, "execution timed out")
+            raise
+        except (OSError, ValueError) as e:
+            # Broken pipe etc. - the worker is unusable
+            self._retire(worker, f"pipe error ({e})")
+            raise WorkerError("Execution worker failed.") from e
+
+        if not worker.is_alive():
+            self._retire(worker, "worker exited")
+        elif worker.tainted:
+            with self._lock:
+                self.tainted_recycles += 1
+            self._retire(worker, f"job changed shared library state ({worker.tainted})")
+        elif self.max_jobs and worker.jobs_done >= self.max_jobs:
+            self._retire(worker, f"reached {worker.jobs_done} jobs")
+        elif self.max_rss_kb and worker.peak_rss_kb > self.max_rss_kb:
+            self._retire(worker, f"peak RSS {worker.peak_rss_kb // 1024} MB")
+        else:
+            self._idle.put(worker)
+        return result
+
+    def stats(self):
+        with self._lock:
+            workers = list(self._workers)
+        return {
+            'size': self.size,
+            'live_workers': len(workers),
+            'idle_workers': self._idle.qsize(),
+            'jobs_done': sum(w.jobs_done for w in workers),
+            'spawn_failures': self.spawn_failures,
+            'tainted_recycles': self.tainted_recycles,
+        }
+
+    @property
+    def live_workers(self):
+        with self._lock:
+            return len(self._workers)
+
+    def shutdown(self):
+        self._closing.set()
+        with self._lock:
+            self._closed = True
+            workers = list(self._workers)
+            self._workers.clear()
+        for worker in workers:
+            worker.kill()
+
+
+if __name__ == '__main__' and '--worker' in sys.argv:
+    _worker_main(json.loads(sys.argv[sys.argv.index('--limits') + 1]) if '--limits' in sys.argv else None)